@@ -1,16 +1,42 @@
 from functools import wraps
 
 import flask as f
+from flask_limiter.util import get_remote_address
 
 import auth
 import backend as cb
+import bus
+import db
+import passwords
+import responses
+import stream as st
 import user
 from auth import RegistrationError
 from backend import AuthError, NotAllowedError
 from limiter import limiter
 
 api = f.Blueprint("api", __name__, url_prefix="/api/v1")
-limiter.limit("2 per second")(api)
+
+
+def rate_limit_key():
+    """Limit API requests per token, so clients behind one address do not
+    share a limit. Requests without a valid token are limited per address."""
+
+    body = f.request.get_json(silent=True)
+    token = body.get("token") if isinstance(body, dict) else None
+
+    if isinstance(token, str):
+        try:
+            auth.check_valid_token(token)
+        except AuthError:
+            pass
+        else:
+            return "token:" + auth.hash_token(token)
+
+    return get_remote_address()
+
+
+limiter.limit("2 per second", key_func=rate_limit_key)(api)
 
 
 def token_required(func):
@@ -60,18 +86,131 @@ def missing_arg(arg=None):
 def api_get(username):
 
     try:
-        args = get_kv(f.request, ["latest", "room"], ["latest"])
+        args = get_kv(
+            f.request,
+            ["latest", "room", "wait", "format"],
+            ["latest", "wait", "format"],
+        )
     except ValueError:
         return missing_arg("room")
 
+    try:
+        fmt = responses.message_format(f.request, args["format"])
+    except responses.NotAcceptable as e:
+        return f.jsonify({"e": e.message}), 406
+
+    try:
+        cursor = cb.page_args(args)
+    except ValueError:
+        return f.jsonify({"e": "Cursor arguments must be integers!"}), 400
+
     try:
         latest = int(args["latest"])
     except (ValueError, TypeError):
         latest = 0
 
+    try:
+        wait = float(args["wait"] or 0)
+    except (ValueError, TypeError):
+        return f.jsonify({"e": "wait must be a number of seconds!"}), 400
+    wait = max(0.0, min(wait, f.current_app.config.get("API_MAX_WAIT", 30)))
+
+    if args["room"] not in cb.get_rooms(username):
+        return f.jsonify({"e": "Not a member of this room!"}), 401
+
+    # Long poll: hold the request until something newer than the client's
+    # cursor arrives, then answer as usual (with nothing, on timeout).
+    after_id = latest if cursor is None else cursor["after_id"]
+    paging_back = cursor is not None and cursor["before_id"] is not None
+    if wait and after_id is not None and not paging_back:
+        cb.wait_for_messages(args["room"], after_id, wait)
+
+    tag = responses.etag(args["room"], fmt, cursor, latest)
+    unchanged = responses.not_modified(tag)
+    if unchanged is not None:
+        return unchanged
+
+    if fmt is not None:
+        cursor = cursor or {"after_id": latest, "before_id": None, "limit": None}
+        page = cb.get_column_page(args["room"], **cursor)
+        response = responses.columns_response(page, fmt)
+    elif cursor is not None:
+        response = f.jsonify(cb.get_page(args["room"], **cursor))
+    else:
+        response = f.jsonify(cb.get_messages(args["room"], latest))
+    return responses.finish(response, tag)
+
+
+@api.route("/sync", methods=["POST"])
+@token_required
+def api_sync(username):
+
+    try:
+        args = get_kv(f.request, ["rooms", "limit"], ["limit"])
+    except ValueError:
+        return missing_arg("rooms")
+
+    cursors = args["rooms"]
+    if not isinstance(cursors, dict) or not all(
+        isinstance(v, int) and not isinstance(v, bool) and 0 <= v <= cb.MAX_ID
+        for v in cursors.values()
+    ):
+        return f.jsonify({"e": "rooms must map room names to message ids!"}), 400
+
+    try:
+        limit = None if args["limit"] is None else int(args["limit"])
+    except (ValueError, TypeError):
+        return f.jsonify({"e": "Cursor arguments must be integers!"}), 400
+
+    try:
+        return f.jsonify(cb.sync(username, cursors, limit))
+    except NotAllowedError as e:
+        return f.jsonify({"e": e.message}), 400
+
+
+@api.route("/search", methods=["POST"])
+@token_required
+def api_search(username):
+
+    try:
+        args = get_kv(
+            f.request, ["query", "room", "limit", "offset"], ["room", "limit", "offset"]
+        )
+    except ValueError:
+        return missing_arg("query")
+
+    try:
+        limit = None if args["limit"] is None else int(args["limit"])
+        offset = max(0, int(args["offset"] or 0))
+    except (ValueError, TypeError):
+        return f.jsonify({"e": "limit and offset must be integers!"}), 400
+
+    if args["room"] is not None and args["room"] not in cb.get_rooms(username):
+        return f.jsonify({"e": "Not a member of this room!"}), 401
+
+    return f.jsonify(
+        cb.search(username, str(args["query"]), args["room"], limit, offset)
+    )
+
+
+@api.route("/stream", methods=["POST"])
+@token_required
+def api_stream(username):
+
+    try:
+        args = get_kv(f.request, ["after_id", "room"], ["after_id"])
+    except ValueError:
+        return missing_arg("room")
+
+    try:
+        after_id = st.start_cursor(f.request, args["after_id"])
+    except ValueError:
+        return f.jsonify({"e": "Cursor arguments must be integers!"}), 400
+
     if args["room"] not in cb.get_rooms(username):
         return f.jsonify({"e": "Not a member of this room!"}), 401
-    return f.jsonify(cb.get_messages(args["room"], latest))
+
+    return st.stream_response(args["room"], username, after_id)
 
 
 @api.route("/send", methods=["POST"])
@@ -91,14 +230,47 @@ def api_send(username):
     return f.jsonify({"status": "ok"})
 
 
+@api.route("/send_batch", methods=["POST"])
+@token_required
+def api_send_batch(username):
+
+    try:
+        args = get_kv(f.request, ["messages"])
+    except ValueError:
+        return missing_arg("messages")
+
+    entries = args["messages"]
+    if not isinstance(entries, list) or not all(
+        isinstance(e, dict)
+        and isinstance(e.get("room"), str)
+        and isinstance(e.get("message"), str)
+        and e["message"]
+        for e in entries
+    ):
+        return (
+            f.jsonify({"e": "messages must be a list of {room, message} objects!"}),
+            400,
+        )
+
+    if len(entries) > f.current_app.config.get("API_MAX_BATCH", 1000):
+        return f.jsonify({"e": "Too many messages in one batch!"}), 400
+
+    try:
+        ids = cb.add_messages(username, [(e["room"], e["message"]) for e in entries])
+    except AuthError as e:
+        return f.jsonify({"e": e.message}), 401
+
+    return f.jsonify({"status": "ok", "ids": ids})
+
+
 @api.route("/rooms/<action>", methods=["POST"])
 @token_required
 def manage_rooms(username, action):
     try:
         args = get_kv(
             f.request,
-            ["room", "invite_message", "invite_token"],
-            ["room", "invite_message", "invite_token"],
+            ["room", "invite_message", "invite_token", "message_id"],
+            ["room", "invite_message", "invite_token", "message_id"],
         )
     except ValueError:
         return missing_arg("room")
@@ -141,6 +313,19 @@ def manage_rooms(username, action):
                 return f.jsonify({"room": room})
             except user.InviteError as e:
                 return f.jsonify({"e": e.message})
+        case "unread":
+            return f.jsonify(cb.unread_counts(username))
+        case "read":
+            if not args["room"]:
+                return missing_arg("room")
+            if args["room"] not in cb.get_rooms(username):
+                return f.jsonify({"e": "Not a member of this room!"}), 401
+            try:
+                message_id = int(args["message_id"])
+            except (ValueError, TypeError):
+                return f.jsonify({"e": "message_id must be an integer!"}), 400
+            cb.mark_read(username, args["room"], message_id)
+            return f.jsonify({"status": "ok"})
 
         case _:
             f.abort(404)
@@ -190,6 +375,14 @@ def manage_user(action):
                 except NotAllowedError as e:
                     return f.jsonify({"e": e.message}), 400
             return missing_arg("name")
+        case "revoke":
+            if args["name"]:
+                try:
+                    auth.revoke_named_token(args["username"], args["name"])
+                except AuthError as e:
+                    return f.jsonify({"e": e.message}), 400
+                return f.jsonify({"status": "ok"})
+            return missing_arg("name")
         case "changepass":
             if args["newpass"]:
                 auth.change_password(
@@ -217,3 +410,24 @@ def manage_token(username, action):
             return f.jsonify({"status": "ok"})
         case _:
             f.abort(404)
+
+
+@api.route("/stats", methods=["POST"])
+@token_required
+def stats(username):
+    """Per-worker runtime statistics, for members of the logs room."""
+
+    if "logs" not in cb.get_rooms(username):
+        return f.jsonify({"e": "Not a member of the logs room!"}), 401
+
+    return f.jsonify(
+        {
+            "db_pool": db.pool_stats(),
+            "bus": bus.get_bus().stats(),
+            "membership_cache": cb.cache_stats(),
+            "token_cache": auth.cache_stats(),
+            "log_handler": f.current_app.extensions["log_handler"].stats(),
+            "reclaim": cb.reclaim_stats(),
+            "passwords": passwords.stats(),
+        }
+    )
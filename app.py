@@ -1,5 +1,8 @@
 import logging
 import os
+import queue
+import threading
+import time
 
 import click
 import flask as f
@@ -8,26 +11,143 @@ from flask_wtf.csrf import CSRFProtect, CSRFError
 import api
 import auth
 import backend
+import bus
 import db
 import jar
+import passwords
 import user
-from limiter import limiter
+from limiter import init_limiter
 
-SCHEMA_VERSION = 3
+SCHEMA_VERSION = 15
 
 
 class MessageHandler(logging.Handler):
-    """Logging handler that prints formatted log records to stdout."""
+    """
+    Logging handler that posts formatted log records to the "logs" room.
 
-    def __init__(self, level=logging.NOTSET):
+    Records are formatted in the calling thread (so the request details are
+    still there) and queued. A background thread writes them in batches of up
+    to ``batch_size``, one transaction per batch, at least every
+    ``flush_interval`` seconds. When the queue is full, records are dropped
+    and counted rather than slowing the request down.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        app,
+        level=logging.NOTSET,
+        batch_size=100,
+        flush_interval=1.0,
+        capacity=10000,
+    ):
         super().__init__(level)
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(capacity)
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
 
     def emit(self, record: logging.LogRecord) -> None:
         try:
             msg = self.format(record)
-            backend.notify(msg, "logs")
         except Exception:
-            pass
+            return
+
+        self._start()
+        try:
+            self.queue.put_nowait(msg)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        """Start the writer thread, again in each forked worker."""
+
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self.queue = queue.Queue(self.queue.maxsize)
+                self._thread = threading.Thread(
+                    target=self._run, name="log-writer", daemon=True
+                )
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = []
+            done = None
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(
+                        timeout=max(0, deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+                if item is self._STOP or isinstance(item, threading.Event):
+                    done = item  # a flush or close request
+                    break
+                batch.append(item)
+
+            if batch:
+                self._write(batch)
+
+            if isinstance(done, threading.Event):
+                done.set()
+            elif done is self._STOP:
+                return
+
+    def _write(self, batch):
+        try:
+            with self.app.app_context():
+                backend.notify_many(batch, "logs")
+        except Exception:
+            self.failed += len(batch)
+        else:
+            self.written += len(batch)
+            self.batches += 1
+
+    def flush(self, timeout=5):
+        """Wait until everything queued so far has been written."""
+
+        if self._thread is None or self._pid != os.getpid():
+            return
+        done = threading.Event()
+        try:
+            self.queue.put(done, timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def close(self):
+        self.flush()
+        if self._thread is not None and self._pid == os.getpid():
+            try:
+                self.queue.put(self._STOP, timeout=1)
+            except queue.Full:
+                pass
+            self._thread.join(1)
+        super().close()
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "batches": self.batches,
+        }
 
 
 class RequestFormatter(logging.Formatter):
@@ -48,6 +168,32 @@ def update_db_command():
     db.update_db(SCHEMA_VERSION)
 
 
+@click.command("prune")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option(
+    "--archive",
+    type=click.Path(dir_okay=False),
+    help="SQLite database to move pruned messages to, instead of dropping them.",
+)
+@click.option(
+    "--pause", default=0.05, show_default=True, help="Seconds between batches."
+)
+def prune_command(batch_size, archive, pause):
+    """Delete messages past their room's retention policy."""
+
+    total_rows = total_bytes = 0
+    for room, rows, size in backend.prune(batch_size, archive, pause):
+        click.echo(f"{room}: {rows} messages, {size} bytes")
+        total_rows += rows
+        total_bytes += size
+
+    free = db.free_bytes()
+    click.echo(
+        f"Pruned {total_rows} messages ({total_bytes} bytes of text). "
+        f"{free} bytes are free for reuse in the database file."
+    )
+
+
 @click.command("init")
 @click.option("-r", "--reset", is_flag=True)
 def init_db_command(reset):
@@ -89,26 +235,34 @@ def create_app(test_config=None):
     def main():
         return f.render_template("main.html")
 
-    handler = MessageHandler()
+    handler = MessageHandler(
+        app,
+        batch_size=app.config.get("LOG_BATCH_SIZE", 100),
+        flush_interval=app.config.get("LOG_FLUSH_INTERVAL", 1.0),
+        capacity=app.config.get("LOG_QUEUE_SIZE", 10000),
+    )
     fmt = "%(levelname)s %(name)s [%(remote_addr)s %(method)s %(path)s]: %(message)s"
     handler.setFormatter(RequestFormatter(fmt))
     handler.setLevel(logging.DEBUG)
 
     app.logger.handlers.append(handler)
+    app.extensions["log_handler"] = handler
 
     app.add_url_rule("/i", view_func=user.invite)
 
     db.init_app(app)
+    bus.init_app(app)
 
     app.cli.add_command(init_db_command)
     app.cli.add_command(update_db_command)
+    app.cli.add_command(prune_command)
 
     app.register_blueprint(auth.bp)
     app.register_blueprint(jar.jar)
     app.register_blueprint(api.api)
     app.register_blueprint(user.user)
 
-    limiter.init_app(app)
+    init_limiter(app)
     csrf = CSRFProtect(app)
     csrf.exempt(api.api)
 
@@ -118,6 +272,11 @@ def create_app(test_config=None):
         f.flash("CSRF error. Please reload and try again.")
         return f.redirect(f.request.url)
 
+    @app.errorhandler(passwords.Busy)
+    def handle_passwords_busy(e):
+        app.logger.warning("Password hashing pool is full.")
+        return f.jsonify({"e": e.message}), 503, {"Retry-After": "1"}
+
     return app
 
 
@@ -1,18 +1,38 @@
 import functools
+import hashlib
 import re
 import secrets
 
 import flask as f
-from werkzeug.security import check_password_hash, generate_password_hash
 
 import backend as cb
+import bus
+import passwords
 from backend import AuthError, NotAllowedError
-from db import DBConnection
+from bus import get_bus
+from cache import TTLCache
+from db import DBConnection, retry_on_busy
 
 STATUS_USER = "Message Jar"
 
 bp = f.Blueprint("auth", __name__, url_prefix="/auth")
 
+# Token hash -> username, or None for tokens known to be invalid. Revoking a
+# token clears it in every worker through the message bus.
+TOKEN_TTL = 60
+INVALID_TOKEN_TTL = 10
+
+_token_users = TTLCache(4096, TOKEN_TTL)
+
+# Username -> credential epoch, or None for users that do not exist. Password
+# changes clear it in every worker through the message bus.
+EPOCH_TTL = 60
+
+_epochs = TTLCache(4096, EPOCH_TTL)
+
+# Sessions written in another format are treated as logged out
+SESSION_VERSION = 1
+
 
 class RegistrationError(Exception):
     """Custom exception for registration errors."""
@@ -54,20 +74,74 @@ def login_required(message="Please log in to continue."):
     return decorator
 
 
+class SessionUser:
+    """The logged in user, as ``g.user``. The username comes from the signed
+    session; the rest of the user's row is only read from the database if a
+    view asks for it."""
+
+    def __init__(self, username):
+        self.username = username
+        self._row = None
+
+    def __getitem__(self, key):
+        if key == "username":
+            return self.username
+
+        if self._row is None:
+            with DBConnection() as db:
+                self._row = db.execute(
+                    "SELECT * FROM user WHERE username = ?", (self.username,)
+                ).fetchone()
+        return self._row[key]
+
+
 @bp.before_app_request
 def load_logged_in_user():
-    """If a user id is stored in the session, load the user object from
-    the database into ``g.user``."""
+    """If the session holds a current identity, put the user in ``g.user``.
+
+    The session cookie is signed, so the username in it can be trusted as it
+    is. It also holds the user's credential epoch from when they logged in,
+    which has to match the (cached) current one: changing the password bumps
+    the epoch and so ends every older session.
+    """
     username = f.session.get("username")
+    f.g.user = None
 
     if not username:
-        f.g.user = None
-    else:
+        return
+
+    if (
+        f.session.get("version") != SESSION_VERSION
+        or f.session.get("epoch") != credential_epoch(username)
+    ):
+        f.session.clear()
+        return
+
+    f.g.user = SessionUser(username)
+
+
+def start_session(username, epoch):
+    """Log a user in, in a new session."""
+
+    f.session.clear()
+    f.session["version"] = SESSION_VERSION
+    f.session["username"] = username
+    f.session["epoch"] = epoch
+
+
+def credential_epoch(username):
+    """Get a user's credential epoch, or None if there is no such user."""
+
+    def load():
         with DBConnection() as db:
-            f.g.user = db.execute(
-                "SELECT * FROM user WHERE username = ?", (username,)
+            r = db.execute(
+                "SELECT credential_epoch FROM user WHERE username = ?", (username,)
             ).fetchone()
 
+        return None if r is None else r[0]
+
+    return _epochs.get_or_load(username, load)
+
 
 @bp.route("/register", methods=("GET", "POST"))
 def register():
@@ -116,9 +190,8 @@ def login():
         except AuthError as e:
             f.flash(e.message)
         else:
-            # store the user id in a new session and return to the index
-            f.session.clear()
-            f.session["username"] = user["username"]
+            # store the user in a new session and return to the index
+            start_session(user["username"], user["credential_epoch"])
             return f.redirect(f.url_for("jar.index"))
 
     return f.render_template("auth/login.html")
@@ -147,20 +220,23 @@ def register_user(username, password):
     if not password:
         raise RegistrationError("Password is required.")
 
+    _insert_user(username, passwords.hash_password(password))
+    f.current_app.logger.info(f"Registered new user {username}")
+
+
+@retry_on_busy
+def _insert_user(username, password_hash):
     with DBConnection() as db:
         try:
             db.execute(
                 "INSERT INTO user (username, password) VALUES (?, ?)",
-                (username, generate_password_hash(password)),
+                (username, password_hash),
             )
             db.commit()
         except db.IntegrityError:
             # The username was already taken, which caused the
             # commit to fail. Show a validation error.
             raise RegistrationError(f"User {username} is already registered.")
-        else:
-            f.current_app.logger.info(f"Registered new user {username}")
-            # Success
 
 
 def check_user(user, password):
@@ -169,50 +245,93 @@ def check_user(user, password):
     with DBConnection() as db:
         r = db.execute("SELECT * FROM user WHERE username = ?", (user,)).fetchone()
 
-    if r is None or not check_password_hash(r["password"], password):
+    if r is None or not passwords.check_password(user, password, r["password"]):
         f.current_app.logger.warning(f"Failed attempt to log in as {user}")
         raise AuthError("Incorrect username or password!")
     if user == STATUS_USER:
         f.current_app.logger.warning(f"Attempt to log in as status user {STATUS_USER}")
         raise AuthError("Cannot log in as status user!")
 
+    if passwords.needs_rehash(r["password"]):
+        _rehash(user, password, r["password"])
+
     f.current_app.logger.info(f"User {user} logged in successfully.")
     return r
 
 
+def _rehash(username, password, old_hash):
+    """Hash a password again with the current settings, unless it was changed
+    in the meantime."""
+
+    with DBConnection() as db:
+        db.execute(
+            "UPDATE user SET password = ? WHERE username = ? AND password = ?",
+            (passwords.hash_password(password), username, old_hash),
+        )
+        db.commit()
+    f.current_app.logger.info(f"Updated the password hash of user {username}.")
+
+
 def change_password(username, old_password, new_password):
-    """Change a user's password."""
+    """Change a user's password, which logs them out everywhere. Returns the
+    new credential epoch."""
 
     check_user(username, old_password)
 
     with DBConnection() as db:
-        db.execute(
-            "UPDATE user SET password = ? WHERE username = ?",
-            (generate_password_hash(new_password), username),
-        )
+        epoch = db.execute(
+            "UPDATE user SET password = ?, credential_epoch = credential_epoch + 1 "
+            "WHERE username = ? RETURNING credential_epoch",
+            (passwords.hash_password(new_password), username),
+        ).fetchone()[0]
         db.commit()
 
+    get_bus().broadcast("epochs", username)
+    return epoch
+
+
+def hash_token(token):
+    """API tokens are stored and cached as their SHA-256 hex digest, so that
+    neither the database nor a worker's memory holds usable tokens."""
+
+    return hashlib.sha256(token.encode()).hexdigest()
+
 
 def check_valid_token(token):
     """Check that a token is valid. Raises AuthError on failure."""
-    with DBConnection() as db:
-        r = db.execute(
-            "SELECT username FROM apitokens WHERE token = ?", (token,)
-        ).fetchone()
 
-    if r is None:
+    token_hash = hash_token(token)
+
+    def load():
+        with DBConnection() as db:
+            r = db.execute(
+                "SELECT u.username FROM apitokens t JOIN user u ON u.id = t.user_id "
+                "WHERE t.token = ?",
+                (token_hash,),
+            ).fetchone()
+
+        return None if r is None else r[0]
+
+    # Bad tokens are remembered too, but not for long, so that guessing does
+    # not turn into a database query per attempt.
+    username = _token_users.get_or_load(
+        token_hash, load, lambda u: None if u else INVALID_TOKEN_TTL
+    )
+
+    if username is None:
         raise AuthError("Token not valid")
 
-    return r[0]
+    return username
 
 
 def generate_api_token(username, name):
-    """Generate an API token for a user."""
+    """Generate an API token for a user. Only its hash is stored, so the
+    token cannot be shown again later."""
 
     with DBConnection() as db:
         r = db.execute(
-            "SELECT token FROM apitokens WHERE username = ? AND tokenname = ?",
-            (username, name),
+            "SELECT token FROM apitokens WHERE user_id = ? AND tokenname = ?",
+            (cb.user_id(username), name),
         ).fetchone()
 
     if r is not None:
@@ -221,8 +340,8 @@ def generate_api_token(username, name):
     token = secrets.token_urlsafe(32)
     with DBConnection() as db:
         db.execute(
-            "INSERT INTO apitokens (username, token, tokenname) VALUES (?, ?, ?)",
-            (username, token, name),
+            "INSERT INTO apitokens (user_id, token, tokenname) VALUES (?, ?, ?)",
+            (cb.user_id(username), hash_token(token), name),
         )
         db.commit()
     f.current_app.logger.info(f"Generated API token for user {username}.")
@@ -232,10 +351,41 @@ def generate_api_token(username, name):
 def revoke_api_token(token):
     """Revoke an API token."""
 
+    token_hash = hash_token(token)
+
     with DBConnection() as db:
         db.execute(
             "DELETE FROM apitokens WHERE token = ?",
-            (token,),
+            (token_hash,),
         )
         db.commit()
+
+    get_bus().broadcast("tokens", token_hash)
+    f.current_app.logger.info("Revoked API token.")
+
+
+def revoke_named_token(username, name):
+    """Revoke one of a user's API tokens by its name. Raises AuthError if the
+    user has no such token."""
+
+    with DBConnection() as db:
+        r = db.execute(
+            "SELECT token FROM apitokens WHERE user_id = ? AND tokenname = ?",
+            (cb.user_id(username), name),
+        ).fetchone()
+        if r is None:
+            raise AuthError(f'No token named "{name}"!')
+
+        db.execute("DELETE FROM apitokens WHERE token = ?", (r[0],))
+        db.commit()
+
+    get_bus().broadcast("tokens", r[0])
     f.current_app.logger.info("Revoked API token.")
+
+
+bus.listen("tokens", _token_users.pop)
+bus.listen("epochs", _epochs.pop)
+
+
+def cache_stats():
+    return {"tokens": _token_users.stats(), "epochs": _epochs.stats()}
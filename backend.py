@@ -1,9 +1,79 @@
+import html
+import os
+import queue
+import sqlite3
+import threading
+import time
+
 import flask as f
 
-from db import DBConnection
+import bus
+from bus import get_bus
+from cache import TTLCache
+from db import DBConnection, release_db, retry_on_busy
 
 STATUS_USER = "Message Jar"
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# The largest integer SQLite can store, so the largest id a cursor can hold
+MAX_ID = 2**63 - 1
+
+# Cursors for rooms a user has left that sync still answers, on top of twice
+# the number of rooms they are in
+SYNC_MAX_EXTRA = 16
+
+# Membership caches: user -> list of rooms, and room -> {member: isadmin}.
+# Every change to room membership goes through _membership_changed, which
+# clears the affected entries here and in the other workers.
+MEMBERSHIP_TTL = 30
+MEMBERSHIP_CACHE_SIZE = 4096
+
+_user_rooms = TTLCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_TTL)
+_room_members = TTLCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_TTL)
+
+# Room name -> id. A room keeps its id until it is deleted, which goes through
+# _membership_changed like any other change to who is in it.
+ROOM_ID_TTL = 300
+
+_room_ids = TTLCache(MEMBERSHIP_CACHE_SIZE, ROOM_ID_TTL)
+
+# Username -> id and id -> username. Users are never renamed or deleted, so
+# these only expire to make room for others.
+USER_ID_TTL = 3600
+
+_user_ids = TTLCache(MEMBERSHIP_CACHE_SIZE, USER_ID_TTL)
+_usernames = TTLCache(MEMBERSHIP_CACHE_SIZE, USER_ID_TTL)
+
+# Unread counts: user -> {room: (last_read_id, unread, counted_to)}. Counts are
+# brought up to date by counting only the messages after ``counted_to`` that
+# the message bus has announced since.
+UNREAD_TTL = 300
+
+_unread = TTLCache(MEMBERSHIP_CACHE_SIZE, UNREAD_TTL)
+
+# room id -> progress, for the rooms this worker is deleting messages from.
+# One thread per worker takes them from the queue in turn.
+_reclaiming = {}
+_reclaim_queue = queue.Queue()
+_reclaim_lock = threading.Lock()
+_reclaimer = None
+
+
+def _forget_reclaimer():
+    """The reclaimer thread does not survive a fork, and what it was doing is
+    left for the parent or the next prune."""
+
+    global _reclaiming, _reclaim_queue, _reclaim_lock, _reclaimer
+    _reclaiming = {}
+    _reclaim_queue = queue.Queue()
+    _reclaim_lock = threading.Lock()
+    _reclaimer = None
+
+
+os.register_at_fork(after_in_child=_forget_reclaimer)
+
 
 class AuthError(Exception):
     """Custom exception for authentication errors."""
@@ -23,10 +93,7 @@ class NotAllowedError(Exception):
 
 def create_room(room_name, creator):
     """Create a new room with the given name and creator."""
-    if member_count(room_name) > 0:
-        raise NotAllowedError(f"Room {room_name} already exists!")
-    add_to_room(room_name, creator, isadmin=1)
-    add_to_room(room_name, STATUS_USER)
+    _insert_room(room_name, creator)
     notify(
         f'Room {room_name} created by {creator}. Send "/help" to see available commands',
         room_name,
@@ -34,233 +101,750 @@ def create_room(room_name, creator):
     f.current_app.logger.info(f"Room {room_name} created.")
 
 
+@retry_on_busy
+def _insert_room(room_name, creator):
+    """Create a room with the creator (as admin) and the status user in it,
+    in one transaction. Raises NotAllowedError if the room already exists."""
+
+    with DBConnection() as db:
+        db.execute("BEGIN IMMEDIATE;")
+        try:
+            room_id = db.execute(
+                "INSERT INTO room (name, creator_id) VALUES (?, ?);",
+                (room_name, user_id(creator)),
+            ).lastrowid
+        except db.IntegrityError:
+            db.rollback()
+            raise NotAllowedError(f"Room {room_name} already exists!")
+
+        db.executemany(
+            "INSERT INTO room_members (room_id, user_id, isadmin) VALUES (?, ?, ?)",
+            [(room_id, user_id(creator), 1), (room_id, user_id(STATUS_USER), 0)],
+        )
+        db.commit()
+
+    _membership_changed(room_name, [creator, STATUS_USER])
+
+
+def room_id(room_name):
+    """Get the id of a room, or None if there is no such room."""
+
+    def load():
+        with DBConnection() as db:
+            r = db.execute(
+                "SELECT id FROM room WHERE name = ? AND deleted = 0;", (room_name,)
+            ).fetchone()
+
+        return None if r is None else r[0]
+
+    # Rooms that do not exist yet are not remembered
+    return _room_ids.get_or_load(room_name, load, lambda i: None if i else 0)
+
+
+def user_id(username):
+    """Get the id of a user, or None if there is no such user."""
+
+    def load():
+        with DBConnection() as db:
+            r = db.execute(
+                "SELECT id FROM user WHERE username = ?;", (username,)
+            ).fetchone()
+
+        return None if r is None else r[0]
+
+    # Users that do not exist yet are not remembered
+    return _user_ids.get_or_load(username, load, lambda i: None if i else 0)
+
+
+def usernames(ids):
+    """Map user ids to usernames, reading only the ones not cached."""
+
+    names = {}
+    missing = []
+    for i in set(ids):
+        name = _usernames.get(i, None)
+        if name is None:
+            missing.append(i)
+        else:
+            names[i] = name
+
+    if missing:
+        placeholders = ", ".join("?" for _ in missing)
+        with DBConnection() as db:
+            rows = db.execute(
+                f"SELECT id, username FROM user WHERE id IN ({placeholders});",
+                missing,
+            ).fetchall()
+        for r in rows:
+            _usernames.set(r["id"], r["username"])
+            names[r["id"]] = r["username"]
+
+    return names
+
+
 def notify(content, room):
     """Send a notification message to a room."""
 
     add_message(STATUS_USER, content, room)
 
 
+def notify_many(contents, room):
+    """Send several notification messages to a room in one transaction.
+    Nothing is sent if the status user is not a member of the room."""
+
+    if not contents or room not in get_rooms(STATUS_USER):
+        return
+
+    rid = room_id(room)
+    author = user_id(STATUS_USER)
+    ids = _insert_messages([(author, content, rid) for content in contents])
+    get_bus().publish(room, ids[-1])
+
+
+@retry_on_busy
+def _insert_messages(rows):
+    """Insert (author id, content, room id) rows in one transaction and
+    return their ids, in order."""
+
+    with DBConnection() as conn:
+        conn.execute("BEGIN IMMEDIATE;")
+        last = conn.execute("SELECT MAX(id) FROM messages;").fetchone()[0] or 0
+        conn.executemany(
+            "INSERT INTO messages (author_id, content, room_id) VALUES (?, ?, ?)",
+            rows,
+        )
+        ids = conn.execute(
+            "SELECT id FROM messages WHERE id > ? ORDER BY id;", (last,)
+        ).fetchall()
+        conn.commit()
+
+    return [r[0] for r in ids]
+
+
+def add_messages(author, entries):
+    """Add a batch of (room, message) entries in one transaction and return
+    the new message ids, in order. Membership is checked once per room and
+    slash commands are run afterwards, in the order they were sent."""
+
+    if not entries:
+        return []
+
+    rooms = get_rooms(author)
+    room_ids = {}
+    for room in {room for room, _ in entries}:
+        room_ids[room] = room_id(room) if room in rooms else None
+        if room_ids[room] is None:
+            raise AuthError(f"User {author} is not a member of room {room}.")
+
+    author_id = user_id(author)
+    ids = _insert_messages(
+        [(author_id, message, room_ids[room]) for room, message in entries]
+    )
+
+    latest = {}
+    for (room, _), message_id in zip(entries, ids):
+        latest[room] = message_id
+    for room, message_id in latest.items():
+        get_bus().publish(room, message_id)
+
+    for room, message in entries:
+        if message.startswith("/"):
+            run_command(author, message, room)
+
+    return ids
+
+
 def add_message(author, message, room, force=False):
     """Add a message to the database."""
 
     if not message:
         return
 
-    if not (force or room in get_rooms(author)):
+    rid = room_id(room)
+    if rid is None or not (force or room in get_rooms(author)):
         raise AuthError(f"User {author} is not a member of room {room}.")
 
-    with DBConnection() as conn:
-        conn.execute(
-            "INSERT INTO messages (author, content, room) VALUES (?, ?, ?)",
-            (author, message, room),
-        )
-
-        conn.commit()
+    _insert_message(author, message, room, rid)
 
     if message.startswith("/"):
-        command = message[1:].split(" ")[0]  # remove the leading slash
-        args = " ".join(message[1:].split(" ")[1:])  # get everything after the command
-
-        match command:
-            case "add":  # add a user
-                if user_exists(args):
-                    add_to_room(room, args)
-                    notify(f"{author} added user {args} to the room.", room)
-                else:
-                    notify(f"User {args} does not exist!", room)
+        run_command(author, message, room)
 
-            case "delete":  # delete room
-                try:
-                    delete_room(author, room)
-                except NotAllowedError:
-                    notify(
-                        f'User "{author}" is not an admin and cannot delete the room.',
-                        room,
-                    )
-            case "clear":
-                if is_admin(author, room):
-                    clear_room(room)
-                    notify(f'Room cleared by admin "{author}".', room)
-                else:
-                    notify(
-                        f'User "{author}" is not an admin and cannot clear the room.',
-                        room,
-                    )
-            case "add-admin":
-                if is_admin(author, room):
-                    print(list_users(room))
-                    if args not in list_users(room):
-                        notify(
-                            f'User "{args}" is not a member of the room and cannot be made an admin.',
-                            room,
-                        )
-                        return
-                    make_admin(args, room)
-                    notify(f'User "{args}" made admin by "{author}".', room)
-                else:
-                    notify(
-                        f'User "{author}" is not an admin and cannot make "{args}" admin.',
-                        room,
-                    )
-            case "remove-admin":
-                if args == author:  # TODO
+
+def run_command(author, message, room):
+    """Carry out a slash command that was sent to a room."""
+
+    command = message[1:].split(" ")[0]  # remove the leading slash
+    args = " ".join(message[1:].split(" ")[1:])  # get everything after the command
+
+    match command:
+        case "add":  # add a user
+            if user_exists(args):
+                add_to_room(room, args)
+                notify(f"{author} added user {args} to the room.", room)
+            else:
+                notify(f"User {args} does not exist!", room)
+
+        case "delete":  # delete room
+            try:
+                delete_room(author, room)
+            except NotAllowedError:
+                notify(
+                    f'User "{author}" is not an admin and cannot delete the room.',
+                    room,
+                )
+        case "clear":
+            if is_admin(author, room):
+                clear_room(room)
+                notify(f'Room cleared by admin "{author}".', room)
+            else:
+                notify(
+                    f'User "{author}" is not an admin and cannot clear the room.',
+                    room,
+                )
+        case "add-admin":
+            if is_admin(author, room):
+                print(list_users(room))
+                if args not in list_users(room):
                     notify(
-                        'You cannot remove yourself as an admin! Use "/delete" to delete the room.',
+                        f'User "{args}" is not a member of the room and cannot be made an admin.',
                         room,
                     )
                     return
-                if is_admin(author, room):
-                    if args in list_users(room) and is_admin(args, room):
-                        remove_admin(args, room)
-                        notify(f'User "{args}" removed from admin by "{author}".', room)
-                    else:
-                        notify(
-                            f'User "{args}" is not an admin of this room.',
-                            room,
-                        )
-                        return
+                make_admin(args, room)
+                notify(f'User "{args}" made admin by "{author}".', room)
+            else:
+                notify(
+                    f'User "{author}" is not an admin and cannot make "{args}" admin.',
+                    room,
+                )
+        case "remove-admin":
+            if args == author:  # TODO
+                notify(
+                    'You cannot remove yourself as an admin! Use "/delete" to delete the room.',
+                    room,
+                )
+                return
+            if is_admin(author, room):
+                if args in list_users(room) and is_admin(args, room):
+                    remove_admin(args, room)
+                    notify(f'User "{args}" removed from admin by "{author}".', room)
                 else:
                     notify(
-                        f'User "{author}" is not an admin and cannot remove user "{args}" as an admin.',
+                        f'User "{args}" is not an admin of this room.',
                         room,
                     )
-            case "leave":  # leave room
-                if is_admin(author, room):
+                    return
+            else:
+                notify(
+                    f'User "{author}" is not an admin and cannot remove user "{args}" as an admin.',
+                    room,
+                )
+        case "leave":  # leave room
+            if is_admin(author, room):
+                notify(
+                    (
+                        f"Admin {author} cannot leave the room."
+                        'Use "/delete" to delete the room.'
+                    ),
+                    room,
+                )
+            else:
+                notify(f"User {author} has left the room.", room)
+                remove_from_room(room, author)
+
+        case "help":
+            notify(
+                (
+                    'Send the "/help" command to print this message.'
+                    ' Use "/add my_friend" to add user "my_friend".'
+                    ' The "/remove" command is remarkable similar, '
+                    "although it accomplishes the inverse operation."
+                    ' To use it, send the message "/remove not_my_friend" to remove the user "not_my_friend".'
+                    ' You can leave a room by sending the "/leave" command,'
+                    " although if you created the room, you will have to delete the room instead."
+                    ' This is done by sending the "/delete" command. '
+                    "But be careful:"
+                    ' there is no recovering lost rooms. To empty a room, send the "/clear" command.'
+                    ' Just like the "/delete" command, only admins can perform this action.'
+                    ' A reload may be necessary for the "/leave", "/delete", "/clear", and "/remove" commands'
+                    " due to how the html client works."
+                    " To make someone an admin or remove someones admin status, you will have to be an admin."
+                    ' Then you can use the "/add-admin" and "/remove-admin" commands.'
+                    ' Admins can also limit how long messages are kept with "/retention",'
+                    ' for example "/retention age 30" or "/retention count 1000".'
+                ),
+                room,
+            )
+
+        case "retention":
+            if not is_admin(author, room):
+                notify(
+                    f'User "{author}" is not an admin and cannot change retention.',
+                    room,
+                )
+                return
+
+            match args.split():
+                case []:
+                    pass
+                case ["off"]:
+                    set_retention(room, max_age_days=None, max_count=None)
+                case ["age", days] if days.isdigit() and int(days) > 0:
+                    set_retention(room, max_age_days=int(days))
+                case ["count", count] if count.isdigit() and int(count) > 0:
+                    set_retention(room, max_count=int(count))
+                case _:
                     notify(
-                        (
-                            f"Admin {author} cannot leave the room."
-                            'Use "/delete" to delete the room.'
-                        ),
+                        'Use "/retention age 30" to keep messages for 30 days,'
+                        ' "/retention count 1000" to keep the newest 1000 messages'
+                        ' or "/retention off" to keep everything.',
                         room,
                     )
-                else:
-                    notify(f"User {author} has left the room.", room)
+                    return
 
-                    with DBConnection() as db:
-                        db.execute(
-                            """DELETE FROM rooms
-                                    WHERE roomname = ? AND member = ?;""",
-                            (room, author),
-                        )
-                        db.commit()
+            notify(describe_retention(room), room)
 
-            case "help":
+        case "remove":  # remove a user
+            if args == STATUS_USER:
                 notify(
-                    (
-                        'Send the "/help" command to print this message.'
-                        ' Use "/add my_friend" to add user "my_friend".'
-                        ' The "/remove" command is remarkable similar, '
-                        "although it accomplishes the inverse operation."
-                        ' To use it, send the message "/remove not_my_friend" to remove the user "not_my_friend".'
-                        ' You can leave a room by sending the "/leave" command,'
-                        " although if you created the room, you will have to delete the room instead."
-                        ' This is done by sending the "/delete" command. '
-                        "But be careful:"
-                        ' there is no recovering lost rooms. To empty a room, send the "/clear" command.'
-                        ' Just like the "/delete" command, only admins can perform this action.'
-                        ' A reload may be necessary for the "/leave", "/delete", "/clear", and "/remove" commands'
-                        " due to how the html client works."
-                        " To make someone an admin or remove someones admin status, you will have to be an admin."
-                        ' Then you can use the "/add-admin" and "/remove-admin" commands.'
-                    ),
+                    "You cannot remove the status user.",
                     room,
                 )
 
-            case "remove":  # remove a user
-                if args == STATUS_USER:
-                    notify(
-                        "You cannot remove the status user.",
-                        room,
-                    )
+            elif author == args:
+                notify(
+                    'You cannot remove yourself! Use "/leave" to leave the room.',
+                    room,
+                )
 
-                elif author == args:
-                    notify(
-                        'You cannot remove yourself! Use "/leave" to leave the room.',
-                        room,
-                    )
+            elif is_admin(args, room):
+                notify(
+                    f"User {author} is an admin and cannot be removeed.",
+                    room,
+                )
 
-                elif is_admin(args, room):
-                    notify(
-                        f"User {author} is an admin and cannot be removeed.",
-                        room,
-                    )
+            else:
+                notify(
+                    f"User {args} has been removed from the room by {author}.", room
+                )
+                remove_from_room(room, args)
 
-                else:
-                    notify(
-                        f"User {args} has been removed from the room by {author}.", room
-                    )
+        case _:
+            pass
 
-                    with DBConnection() as db:
-                        db.execute(
-                            """DELETE FROM rooms
-                                    WHERE roomname = ? AND member = ?;""",
-                            (room, args),
-                        )
-                        db.commit()
 
-            case _:
-                pass
+@retry_on_busy
+def _insert_message(author, message, room, rid):
+    with DBConnection() as conn:
+        cur = conn.execute(
+            "INSERT INTO messages (author_id, content, room_id) VALUES (?, ?, ?)",
+            (user_id(author), message, rid),
+        )
+
+        conn.commit()
+
+    get_bus().publish(room, cur.lastrowid)
 
 
 def delete_room(user, room):
-    """Delete a room and its messages from the database."""
+    """Delete a room. Its messages are deleted in the background (see
+    clear_room); the room row goes once they are gone."""
     if not is_admin(user, room):
         raise NotAllowedError(f"User {user} is not an admin of room {room}.")
 
+    rid = room_id(room)
+
     with DBConnection() as db:
-        # delete messages for the room
-        db.execute(
-            "DELETE FROM messages WHERE room = ?;",
-            (room,),
-        )
+        db.execute("BEGIN IMMEDIATE;")
+        # Everyone in the room as it is deleted, not as cached here
+        members = [
+            r[0]
+            for r in db.execute(
+                "SELECT u.username FROM room_members m "
+                "JOIN user u ON u.id = m.user_id WHERE m.room_id = ?;",
+                (rid,),
+            )
+        ]
+        # The name is free for a new room straight away
+        db.execute("UPDATE room SET deleted = 1 WHERE id = ?;", (rid,))
         # delete room membership entries
+        db.execute("DELETE FROM room_members WHERE room_id = ?;", (rid,))
+        db.execute("DELETE FROM read_markers WHERE room_id = ?;", (rid,))
+        db.execute("DELETE FROM invitelinks WHERE room_id = ?;", (rid,))
+        db.commit()
+
+    _membership_changed(room, members)
+    get_bus().forget(room)
+    _reclaim(room, rid)
+
+
+def get_retention(room):
+    """Get a room's retention policy as ``(max_age_days, max_count)``; either
+    is None when there is no such limit."""
+
+    with DBConnection() as db:
+        r = db.execute(
+            "SELECT max_age_days, max_count FROM room WHERE id = ?;",
+            (room_id(room),),
+        ).fetchone()
+
+    return (None, None) if r is None else (r["max_age_days"], r["max_count"])
+
+
+_UNCHANGED = object()
+
+
+def set_retention(room, max_age_days=_UNCHANGED, max_count=_UNCHANGED):
+    """Change one or both limits of a room's retention policy. None removes
+    a limit."""
+
+    age, count = get_retention(room)
+    age = age if max_age_days is _UNCHANGED else max_age_days
+    count = count if max_count is _UNCHANGED else max_count
+
+    with DBConnection() as db:
         db.execute(
-            "DELETE FROM rooms WHERE roomname = ?;",
-            (room,),
+            "UPDATE room SET max_age_days = ?, max_count = ? WHERE id = ?;",
+            (age, count, room_id(room)),
         )
         db.commit()
 
 
-def member_count(room):
-    """duh"""
+def describe_retention(room):
+    age, count = get_retention(room)
+
+    limits = []
+    if age is not None:
+        limits.append(f"for {age} days")
+    if count is not None:
+        limits.append(f"up to the newest {count}")
+
+    if not limits:
+        return "Messages in this room are kept forever."
+    return f"Messages in this room are kept {' and '.join(limits)}."
+
+
+# Above any message id, for deleting everything in a room
+_ALL = MAX_ID
+
+
+def prune(batch_size=500, archive=None, pause=0.05):
+    """Delete the messages that are past their room's retention policy.
+
+    Messages go oldest first in batches of ``batch_size``, one short
+    transaction per batch with ``pause`` seconds between them, so other
+    writers are never held up for long. With ``archive`` (the path of an
+    SQLite database) they are copied there before being deleted. Yields
+    ``(room, rows, bytes)`` for each pruned room, where bytes counts the
+    message text removed.
+
+    Cleared messages and deleted rooms that were not dealt with in the
+    background (because the worker stopped, say) are finished off here too.
+    """
 
     with DBConnection() as db:
+        policies = db.execute(
+            "SELECT id, name, deleted, max_age_days, max_count, cleared_id FROM room "
+            "WHERE max_age_days IS NOT NULL OR max_count IS NOT NULL "
+            "OR cleared_id > 0 OR deleted = 1;"
+        ).fetchall()
+
+        if archive is not None:
+            db.execute("ATTACH DATABASE ? AS archive;", (archive,))
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS archive.messages ("
+                "id INTEGER PRIMARY KEY, author TEXT, created INTEGER,"
+                "content TEXT, room TEXT, edited INTEGER, deleted INTEGER);"
+            )
+
+        try:
+            for rid, room, deleted, max_age_days, max_count, cleared in policies:
+                if deleted:
+                    _delete_room_messages(db, rid, batch_size, pause)
+                    continue
+                if cleared:
+                    # Hidden already, so not archived or counted
+                    _prune_batches(db, rid, cleared + 1, batch_size, None, pause)
+                rows, size = _prune_room(
+                    db, rid, max_age_days, max_count, batch_size, archive, pause
+                )
+                if rows:
+                    _messages_removed(room)
+                    yield room, rows, size
+        finally:
+            if archive is not None:
+                db.execute("DETACH DATABASE archive;")
+
+
+def _prune_room(db, rid, max_age_days, max_count, batch_size, archive, pause):
+    # Everything below ``cutoff`` goes
+    cutoff = 0
+
+    if max_count is not None:
         r = db.execute(
-            """SELECT COUNT(*) AS member_count
-                    FROM rooms
-                    WHERE roomname = ?;""",
-            (room,),
+            "SELECT id FROM messages WHERE room_id = ? "
+            "ORDER BY id DESC LIMIT 1 OFFSET ?;",
+            (rid, max_count - 1),
         ).fetchone()
+        if r is not None:
+            cutoff = r["id"]
+
+    if max_age_days is not None:
+        oldest = int(time.time() * 1000) - max_age_days * 86_400_000
+        # Ids grow with time, so the first message young enough to keep is
+        # found by reading forwards over only the ones that are going anyway
+        r = db.execute(
+            "SELECT id FROM messages WHERE room_id = ? AND created >= ? "
+            "ORDER BY id LIMIT 1;",
+            (rid, oldest),
+        ).fetchone()
+        if r is None:  # all of them are too old
+            r = db.execute(
+                "SELECT MAX(id) + 1 AS id FROM messages WHERE room_id = ?;", (rid,)
+            ).fetchone()
+        cutoff = max(cutoff, r["id"] or 0)
+
+    if not cutoff:
+        return 0, 0
+    return _prune_batches(db, rid, cutoff, batch_size, archive, pause)
 
-    return r[0]
+
+def _prune_batches(db, rid, cutoff, batch_size, archive, pause):
+    """Run _prune_batch until nothing below ``cutoff`` is left, pausing
+    between batches. Returns the total ``(rows, bytes)``."""
+
+    rows = size = 0
+    while True:
+        batch = _prune_batch(db, rid, cutoff, batch_size, archive)
+        if batch is None:
+            break
+        rows += batch[0]
+        size += batch[1]
+        if batch[0] < batch_size:  # that was the last of them
+            break
+        time.sleep(pause)
+
+    return rows, size
+
+
+def _delete_room_messages(db, rid, batch_size, pause):
+    """Delete all of a deleted room's messages in batches, then the room."""
+
+    rows, size = _prune_batches(db, rid, _ALL, batch_size, None, pause)
+
+    db.execute("DELETE FROM room WHERE id = ? AND deleted = 1;", (rid,))
+    db.commit()
+    return rows, size
+
+
+@retry_on_busy
+def _prune_batch(db, rid, cutoff, batch_size, archive):
+    """Delete (and maybe archive) the oldest ``batch_size`` messages of a
+    room below ``cutoff``. Returns ``(rows, bytes)``, or None if there were
+    none left."""
+
+    try:
+        db.execute("BEGIN IMMEDIATE;")
+        last = db.execute(
+            "SELECT id FROM messages WHERE room_id = ? AND id < ? "
+            "ORDER BY id LIMIT 1 OFFSET ?;",
+            (rid, cutoff, batch_size - 1),
+        ).fetchone()
+        if last is None:  # less than a full batch left
+            last = db.execute(
+                "SELECT MAX(id) AS id FROM messages WHERE room_id = ? AND id < ?;",
+                (rid, cutoff),
+            ).fetchone()
+        if last["id"] is None:
+            db.rollback()
+            return None
+
+        r = db.execute(
+            "SELECT COUNT(*) AS n, SUM(LENGTH(CAST(content AS BLOB))) AS size "
+            "FROM messages WHERE room_id = ? AND id <= ?;",
+            (rid, last["id"]),
+        ).fetchone()
+
+        if archive is not None:
+            db.execute(
+                "INSERT OR REPLACE INTO archive.messages "
+                "SELECT m.id, u.username, m.created, m.content, r.name, m.edited, "
+                "m.deleted FROM main.messages m JOIN main.room r ON r.id = m.room_id "
+                "JOIN main.user u ON u.id = m.author_id "
+                "WHERE m.room_id = ? AND m.id <= ?;",
+                (rid, last["id"]),
+            )
+        db.execute(
+            "DELETE FROM messages WHERE room_id = ? AND id <= ?;", (rid, last["id"])
+        )
+        db.commit()
+    except sqlite3.Error:
+        # The caller's connection stays open, so start the retry afresh
+        if db.in_transaction:
+            db.rollback()
+        raise
+
+    return r["n"], r["size"] or 0
+
+
+def member_count(room):
+    """duh"""
+
+    return len(_members(room))
 
 
 def clear_room(room):
-    """Clear all messages from a room."""
+    """Clear all messages from a room.
+
+    Deleting a big room's messages in one go would hold the write lock for
+    as long as that takes, so instead the room's cleared_id is moved up to
+    its newest message, which hides everything up to there from every read
+    straight away, and the rows themselves are deleted in the background.
+    """
+    rid = room_id(room)
+
     with DBConnection() as db:
         db.execute(
-            "DELETE FROM messages WHERE room = ?;",
-            (room,),
+            "UPDATE room SET cleared_id = "
+            "(SELECT COALESCE(MAX(id), 0) FROM messages WHERE room_id = ?) "
+            "WHERE id = ?;",
+            (rid, rid),
         )
         db.commit()
 
+    _messages_removed(room)
+    _reclaim(room, rid)
+
+
+def _reclaim(room, rid):
+    """Delete the messages clear_room hid, or all of a deleted room's, in the
+    background. Progress shows up in reclaim_stats, and the room is told once
+    they are gone."""
+
+    global _reclaimer
+
+    app = f.current_app._get_current_object()
+    with _reclaim_lock:
+        if rid in _reclaiming:
+            # The room goes round again for the new cleared_id
+            _reclaiming[rid]["pending"] = True
+            return
+        _reclaiming[rid] = {"room": room, "rows": 0, "bytes": 0, "pending": False}
+        _reclaim_queue.put((app, rid))
+        if _reclaimer is None:
+            _reclaimer = threading.Thread(
+                target=_run_reclaimer, name="reclaimer", daemon=True
+            )
+            _reclaimer.start()
+
+
+def _run_reclaimer():
+    while True:
+        app, rid = _reclaim_queue.get()
+        try:
+            _reclaim_room(app, rid)
+        except Exception:
+            app.logger.exception("Reclaiming deleted messages failed.")
+
+
+def _reclaim_room(app, rid):
+    progress = _reclaiming[rid]
+    room = progress["room"]
+
+    with app.app_context():
+        batch_size = app.config.get("CLEAR_BATCH_SIZE", 500)
+        pause = app.config.get("CLEAR_PAUSE", 0.05)
+        try:
+            while True:
+                with DBConnection() as db:
+                    r = db.execute(
+                        "SELECT deleted, cleared_id FROM room WHERE id = ?;", (rid,)
+                    ).fetchone()
+                    if r is not None and r["deleted"]:
+                        rows, size = _delete_room_messages(
+                            db, rid, batch_size, pause
+                        )
+                        progress["rows"] += rows
+                        progress["bytes"] += size
+                        batch = None
+                    elif r is not None:
+                        cutoff = r["cleared_id"] + 1
+                        batch = _prune_batch(db, rid, cutoff, batch_size, None)
+                    else:
+                        batch = None
+                if batch is not None:
+                    progress["rows"] += batch[0]
+                    progress["bytes"] += batch[1]
+                    time.sleep(pause)
+                    continue
+                with _reclaim_lock:
+                    if not progress["pending"]:
+                        del _reclaiming[rid]
+                        break
+                    progress["pending"] = False
+        except Exception:
+            with _reclaim_lock:
+                _reclaiming.pop(rid, None)
+            app.logger.exception(f"Deleting cleared messages in {room} failed.")
+            return
+
+        app.logger.info(
+            f"Deleted {progress['rows']} cleared messages "
+            f"({progress['bytes']} bytes) in {room}."
+        )
+        if progress["rows"] and room_id(room) == rid:
+            notify(f"{progress['rows']} cleared messages deleted.", room)
+
+
+def reclaim_stats():
+    """Cleared or deleted rooms whose messages this worker is deleting, with
+    the rows and bytes deleted so far."""
+
+    with _reclaim_lock:
+        return {
+            p["room"]: {"rows": p["rows"], "bytes": p["bytes"]}
+            for p in _reclaiming.values()
+        }
+
 
 def add_to_room(room_name, user, isadmin=0):
-    """Add a user to a room.
-    The way that the database is set up means that to add someone to a non-existent room
-    means that the room will be created.
-    """
+    """Add a user to a room. Rooms are made with create_room, so nothing
+    happens if there is no such room."""
 
-    if user in list_users(room_name):
+    rid = room_id(room_name)
+    if rid is None or user in list_users(room_name):
         return
 
     with DBConnection() as db:
         db.execute(
-            "INSERT INTO rooms (roomname, member, isadmin) VALUES (?, ?, ?)",
-            (room_name, user, isadmin),
+            "INSERT OR IGNORE INTO room_members (room_id, user_id, isadmin) "
+            "VALUES (?, ?, ?)",
+            (rid, user_id(user), isadmin),
         )
         db.commit()
 
+    _membership_changed(room_name, [user])
+
+
+def remove_from_room(room_name, user):
+    """Remove a user from a room."""
+
+    rid = room_id(room_name)
+
+    with DBConnection() as db:
+        db.execute(
+            """DELETE FROM room_members
+                    WHERE room_id = ? AND user_id = ?;""",
+            (rid, user_id(user)),
+        )
+        db.execute(
+            "DELETE FROM read_markers WHERE room_id = ? AND user_id = ?;",
+            (rid, user_id(user)),
+        )
+        db.commit()
+
+    _membership_changed(room_name, [user])
+
 
 def user_exists(user):
     """Check if a user exists in the database."""
@@ -275,80 +859,551 @@ def user_exists(user):
 def get_rooms(user):
     """Get a list of rooms that a user is a member of."""
 
-    with DBConnection() as db:
-        rooms = db.execute(
-            """
-        SELECT DISTINCT roomname
-        FROM rooms
-        WHERE member = ?;""",
-            (user,),
-        ).fetchall()
+    def load():
+        with DBConnection() as db:
+            rooms = db.execute(
+                """
+            SELECT r.name
+            FROM room_members m
+            JOIN room r ON r.id = m.room_id
+            WHERE m.user_id = ?;""",
+                (user_id(user),),
+            ).fetchall()
 
-    rooms = [r["roomname"] for r in rooms]
+        return [r["name"] for r in rooms]
 
-    return rooms
+    return list(_user_rooms.get_or_load(user, load))
 
 
 def is_admin(user, room):
     """Check if a user is an admin of a room."""
 
+    return _members(room).get(user) == 1
+
+
+def _members(room):
+    """Get the cached {member: isadmin} mapping for a room."""
+
+    def load():
+        with DBConnection() as db:
+            rows = db.execute(
+                """
+            SELECT u.username, m.isadmin
+            FROM room_members m
+            JOIN user u ON u.id = m.user_id
+            WHERE m.room_id = ?;""",
+                (room_id(room),),
+            ).fetchall()
+
+        return {r["username"]: r["isadmin"] for r in rows}
+
+    return _room_members.get_or_load(room, load)
+
+
+def _membership_changed(room, users):
+    """Drop the cached membership of a room and of the given users, in this
+    worker and (through the message bus) in every other one."""
+
+    _bump_version(room)
+    get_bus().broadcast("membership", {"room": room, "users": list(users)})
+
+
+def _forget_membership(change):
+    _room_members.pop(change["room"])
+    _room_ids.pop(change["room"])
+    for user in change["users"]:
+        _user_rooms.pop(user)
+        _unread.pop(user)
+
+
+bus.listen("membership", _forget_membership)
+
+
+def mark_read(user, room, message_id):
+    """Move a user's read marker in a room forward to ``message_id`` (capped
+    at the newest message). Markers never move backwards."""
+
+    message_id = min(message_id, latest_id(room))
+
     with DBConnection() as db:
-        r = db.execute(
+        db.execute(
             """
-        SELECT isadmin
-        FROM rooms
-        WHERE roomname = ? AND member = ?;""",
-            (room, user),
+        INSERT INTO read_markers (user_id, room_id, last_read_id) VALUES (?, ?, ?)
+        ON CONFLICT (room_id, user_id)
+        DO UPDATE SET last_read_id = MAX(last_read_id, excluded.last_read_id);""",
+            (user_id(user), room_id(room), message_id),
+        )
+        db.commit()
+
+    _unread_changed([user])
+
+
+def unread_counts(user):
+    """Get the number of unread messages in each of a user's rooms, not
+    counting the user's own.
+
+    Counts come from the (room, id) index past each read marker, are cached
+    per user, and after that only the messages announced on the bus since
+    the last count are counted and added on.
+    """
+
+    def load():
+        with DBConnection() as db:
+            rows = db.execute(
+                """
+            SELECT r.name, COALESCE(k.last_read_id, 0) AS last_read_id,
+                (SELECT COUNT(*) FROM messages m
+                 WHERE m.room_id = r.id
+                 AND m.id > MAX(COALESCE(k.last_read_id, 0), r.cleared_id)
+                 AND m.author_id != rm.user_id
+                ) AS unread,
+                (SELECT MAX(id) FROM messages m
+                 WHERE m.room_id = r.id) AS counted_to
+            FROM room_members rm
+            JOIN room r ON r.id = rm.room_id
+            LEFT JOIN read_markers k
+                ON k.room_id = rm.room_id AND k.user_id = rm.user_id
+            WHERE rm.user_id = ?;""",
+                (user_id(user),),
+            ).fetchall()
+
+        return {
+            r["name"]: (r["last_read_id"], r["unread"], r["counted_to"] or 0)
+            for r in rows
+        }
+
+    cached = _unread.get_or_load(user, load)
+    counts = dict(cached)
+
+    with DBConnection() as db:
+        for room, (last_read_id, unread, counted_to) in cached.items():
+            latest = get_bus().latest(room)
+            if latest > counted_to:
+                new = db.execute(
+                    "SELECT COUNT(*) FROM messages "
+                    "WHERE room_id = ? AND id > ? AND id <= ? AND author_id != ?;",
+                    (
+                        room_id(room),
+                        max(counted_to, last_read_id),
+                        latest,
+                        user_id(user),
+                    ),
+                ).fetchone()[0]
+                counts[room] = (last_read_id, unread + new, latest)
+
+    if counts != cached:
+        _unread.replace(user, cached, counts)
+
+    return {room: unread for room, (_, unread, _) in counts.items()}
+
+
+def _unread_changed(users):
+    """Drop cached unread counts after read markers move or messages are
+    removed, in every worker."""
+
+    get_bus().broadcast("unread", {"users": list(users)})
+
+
+def _forget_unread(change):
+    for user in change["users"]:
+        _unread.pop(user)
+
+
+bus.listen("unread", _forget_unread)
+
+
+def _messages_removed(room):
+    """Let every worker know that messages were taken out of a room, which
+    invalidates unread counts and the room's version."""
+
+    _bump_version(room)
+    get_bus().broadcast("removed", {"room": room, "users": list_users(room)})
+
+
+bus.listen("removed", _forget_unread)
+
+
+@retry_on_busy
+def _bump_version(room):
+    """Move a room's version on, which changes the ETags of its pages."""
+
+    with DBConnection() as db:
+        db.execute(
+            "UPDATE room SET version = version + 1 WHERE name = ? AND deleted = 0;",
+            (room,),
+        )
+        db.commit()
+
+
+def room_state(room):
+    """Get ``(newest message id, version)`` for a room without reading any
+    messages. Together they change whenever a page of the room could.
+
+    Both come from the database, so every worker gives the same answer."""
+
+    rid = room_id(room)
+    with DBConnection() as db:
+        r = db.execute(
+            "SELECT version, cleared_id, "
+            "(SELECT MAX(id) FROM messages WHERE room_id = ?) AS latest "
+            "FROM room WHERE id = ?;",
+            (rid, rid),
         ).fetchone()
 
-    return bool(r and r["isadmin"] == 1)
+    if r is None:
+        return 0, None
+    return r["latest"] or 0, f"{r['cleared_id']}.{r['version']}"
+
+
+def cache_stats():
+    return {
+        "user_rooms": _user_rooms.stats(),
+        "room_members": _room_members.stats(),
+        "unread": _unread.stats(),
+        "room_ids": _room_ids.stats(),
+        "usernames": _usernames.stats(),
+    }
 
 
-def get_messages(room, latest=0):
-    """Get all the messages from a room and return them as a list.
+def get_messages(room, after_id=0, before_id=None, limit=None):
+    """Get messages from a room, oldest first, and return them as a list.
+
+    Only messages with an id greater than ``after_id`` are returned. When
+    ``before_id`` is given, the page of messages just before that id is
+    returned instead, which is what a client needs to scroll back. ``limit``
+    caps the number of messages; with a limit and no cursor at all, the newest
+    messages in the room are returned.
     Use flask.jsonify(get_messages()) to return this as a page
     """
 
+    query, params, newest_first = _message_query(room, after_id, before_id, limit)
+
+    with DBConnection() as conn:
+        rv = conn.execute(query, params).fetchall()
+
+    if newest_first:
+        rv.reverse()
+
+    names = usernames(r["author_id"] for r in rv)
+    return [_message(result, names) for result in rv]
+
+
+def _message_query(room, after_id, before_id, limit):
+    """Build the query behind get_messages. Returns the query, its parameters
+    and whether it returns the newest messages first."""
+
     query = """
-        SELECT m.id, m.author, m.created, m.content
+        SELECT m.id, m.author_id, m.created, m.content
         FROM messages m
-        JOIN user u ON m.author = u.username
-        WHERE room = ?
-        ORDER BY m.id ASC
+        WHERE m.room_id = ? AND m.id > MAX(?, COALESCE(
+            (SELECT cleared_id FROM room WHERE id = ?), 0))"""
+    # One lower bound, so that the index range starts past cleared messages
+    rid = room_id(room)
+    params = [rid, 0 if before_id is not None else after_id or 0, rid]
+
+    if before_id is not None:
+        query += " AND m.id < ?"
+        params.append(before_id)
+
+    # Paging backwards (or grabbing the newest page) walks the index from the
+    # end, so flip the order in SQL and put it right again afterwards.
+    newest_first = limit is not None and (before_id is not None or after_id is None)
+
+    query += " ORDER BY m.id DESC" if newest_first else " ORDER BY m.id ASC"
+
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+
+    return query, params, newest_first
+
+
+def get_columns(room, after_id=0, before_id=None, limit=None):
+    """Get the same messages as get_messages, as one list per column.
+
+    Authors are sent once each in ``authors`` and referred to by their index
+    in that list from the ``author`` column. The columns are built straight
+    from the cursor's tuples, without a dictionary per message.
     """
 
-    data = []
+    query, params, newest_first = _message_query(room, after_id, before_id, limit)
 
     with DBConnection() as conn:
-        results = conn.execute(query, (room,))
-        row_headers = [x[0] for x in results.description]
+        cur = conn.cursor()
+        cur.row_factory = None
+        rv = cur.execute(query, params).fetchall()
+
+    if newest_first:
+        rv.reverse()
+
+    ids, authors, created, content = map(list, zip(*rv)) if rv else ([],) * 4
+
+    index = {}
+    author = [index.setdefault(a, len(index)) for a in authors]
+    names = usernames(index)
+    return {
+        "id": ids,
+        "author": author,
+        "authors": [names[a] for a in index],
+        "created": created,
+        "content": content,
+    }
+
+
+def _message(row, names):
+    """Turn a messages row into the dictionary sent to clients, with the
+    author's name from ``names`` (see usernames)."""
+
+    return {
+        "id": row["id"],
+        "author": names[row["author_id"]],
+        "created": row["created"],
+        "content": row["content"],
+    }
+
+
+def sync(user, cursors, limit=None):
+    """Get what is new in several rooms at once.
+
+    ``cursors`` maps room names to the newest message id the client has. For
+    every one of those rooms the user is still in, up to ``limit`` messages
+    after that id are returned along with the cursor to send next time, all
+    from a single query. Rooms the user is in but did not ask about are listed
+    as ``joined``, and rooms asked about that the user is not in are listed as
+    ``left``, whether or not they exist.
+
+    Raises NotAllowedError if there are many more cursors than the user has
+    rooms.
+    """
 
-        rv = results.fetchall()
+    limit = DEFAULT_PAGE_SIZE if limit is None else max(1, min(limit, MAX_PAGE_SIZE))
 
-    for result in rv:
-        data.append(dict(zip(row_headers, result)))
+    rooms = get_rooms(user)
+    if len(cursors) > SYNC_MAX_EXTRA + 2 * len(rooms):
+        raise NotAllowedError("Too many rooms to sync at once!")
 
-    data.sort(key=lambda x: x["id"])
+    watched = {room: after_id for room, after_id in cursors.items() if room in rooms}
+    gone = [room for room in cursors if room not in watched]
 
-    for i in data[latest:]:
-        i["created"] = i["created"].isoformat() + "Z"  # Z is for the js
+    result = {
+        "rooms": {
+            room: {"messages": [], "next_cursor": after_id}
+            for room, after_id in watched.items()
+        },
+        "joined": [room for room in rooms if room not in cursors],
+        "left": gone,
+    }
 
-    return data[latest:]
+    ids = {room_id(room): room for room in watched}
+
+    with DBConnection() as conn:
+        if watched:
+            # Look up each room's limit-th new message first, so the join only
+            # reads that much of the (room, id) index however big the backlog.
+            values = ", ".join("(?, ?)" for _ in watched)
+            rows = conn.execute(
+                f"""
+            WITH cursors(room_id, after_id) AS (VALUES {values}),
+            floors AS (
+                SELECT cursors.room_id, MAX(cursors.after_id, r.cleared_id) AS after_id
+                FROM cursors
+                JOIN room r ON r.id = cursors.room_id
+            ),
+            bounds AS (
+                SELECT room_id, after_id, (
+                    SELECT id FROM messages
+                    WHERE room_id = c.room_id AND id > c.after_id
+                    ORDER BY id LIMIT 1 OFFSET ?
+                ) AS last_id
+                FROM floors c
+            )
+            SELECT m.id, m.author_id, m.created, m.content, m.room_id
+            FROM bounds b
+            JOIN messages m ON m.room_id = b.room_id AND m.id > b.after_id
+            AND m.id <= COALESCE(b.last_id, 9223372036854775807)
+            ORDER BY m.room_id, m.id;""",
+                [v for rid, room in ids.items() for v in (rid, watched[room])]
+                + [limit - 1],
+            ).fetchall()
+
+            names = usernames(row["author_id"] for row in rows)
+            for row in rows:
+                page = result["rooms"][ids[row["room_id"]]]
+                page["messages"].append(_message(row, names))
+                page["next_cursor"] = row["id"]
+
+    return result
+
+
+def search(user, query, room=None, limit=None, offset=0):
+    """Full-text search the messages in a user's rooms (or just ``room``).
+
+    Every word of ``query`` has to appear; a word ending in ``*`` matches
+    any word it starts. Results are ranked best first (bm25) and come with an
+    HTML snippet of the content with the matches in ``<mark>`` tags. Returns
+    the results and the offset of the next page (None on the last one).
+    """
+
+    limit = DEFAULT_PAGE_SIZE if limit is None else max(1, min(limit, MAX_PAGE_SIZE))
+
+    rooms = get_rooms(user)
+    if room is not None:
+        rooms = [room] if room in rooms else []
+
+    # Quote every word, so that what users type is never FTS5 syntax
+    words = [
+        '"' + w.rstrip("*").replace('"', '""') + '"' + ("*" if w.endswith("*") else "")
+        for w in query.split()
+        if w.rstrip("*")
+    ]
+    if not words or not rooms:
+        return {"results": [], "next_offset": None}
+
+    names = {room_id(room): room for room in rooms}
+    placeholders = ", ".join("?" for _ in names)
+    with DBConnection() as db:
+        rows = db.execute(
+            f"""
+        SELECT m.id, m.author_id, m.created, m.room_id,
+            snippet(messages_fts, 0, char(2), char(3), '...', 16) AS snippet
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN room r ON r.id = m.room_id
+        WHERE messages_fts MATCH ? AND m.room_id IN ({placeholders})
+        AND m.id > r.cleared_id
+        ORDER BY bm25(messages_fts)
+        LIMIT ? OFFSET ?;""",
+            [" ".join(words), *names, limit + 1, offset],
+        ).fetchall()
+
+    authors = usernames(r["author_id"] for r in rows)
+    results = [
+        {
+            "id": r["id"],
+            "author": authors[r["author_id"]],
+            "created": r["created"],
+            "room": names[r["room_id"]],
+            "snippet": html.escape(r["snippet"])
+            .replace("\x02", "<mark>")
+            .replace("\x03", "</mark>"),
+        }
+        for r in rows[:limit]
+    ]
+    next_offset = offset + limit if len(rows) > limit else None
+
+    return {"results": results, "next_offset": next_offset}
+
+
+def latest_id(room):
+    """Get the id of the newest message in a room, or 0 if it is empty."""
+
+    with DBConnection() as db:
+        r = db.execute(
+            "SELECT MAX(id) FROM messages WHERE room_id = ?;", (room_id(room),)
+        ).fetchone()
+
+    return r[0] or 0
+
+
+def wait_for_messages(room, after_id, timeout):
+    """Block until the room has a message newer than ``after_id`` or the
+    timeout (in seconds) runs out. Returns whether there is something new.
+
+    The database is checked once, then the message bus is waited on, so
+    messages from any worker wake the caller. The connection is handed back
+    while waiting.
+    """
+
+    newer = latest_id(room) > after_id
+    release_db()
+
+    return newer or get_bus().wait(room, after_id, timeout)
+
+
+def get_page(room, after_id=None, before_id=None, limit=None):
+    """Get a page of messages along with the cursor for the next request.
+
+    ``next_cursor`` is meant to be sent back as the same parameter that was
+    used for this request: the newest id seen when reading forwards, or the
+    oldest id seen when paging backwards (``None`` once there is nothing left).
+    """
+
+    limit = DEFAULT_PAGE_SIZE if limit is None else max(1, min(limit, MAX_PAGE_SIZE))
+
+    messages = get_messages(room, after_id, before_id, limit)
+    ids = [m["id"] for m in messages]
+
+    return {
+        "messages": messages,
+        "next_cursor": _next_cursor(ids, after_id, before_id, limit),
+    }
+
+
+def get_column_page(room, after_id=None, before_id=None, limit=None):
+    """Like get_page, with the messages in the format of get_columns."""
+
+    limit = DEFAULT_PAGE_SIZE if limit is None else max(1, min(limit, MAX_PAGE_SIZE))
+
+    columns = get_columns(room, after_id, before_id, limit)
+
+    return {
+        "messages": columns,
+        "next_cursor": _next_cursor(columns["id"], after_id, before_id, limit),
+    }
+
+
+def _next_cursor(ids, after_id, before_id, limit):
+    if before_id is not None:
+        # Keep paging backwards from the oldest message, unless this was the
+        # last page.
+        return ids[0] if len(ids) == limit else None
+    if ids:
+        return ids[-1]
+    return after_id or 0
+
+
+def page_args(args):
+    """Read the ``after_id``, ``before_id`` and ``limit`` cursor arguments
+    from a mapping of request arguments.
+
+    Returns ``None`` if none of them were given, so that callers can fall
+    back to the plain list response. Raises ValueError on values that are not
+    integers (or strings of one) or do not fit in SQLite's integers.
+    """
+
+    if not any(args.get(k) is not None for k in ("after_id", "before_id", "limit")):
+        return None
+
+    cursor = {}
+    for key in ("after_id", "before_id", "limit"):
+        value = args.get(key)
+        if value is None or value == "":
+            cursor[key] = None
+            continue
+        # JSON bodies can hold lists, objects, floats and booleans too
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError(f"{key} must be an integer")
+        cursor[key] = int(value)
+        if not -MAX_ID <= cursor[key] <= MAX_ID:
+            raise ValueError(f"{key} is out of range")
+
+    return cursor
 
 
 def list_tokens(user):
-    """List all API tokens for a user."""
+    """List the names of all API tokens for a user. The tokens themselves
+    are only stored hashed."""
 
     with DBConnection() as db:
         tokens = db.execute(
             """
-        SELECT tokenname, token
+        SELECT tokenname
         FROM apitokens
-        WHERE username = ?;""",
-            (user,),
+        WHERE user_id = ?;""",
+            (user_id(user),),
         ).fetchall()
 
-    token_list = [{"tokenname": t["tokenname"], "token": t["token"]} for t in tokens]
+    token_list = [{"tokenname": t["tokenname"]} for t in tokens]
 
     return token_list
 
@@ -359,13 +1414,15 @@ def make_admin(user, room):
     with DBConnection() as db:
         db.execute(
             """
-        UPDATE rooms
+        UPDATE room_members
         SET isadmin = 1
-        WHERE roomname = ? AND member = ?;""",
-            (room, user),
+        WHERE room_id = ? AND user_id = ?;""",
+            (room_id(room), user_id(user)),
         )
         db.commit()
 
+    _membership_changed(room, [user])
+
 
 def remove_admin(user, room):
     """Remove a user as an admin of a room."""
@@ -373,27 +1430,18 @@ def remove_admin(user, room):
     with DBConnection() as db:
         curr = db.execute(
             """
-        UPDATE rooms
+        UPDATE room_members
         SET isadmin = 0
-        WHERE roomname = ? AND member = ?;""",
-            (room, user),
+        WHERE room_id = ? AND user_id = ?;""",
+            (room_id(room), user_id(user)),
         )
         print(f"Rows affected: {curr.rowcount}")
         db.commit()
 
+    _membership_changed(room, [user])
+
 
 def list_users(room):
     """List all users in a room."""
 
-    with DBConnection() as db:
-        users = db.execute(
-            """
-        SELECT member
-        FROM rooms
-        WHERE roomname = ?;""",
-            (room,),
-        ).fetchall()
-
-    user_list = [u["member"] for u in users]
-
-    return user_list
+    return list(_members(room))
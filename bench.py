@@ -0,0 +1,260 @@
+"""
+Micro benchmarks. Run one with ``python bench.py <name>``; ``python bench.py``
+lists them.
+"""
+
+import argparse
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.removeprefix("bench_")] = func
+    return func
+
+
+def report(name, seconds, count, unit="ops"):
+    print(f"{name:<40} {count / seconds:>12,.0f} {unit}/s")
+
+
+def report_latency(name, samples):
+    samples = sorted(samples)
+    p99 = samples[int(len(samples) * 0.99) - 1]
+    print(
+        f"{name:<40} mean {statistics.mean(samples) * 1e6:>9,.0f} us"
+        f"   p99 {p99 * 1e6:>9,.0f} us"
+    )
+
+
+def _buses():
+    from bus import MemoryBus, RedisBus, SQLiteBus
+
+    handle, database = tempfile.mkstemp(suffix=".sqlite")
+    os.close(handle)
+    conn = sqlite3.connect(database)
+    conn.execute("CREATE TABLE room (id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+    conn.execute(
+        "CREATE TABLE messages (id INTEGER PRIMARY KEY, room_id INTEGER NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE bus_events (id INTEGER PRIMARY KEY, origin TEXT NOT NULL, "
+        "channel TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL)"
+    )
+    conn.execute("INSERT INTO room (name) VALUES ('poll')")
+    conn.commit()
+    conn.close()
+
+    buses = [("memory", MemoryBus()), ("sqlite", SQLiteBus(database, 0.01))]
+    try:
+        from redislite import StrictRedis  # type: ignore
+    except ImportError:
+        pass
+    else:
+        redis = StrictRedis(os.path.join(tempfile.mkdtemp(), "bench.rdb"))
+        buses.append(("redis", RedisBus(redis, channel="bench")))
+    return buses, database
+
+
+@benchmark
+def bench_bus(args):
+    """Message bus publish throughput and publish-to-wake latency."""
+
+    buses, database = _buses()
+
+    for name, bus in buses:
+        start = time.perf_counter()
+        for i in range(args.n):
+            bus.publish(f"room {i % 100}", i + 1)
+        report(f"{name}: publish, no waiters", time.perf_counter() - start, args.n)
+
+        samples = []
+        published = 10**9  # past anything the throughput run announced
+        ready = threading.Event()
+
+        def waiter():
+            for i in range(args.rounds):
+                ready.set()
+                bus.wait("latency", published + i, 5)
+                samples.append(time.perf_counter() - sent[0])
+
+        sent = [0.0]
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        for i in range(args.rounds):
+            ready.wait()
+            ready.clear()
+            time.sleep(0.0005)  # let the waiter block
+            sent[0] = time.perf_counter()
+            bus.publish("latency", published + i + 1)
+        thread.join()
+        report_latency(f"{name}: publish to wake", samples)
+
+    # Another process committing is only noticed by the data_version poller
+    sqlite_bus = buses[1][1]
+    conn = sqlite3.connect(database, check_same_thread=False)
+
+    def insert():
+        conn.execute(
+            "INSERT INTO messages (room_id) SELECT id FROM room WHERE name = 'poll'"
+        )
+        conn.commit()
+
+    samples = []
+    for _ in range(min(args.rounds, 200)):
+        last = conn.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+        start = time.perf_counter()
+        timer = threading.Timer(0, insert)
+        timer.start()
+        sqlite_bus.wait("poll", last, 5)
+        samples.append(time.perf_counter() - start)
+        timer.join()
+    conn.close()
+    report_latency("sqlite: foreign commit to wake", samples)
+
+    os.remove(database)
+
+
+@benchmark
+def bench_formats(args):
+    """Payload size and encode time of the message list formats."""
+
+    import flask as f
+
+    import backend as cb
+    import db
+    from app import create_app
+    from responses import msgpack
+
+    handle, database = tempfile.mkstemp(suffix=".sqlite")
+    os.close(handle)
+    app = create_app({"DATABASE": database, "MESSAGE_BUS": "memory"})
+
+    with app.app_context():
+        db.init_db(True)
+        with db.DBConnection() as conn:
+            authors = [
+                conn.execute(
+                    "INSERT INTO user (username, password) VALUES (?, '')",
+                    (f"user {i}",),
+                ).lastrowid
+                for i in range(10)
+            ]
+            room_id = conn.execute(
+                "INSERT INTO room (name) VALUES ('bench');"
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO messages (author_id, content, room_id) VALUES (?, ?, ?)",
+                [
+                    (authors[i % 10], f"message number {i}, saying something", room_id)
+                    for i in range(args.n)
+                ],
+            )
+            conn.commit()
+
+        formats = [
+            ("json rows", lambda: f.json.dumps(cb.get_messages("bench")).encode()),
+            ("json columns", lambda: f.json.dumps(cb.get_columns("bench")).encode()),
+        ]
+        if msgpack is not None:
+            formats.append(
+                ("msgpack columns", lambda: msgpack.packb(cb.get_columns("bench")))
+            )
+
+        for name, encode in formats:
+            size = len(encode())
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                encode()
+            elapsed = time.perf_counter() - start
+            report(f"{name}: {args.n} messages", elapsed, args.rounds, "pages")
+            print(f"{name + ': size':<40} {size:>12,} bytes")
+
+    os.remove(database)
+
+
+def _limiter_hits(uri, count, results):
+    from limits import parse
+    from limits.storage import storage_from_string
+    from limits.strategies import SlidingWindowCounterRateLimiter
+
+    import limiter  # registers the sqlite:// scheme
+
+    rate_limiter = SlidingWindowCounterRateLimiter(storage_from_string(uri))
+    item = parse(f"{count} per hour")
+    results.put(sum(rate_limiter.hit(item, "shared") for _ in range(count)))
+
+
+@benchmark
+def bench_limiter(args):
+    """Rate limiter overhead per request, and whether workers share limits."""
+
+    import multiprocessing
+
+    from limits import parse
+    from limits.storage import storage_from_string
+    from limits.strategies import SlidingWindowCounterRateLimiter
+
+    import limiter
+
+    directory = tempfile.mkdtemp()
+    storages = [("memory", "memory://")]
+    storages.append(("sqlite", "sqlite://" + os.path.join(directory, "limits.sqlite")))
+    if limiter.redis is not None:
+        storages.append(("redis", limiter.DEFAULT_STORAGE_URI))
+
+    # A limit that is never reached, as on a well behaved client
+    item = parse(f"{args.n * 2} per hour")
+    for name, uri in storages:
+        rate_limiter = SlidingWindowCounterRateLimiter(storage_from_string(uri))
+        rate_limiter.storage.reset()
+        samples = []
+        for i in range(args.rounds):
+            start = time.perf_counter()
+            rate_limiter.hit(item, f"client {i % 10}")
+            samples.append(time.perf_counter() - start)
+        report_latency(f"{name}: hit", samples)
+
+        # Four workers each trying to use up the whole limit: the total let
+        # through should be the limit, not four times it.
+        if name == "memory":
+            continue
+        rate_limiter.storage.reset()
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=_limiter_hits, args=(uri, args.rounds // 4, results)
+            )
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        allowed = sum(results.get() for _ in workers)
+        for worker in workers:
+            worker.join()
+        label = f"{name}: 4 workers, limit {args.rounds // 4}"
+        print(f"{label:<40} {allowed:>12,} let through")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("name", nargs="?", choices=sorted(BENCHMARKS))
+    parser.add_argument("-n", type=int, default=100_000, help="operations to time")
+    parser.add_argument("--rounds", type=int, default=1000, help="latency samples")
+    args = parser.parse_args()
+
+    if args.name is None:
+        for name, func in sorted(BENCHMARKS.items()):
+            print(f"{name:<12} {func.__doc__}")
+        return
+
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""
+Cross-worker notifications for new messages.
+
+Writers publish ``(room, message_id)`` after committing a message and readers
+wait on a room until a message newer than the one they have is announced.
+Every bus keeps the newest id it has seen per room, so a publish that lands
+between a reader's query and its wait is not lost.
+
+Buses also carry small broadcasts to every worker (``broadcast`` and
+``subscribe``), which is how in-process caches are invalidated everywhere.
+
+MemoryBus only reaches waiters in the same process. RedisBus relays through a
+redis (or redislite) server, and SQLiteBus watches ``PRAGMA data_version`` on
+the database itself, so both also see messages written by other workers.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import flask as f
+
+
+class MemoryBus:
+    """Bus for waiters in this process only."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._conditions = {}
+        self._waiting = {}
+        self._subscribers = {}
+
+        self.broadcasts = 0
+        self.published = 0
+        self.delivered = 0
+        self.wakeups = 0
+        self.timeouts = 0
+
+    def publish(self, room, message_id):
+        """Announce that ``message_id`` was committed in ``room``."""
+
+        self.published += 1
+        self._deliver(room, message_id)
+
+    def _deliver(self, room, message_id):
+        with self._lock:
+            self.delivered += 1
+            if message_id > self._latest.get(room, 0):
+                self._latest[room] = message_id
+            condition = self._conditions.get(room)
+            if condition is not None:
+                condition.notify_all()
+
+    def latest(self, room):
+        """The newest message id announced for a room, or 0."""
+
+        with self._lock:
+            return self._latest.get(room, 0)
+
+    def wait(self, room, after_id, timeout):
+        """Block until a message newer than ``after_id`` is announced for
+        ``room``, or ``timeout`` seconds pass. Returns whether one was."""
+
+        with self._lock:
+            condition = self._conditions.get(room)
+            if condition is None:
+                condition = self._conditions[room] = threading.Condition(self._lock)
+            self._waiting[room] = self._waiting.get(room, 0) + 1
+
+            try:
+                ok = condition.wait_for(
+                    lambda: self._latest.get(room, 0) > after_id, timeout
+                )
+            finally:
+                self._waiting[room] -= 1
+                if not self._waiting[room]:
+                    del self._waiting[room]
+                    del self._conditions[room]
+
+        if ok:
+            self.wakeups += 1
+        else:
+            self.timeouts += 1
+        return ok
+
+    def subscribe(self, channel, callback):
+        """Call ``callback(payload)`` for every broadcast on ``channel``,
+        whichever worker sent it."""
+
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def broadcast(self, channel, payload):
+        """Send a JSON serializable payload to the subscribers of ``channel``
+        in every worker, this one included."""
+
+        self.broadcasts += 1
+        self._dispatch(channel, payload)
+
+    def _dispatch(self, channel, payload):
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, ()))
+        for callback in callbacks:
+            callback(payload)
+
+    def forget(self, room):
+        """Drop what is known about a room, e.g. after it is deleted."""
+
+        with self._lock:
+            self._latest.pop(room, None)
+
+    def stats(self):
+        with self._lock:
+            waiting = sum(self._waiting.values())
+        return {
+            "backend": type(self).__name__,
+            "pid": os.getpid(),
+            "rooms": len(self._latest),
+            "waiting": waiting,
+            "broadcasts": self.broadcasts,
+            "published": self.published,
+            "delivered": self.delivered,
+            "wakeups": self.wakeups,
+            "timeouts": self.timeouts,
+        }
+
+
+class RedisBus(MemoryBus):
+    """Bus relayed through redis pub/sub, so every worker sharing the redis
+    server (a redislite Unix socket by default) hears every publish."""
+
+    def __init__(self, client, channel="messagejar:messages"):
+        super().__init__()
+        self._client = client
+        self._channel = channel
+        self._listener = None
+        self._listener_lock = threading.Lock()
+        self._origin = uuid.uuid4().hex
+
+    def publish(self, room, message_id):
+        super().publish(room, message_id)
+        self._client.publish(self._channel, json.dumps([room, message_id]))
+
+    def wait(self, room, after_id, timeout):
+        self._listen()
+        return super().wait(room, after_id, timeout)
+
+    def subscribe(self, channel, callback):
+        super().subscribe(channel, callback)
+        self._listen()
+
+    def broadcast(self, channel, payload):
+        super().broadcast(channel, payload)
+        event = {"origin": self._origin, "channel": channel, "payload": payload}
+        self._client.publish(self._channel, json.dumps(event))
+
+    def _receive(self, data):
+        data = json.loads(data)
+        if isinstance(data, dict):
+            if data["origin"] != self._origin:
+                self._dispatch(data["channel"], data["payload"])
+        else:
+            room, message_id = data
+            self._deliver(room, message_id)
+
+    def _listen(self):
+        with self._listener_lock:
+            if self._listener is None:
+                self._start_listener()
+
+    def _start_listener(self):
+        def subscribe():
+            pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self._channel)
+            return pubsub
+
+        # Subscribe before returning, so nothing published after this call
+        # can be missed by the waiter.
+        pubsub = subscribe()
+
+        def run():
+            nonlocal pubsub
+            while True:
+                try:
+                    for message in pubsub.listen():
+                        try:
+                            self._receive(message["data"])
+                        except (TypeError, ValueError, KeyError):
+                            continue
+                except Exception:
+                    # Lost the server; waiters still time out and re-check
+                    # the database, so just try to subscribe again.
+                    time.sleep(1)
+                    try:
+                        pubsub = subscribe()
+                    except Exception:
+                        pass
+
+        self._listener = threading.Thread(target=run, name="bus-redis", daemon=True)
+        self._listener.start()
+
+
+class SQLiteBus(MemoryBus):
+    """
+    Bus that needs nothing but the database. A daemon thread polls
+    ``PRAGMA data_version``, which changes whenever another connection
+    commits, and then looks up the new messages by id range. Publishes from
+    this process are delivered at once; those from other workers within
+    ``interval`` seconds. Broadcasts are written to the small ``bus_events``
+    table from schema.sql, read the same way and pruned after a minute.
+    """
+
+    def __init__(self, database, interval=0.2):
+        super().__init__()
+        self._database = database
+        self._interval = interval
+        self._poller = None
+        self._poller_lock = threading.Lock()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._origin = uuid.uuid4().hex
+        self.polls = 0
+
+    def wait(self, room, after_id, timeout):
+        self._poll()
+        return super().wait(room, after_id, timeout)
+
+    def subscribe(self, channel, callback):
+        super().subscribe(channel, callback)
+        self._poll()
+
+    def broadcast(self, channel, payload):
+        super().broadcast(channel, payload)
+
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = sqlite3.connect(self._database, check_same_thread=False)
+                self._writer.execute("PRAGMA busy_timeout = 5000;")
+            self._writer.execute(
+                "INSERT INTO bus_events (origin, channel, payload, created) "
+                "VALUES (?, ?, ?, ?);",
+                (self._origin, channel, json.dumps(payload), time.time()),
+            )
+            self._writer.execute(
+                "DELETE FROM bus_events WHERE created < ?;", (time.time() - 60,)
+            )
+            self._writer.commit()
+
+    def _poll(self):
+        with self._poller_lock:
+            if self._poller is None:
+                self._start_poller()
+
+    def _start_poller(self):
+        conn = sqlite3.connect(self._database, check_same_thread=False)
+        conn.execute("PRAGMA busy_timeout = 5000;")
+        seen = conn.execute("SELECT MAX(id) FROM messages;").fetchone()[0] or 0
+        seen_event = conn.execute("SELECT MAX(id) FROM bus_events;").fetchone()[0]
+        seen_event = seen_event or 0
+        version = conn.execute("PRAGMA data_version;").fetchone()[0]
+
+        def run():
+            nonlocal seen, seen_event, version
+            while True:
+                time.sleep(self._interval)
+                try:
+                    current = conn.execute("PRAGMA data_version;").fetchone()[0]
+                    if current == version:
+                        continue
+                    version = current
+                    self.polls += 1
+                    rows = conn.execute(
+                        "SELECT r.name, MAX(m.id) FROM messages m "
+                        "JOIN room r ON r.id = m.room_id "
+                        "WHERE m.id > ? GROUP BY m.room_id;",
+                        (seen,),
+                    ).fetchall()
+                    events = conn.execute(
+                        "SELECT id, origin, channel, payload FROM bus_events "
+                        "WHERE id > ? ORDER BY id;",
+                        (seen_event,),
+                    ).fetchall()
+                except sqlite3.Error:
+                    continue
+
+                for room, message_id in rows:
+                    seen = max(seen, message_id)
+                    self._deliver(room, message_id)
+
+                for event_id, origin, channel, payload in events:
+                    seen_event = event_id
+                    if origin != self._origin:
+                        self._dispatch(channel, json.loads(payload))
+
+        self._poller = threading.Thread(target=run, name="bus-sqlite", daemon=True)
+        self._poller.start()
+
+    def stats(self):
+        return {**super().stats(), "polls": self.polls}
+
+
+_bus = None
+_bus_lock = threading.Lock()
+_listeners = []
+
+
+def _forget_bus():
+    """Listener threads do not survive a fork, so children build their own bus."""
+
+    global _bus, _bus_lock
+    _bus = None
+    _bus_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_bus)
+
+
+def create_bus(kind, database=None, redis=None, interval=0.2):
+    """Build a bus by name: "memory", "redis", "sqlite" or "auto" (redis when
+    a client is available, otherwise sqlite)."""
+
+    if kind == "auto":
+        kind = "redis" if redis is not None else "sqlite"
+
+    match kind:
+        case "memory":
+            return MemoryBus()
+        case "redis":
+            if redis is None:
+                raise ValueError("The redis message bus needs redislite installed.")
+            return RedisBus(redis)
+        case "sqlite":
+            return SQLiteBus(database, interval)
+        case _:
+            raise ValueError(f"Unknown message bus {kind!r}")
+
+
+def listen(channel, callback):
+    """Subscribe ``callback`` to a channel on this process's bus, including
+    any bus built later (after a fork, say). Meant for module level use."""
+
+    _listeners.append((channel, callback))
+
+
+def get_bus():
+    """Get this process's bus, as configured by MESSAGE_BUS in the Flask config."""
+
+    global _bus
+
+    with _bus_lock:
+        if _bus is None:
+            from limiter import redis
+
+            config = f.current_app.config
+            _bus = create_bus(
+                config.get("MESSAGE_BUS", "auto"),
+                database=config["DATABASE"],
+                redis=redis,
+                interval=config.get("BUS_POLL_INTERVAL", 0.2),
+            )
+            for channel, callback in _listeners:
+                _bus.subscribe(channel, callback)
+
+    return _bus
+
+
+def init_app(app):
+    """Make sure each worker has its bus, with every ``listen`` callback
+    subscribed, before it handles a request, whichever cache it loads first.
+    This is called by the application factory. The bus is started on the
+    first request rather than here, as workers forked from a preloaded app
+    would not inherit it anyway."""
+
+    @app.before_request
+    def start_bus():
+        get_bus()
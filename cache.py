@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe in-process cache. Entries expire ``ttl`` seconds after they
+    are stored, and once ``maxsize`` entries are held the least recently used
+    one is evicted.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0  # bumped by every invalidation
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING):
+        """Get a live entry, or ``default`` (MISSING unless given)."""
+
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def _store(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_load(self, key, load, ttl=None):
+        """Get an entry, calling ``load()`` to fill it on a miss. ``ttl`` may
+        be a function of the loaded value, to keep some values for less time.
+
+        If anything is invalidated while ``load()`` runs, the loaded value
+        is returned but not stored, as it may already be stale.
+        """
+
+        value = self.get(key)
+        if value is MISSING:
+            generation = self._generation
+            value = load()
+            if callable(ttl):
+                ttl = ttl(value)
+            with self._lock:
+                if generation == self._generation:
+                    self._store(key, value, ttl)
+        return value
+
+    def replace(self, key, old, new):
+        """Swap in a new value for an entry only if it still holds ``old``,
+        keeping its expiry time. Returns whether it did."""
+
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] is not old:
+                return False
+            self._data[key] = (entry[0], new)
+            return True
+
+    def pop(self, key):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
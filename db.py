@@ -1,10 +1,259 @@
+import functools
+import hashlib
+import os
+import random
 import sqlite3
-from datetime import datetime
+import threading
+import time
 from os.path import isfile
 
 import click
 import flask as f
 
+# Applied to every new connection, in this order. busy_timeout goes first so
+# that switching the journal mode waits for other workers instead of failing.
+# Override with DB_PRAGMAS in the instance config.
+DEFAULT_PRAGMAS = {
+    "busy_timeout": 5000,
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,  # in KiB when negative
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",
+}
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free in time."""
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of sqlite3 connections to one database file.
+    Connections are opened lazily up to ``size`` and handed to one thread at a
+    time; callers that find every connection in use wait up to ``timeout``
+    seconds for one to be released.
+    """
+
+    def __init__(self, database, size=8, timeout=30, pragmas=None):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        self._idle = []
+        self._open = 0
+        self._cond = threading.Condition()
+        self._checkpointer = None
+
+        self.checkouts = 0
+        self.hits = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.checkpoints = 0
+        self.truncations = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+        return conn
+
+    def acquire(self):
+        """Check a connection out of the pool, opening one if there is room."""
+
+        with self._cond:
+            self.checkouts += 1
+            if not self._idle and self._open >= self.size:
+                self.waits += 1
+                if not self._cond.wait_for(
+                    lambda: self._idle or self._open < self.size, self.timeout
+                ):
+                    self.timeouts += 1
+                    raise PoolTimeout(
+                        f"No database connection free after {self.timeout} seconds."
+                    )
+            if self._idle:
+                self.hits += 1
+                return self._idle.pop()
+            self._open += 1
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        """Return a connection to the pool, rolling back anything uncommitted."""
+
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self.discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def discard(self, conn):
+        """Close a connection instead of returning it to the pool."""
+
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def start_checkpointer(self, interval, truncate_bytes):
+        """Checkpoint the WAL every ``interval`` seconds on a daemon thread.
+
+        Readers never block a PASSIVE checkpoint, so the WAL is folded back
+        into the database off the request path. Once the WAL file grows past
+        ``truncate_bytes`` a TRUNCATE checkpoint is tried to shrink it again.
+        """
+
+        if self._checkpointer is not None or interval <= 0:
+            return
+
+        def run():
+            conn = sqlite3.connect(self.database, check_same_thread=False)
+            timeout = self.pragmas.get("busy_timeout", 0)
+            conn.execute(f"PRAGMA busy_timeout = {timeout};")
+            while True:
+                time.sleep(interval)
+                try:
+                    conn.execute("PRAGMA wal_checkpoint(PASSIVE);")
+                    self.checkpoints += 1
+                    wal = self.database + "-wal"
+                    if isfile(wal) and os.path.getsize(wal) > truncate_bytes:
+                        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                        self.truncations += 1
+                except sqlite3.Error:
+                    pass
+
+        self._checkpointer = threading.Thread(
+            target=run, name="wal-checkpointer", daemon=True
+        )
+        self._checkpointer.start()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pid": os.getpid(),
+                "size": self.size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "checkouts": self.checkouts,
+                "hits": self.hits,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "hit_rate": self.hits / self.checkouts if self.checkouts else 0.0,
+                "checkpoints": self.checkpoints,
+                "truncations": self.truncations,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _forget_pools():
+    """Drop the pools inherited from the parent after a fork.
+
+    SQLite connections must not be used across a fork, so the child starts
+    with no pools. The inherited connections are left alone rather than
+    closed, as closing them could disturb the parent's open files.
+    """
+
+    global _pools, _pools_lock
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_pools)
+
+
+def get_pool():
+    """Get the connection pool for the database defined in the Flask config."""
+
+    config = f.current_app.config
+    database = config["DATABASE"]
+
+    with _pools_lock:
+        pool = _pools.get(database)
+        if pool is None:
+            pool = _pools[database] = ConnectionPool(
+                database,
+                size=config.get("DB_POOL_SIZE", 8),
+                timeout=config.get("DB_POOL_TIMEOUT", 30),
+                pragmas=config.get("DB_PRAGMAS"),
+            )
+            if str(pool.pragmas.get("journal_mode", "")).upper() == "WAL":
+                pool.start_checkpointer(
+                    config.get("DB_CHECKPOINT_INTERVAL", 30),
+                    config.get("DB_WAL_TRUNCATE_BYTES", 64 * 1024 * 1024),
+                )
+
+    return pool
+
+
+def is_busy(error):
+    """Whether an exception is SQLite reporting a busy or locked database."""
+
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(error) or "busy" in str(error)
+
+
+def retry_on_busy(func):
+    """
+    Decorator that retries a write when another worker holds the database
+    lock for longer than busy_timeout. Waits grow exponentially (with jitter)
+    from DB_BUSY_BACKOFF seconds, for up to DB_BUSY_RETRIES retries.
+    The wrapped function must do its whole write, including the commit, in
+    its own DBConnection block, so that a retry starts from a clean slate.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = f.current_app.config.get("DB_BUSY_RETRIES", 5)
+        delay = f.current_app.config.get("DB_BUSY_BACKOFF", 0.05)
+
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if attempt == retries or not is_busy(e):
+                    raise
+                time.sleep(delay * 2**attempt * random.uniform(0.5, 1.5))
+
+    return wrapper
+
+
+def pool_stats():
+    """Statistics for every connection pool in this process."""
+
+    with _pools_lock:
+        pools = list(_pools.values())
+
+    return [pool.stats() for pool in pools]
+
 
 class DBConnection:
     """
@@ -13,33 +262,138 @@ class DBConnection:
     Usage:
         with DBConnection() as db:
             db.execute(...)
+
+    The connection comes from a per-process pool and is kept on ``flask.g``,
+    so every block in the same request or app context reuses it. Anything not
+    committed when the outermost block exits is rolled back.
     """
 
     def __init__(self):
         self.conn = None
-        self._created_here = False
 
     def __enter__(self):
-        self.conn = sqlite3.connect(
-            f.current_app.config["DATABASE"], detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        self.conn.row_factory = sqlite3.Row
+        self.conn = f.g.get("db")
+        if self.conn is None:
+            self.conn = f.g.db = get_pool().acquire()
+
+        f.g.db_depth = f.g.get("db_depth", 0) + 1
         return self.conn
 
     def __exit__(self, exc_type, exc, tb):
-        try:
-            self.conn.close()
-        except Exception:
-            pass
+        f.g.db_depth -= 1
+        if f.g.db_depth == 0:
+            try:
+                if self.conn.in_transaction:
+                    self.conn.rollback()
+            except sqlite3.Error:
+                pass
         return False
 
 
+# Milliseconds since the epoch, UTC
+NOW_MS = "CAST(ROUND((julianday('now') - 2440587.5) * 86400000) AS INTEGER)"
+
+# Kept in step with schema.sql, for migrations that rebuild the table
+MESSAGES_TABLE = (
+    "CREATE TABLE {name} ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    "author_id INTEGER NOT NULL,"
+    f"created INTEGER NOT NULL DEFAULT ({NOW_MS}),"
+    "content TEXT NOT NULL,"
+    "room_id INTEGER NOT NULL,"
+    "edited INTEGER NOT NULL DEFAULT 0,"
+    "deleted INTEGER NOT NULL DEFAULT 0,"
+    "FOREIGN KEY (author_id) REFERENCES user (id),"
+    "FOREIGN KEY (room_id) REFERENCES room (id) ON DELETE CASCADE"
+    ");"
+)
+
+# The table as version 12 left it
+MESSAGES_TABLE_V12 = (
+    "CREATE TABLE {name} ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    "author TEXT NOT NULL,"
+    f"created INTEGER NOT NULL DEFAULT ({NOW_MS}),"
+    "content TEXT NOT NULL,"
+    "room_id INTEGER NOT NULL,"
+    "edited INTEGER NOT NULL DEFAULT 0,"
+    "deleted INTEGER NOT NULL DEFAULT 0,"
+    "FOREIGN KEY (room_id) REFERENCES room (id) ON DELETE CASCADE"
+    ");"
+)
+
+# The table as version 7 left it
+MESSAGES_TABLE_V7 = (
+    "CREATE TABLE {name} ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    "author TEXT NOT NULL,"
+    f"created INTEGER NOT NULL DEFAULT ({NOW_MS}),"
+    "content TEXT NOT NULL,"
+    "room TEXT NOT NULL,"
+    "edited INTEGER NOT NULL DEFAULT 0,"
+    "deleted INTEGER NOT NULL DEFAULT 0,"
+    "FOREIGN KEY (room) REFERENCES rooms (roomname) ON DELETE CASCADE"
+    ");"
+)
+
+# Full-text index over message contents, kept in step by triggers
+FTS_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+    "USING fts5(content, content='messages', content_rowid='id');"
+)
+FTS_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages "
+    "BEGIN "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); "
+    "END;",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages "
+    "BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); "
+    "END;",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update "
+    "AFTER UPDATE OF content ON messages "
+    "BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); "
+    "END;",
+)
+
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS messages_room_id ON messages (room, id);",
+    "CREATE UNIQUE INDEX IF NOT EXISTS rooms_roomname_member ON rooms (roomname, member);",
+    "CREATE INDEX IF NOT EXISTS rooms_member_roomname ON rooms (member, roomname);",
+    "CREATE INDEX IF NOT EXISTS apitokens_username_tokenname ON apitokens (username, tokenname);",
+    "CREATE INDEX IF NOT EXISTS invitelinks_username_invite_name ON invitelinks (username, invite_name);",
+)
+
+
 def __close_db(e=None):
-    """If this request connected to the database, close the connection."""
+    """If this request used a database connection, return it to the pool."""
     db = f.g.pop("db", None)
+    f.g.pop("db_depth", None)
 
     if db is not None:
-        db.close()
+        get_pool().release(db)
+
+
+def release_db():
+    """Give this request's connection back to the pool early. Long running
+    views call this between queries so they do not hold a connection while
+    they wait."""
+    if not f.g.get("db_depth"):
+        __close_db()
+
+
+def free_bytes():
+    """How much of the database file is free pages, left over from deletes."""
+
+    with DBConnection() as conn:
+        pages = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+
+    return pages * page_size
 
 
 def init_db(reset):
@@ -58,11 +412,6 @@ def init_db(reset):
         )
 
 
-sqlite3.register_converter(
-    "timestamp", lambda v: datetime.fromisoformat(v.decode())
-)  # TODO set time zone
-
-
 def init_app(app):
     """Register database functions with the Flask app. This is called by
     the application factory.
@@ -70,6 +419,276 @@ def init_app(app):
     app.teardown_appcontext(__close_db)
 
 
+def _rebuild(conn, table, create, copy):
+    """Replace a table with a new one made by ``create`` (a CREATE TABLE
+    statement with a {name} field) and filled by ``copy`` (an INSERT into
+    ``<table>_new``), keeping its AUTOINCREMENT sequence. Indexes and
+    triggers go with the old table."""
+
+    seq = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = ?;", (table,)
+    ).fetchone()
+    conn.execute(create.format(name=f"{table}_new"))
+    conn.execute(copy)
+    conn.execute(f"DROP TABLE {table};")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table};")
+    if seq is not None:
+        # So that ids of rows deleted from the end are not used again
+        conn.execute(
+            "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?;",
+            (seq[0], table),
+        )
+
+
+def _rooms_by_id(conn):
+    """Version 12: rooms get a table of their own, and messages, memberships,
+    read markers and invites refer to rooms by integer id instead of name."""
+
+    conn.execute(
+        "CREATE TABLE room ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "name TEXT NOT NULL,"
+        "creator TEXT,"
+        f"created INTEGER NOT NULL DEFAULT ({NOW_MS}),"
+        "deleted INTEGER NOT NULL DEFAULT 0,"
+        "max_age_days INTEGER,"
+        "max_count INTEGER,"
+        "cleared_id INTEGER NOT NULL DEFAULT 0"
+        ");"
+    )
+    conn.execute("CREATE UNIQUE INDEX room_name ON room (name) WHERE deleted = 0;")
+    # Rooms with members, with the settings they had
+    conn.execute(
+        "INSERT INTO room "
+        "(name, creator, created, max_age_days, max_count, cleared_id) "
+        "SELECT r.roomname, "
+        # The first admin is the one that created the room
+        "(SELECT member FROM rooms WHERE roomname = r.roomname AND isadmin = 1 "
+        "ORDER BY rowid LIMIT 1), COALESCE("
+        f"(SELECT MIN(created) FROM messages WHERE room = r.roomname), {NOW_MS}), "
+        "s.max_age_days, s.max_count, COALESCE(s.cleared_id, 0) "
+        "FROM (SELECT DISTINCT roomname FROM rooms) r "
+        "LEFT JOIN room_settings s ON s.room = r.roomname;"
+    )
+    # Deleted rooms whose messages are still waiting to be deleted
+    conn.execute(
+        "INSERT INTO room (name, deleted) SELECT DISTINCT room, 1 FROM messages "
+        "WHERE room NOT IN (SELECT name FROM room);"
+    )
+
+    conn.execute(
+        "CREATE TABLE room_members ("
+        "room_id INTEGER NOT NULL,"
+        "member TEXT NOT NULL,"
+        "isadmin INTEGER NOT NULL DEFAULT 0,"
+        "PRIMARY KEY (room_id, member),"
+        "FOREIGN KEY (room_id) REFERENCES room (id) ON DELETE CASCADE,"
+        "FOREIGN KEY (member) REFERENCES user (username)"
+        ") WITHOUT ROWID;"
+    )
+    conn.execute(
+        "INSERT INTO room_members (room_id, member, isadmin) "
+        "SELECT r.id, m.member, m.isadmin FROM rooms m "
+        "JOIN room r ON r.name = m.roomname AND r.deleted = 0;"
+    )
+    conn.execute("CREATE INDEX room_members_member ON room_members (member, room_id);")
+
+    _rebuild(
+        conn,
+        "messages",
+        MESSAGES_TABLE_V12,
+        "INSERT INTO messages_new "
+        "(id, author, created, content, room_id, edited, deleted) "
+        "SELECT m.id, m.author, m.created, m.content, r.id, m.edited, m.deleted "
+        "FROM messages m JOIN room r ON r.name = m.room;",
+    )
+    conn.execute("CREATE INDEX messages_room_id ON messages (room_id, id);")
+    # The search index is still right, but its triggers went with the table
+    for trigger in FTS_TRIGGERS:
+        conn.execute(trigger)
+
+    conn.execute(
+        "CREATE TABLE read_markers_new ("
+        "user TEXT NOT NULL,"
+        "room_id INTEGER NOT NULL,"
+        "last_read_id INTEGER NOT NULL DEFAULT 0,"
+        "PRIMARY KEY (room_id, user)"
+        ") WITHOUT ROWID;"
+    )
+    conn.execute(
+        "INSERT INTO read_markers_new (user, room_id, last_read_id) "
+        "SELECT k.user, r.id, k.last_read_id FROM read_markers k "
+        "JOIN room r ON r.name = k.room AND r.deleted = 0;"
+    )
+    conn.execute("DROP TABLE read_markers;")
+    conn.execute("ALTER TABLE read_markers_new RENAME TO read_markers;")
+
+    # Invites to rooms that are gone were no use anyway
+    conn.execute(
+        "CREATE TABLE invitelinks_new ("
+        "token TEXT PRIMARY KEY,"
+        "username TEXT NOT NULL,"
+        "invite_name TEXT NOT NULL,"
+        "room_id INTEGER NOT NULL,"
+        "created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+        "FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE,"
+        "FOREIGN KEY (room_id) REFERENCES room (id) ON DELETE CASCADE"
+        ");"
+    )
+    conn.execute(
+        "INSERT INTO invitelinks_new (token, username, invite_name, room_id, created) "
+        "SELECT i.token, i.username, i.invite_name, r.id, i.created "
+        "FROM invitelinks i JOIN room r ON r.name = i.room AND r.deleted = 0;"
+    )
+    conn.execute("DROP TABLE invitelinks;")
+    conn.execute("ALTER TABLE invitelinks_new RENAME TO invitelinks;")
+    conn.execute(
+        "CREATE INDEX invitelinks_username_invite_name "
+        "ON invitelinks (username, invite_name);"
+    )
+    conn.execute("CREATE INDEX invitelinks_room_id ON invitelinks (room_id);")
+
+    conn.execute("DROP TABLE rooms;")
+    conn.execute("DROP TABLE room_settings;")
+
+
+def _users_by_id(conn):
+    """Version 13: users get an integer id, which messages, rooms,
+    memberships, read markers, API tokens and invites refer to instead of
+    the username. Foreign keys are enforced from this version on. Returns
+    how many messages were dropped because their author no longer exists."""
+
+    _rebuild(
+        conn,
+        "user",
+        "CREATE TABLE {name} ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "username TEXT UNIQUE NOT NULL,"
+        "password TEXT NOT NULL,"
+        "credential_epoch INTEGER NOT NULL DEFAULT 0"
+        ");",
+        "INSERT INTO user_new (id, username, password, credential_epoch) "
+        "SELECT rowid, username, password, credential_epoch FROM user;",
+    )
+
+    # Messages by users that no longer exist were never shown. Deleting them
+    # first keeps the search index in step.
+    dropped = conn.execute(
+        "DELETE FROM messages WHERE author NOT IN (SELECT username FROM user);"
+    ).rowcount
+    _rebuild(
+        conn,
+        "messages",
+        MESSAGES_TABLE,
+        "INSERT INTO messages_new "
+        "(id, author_id, created, content, room_id, edited, deleted) "
+        "SELECT m.id, u.id, m.created, m.content, m.room_id, m.edited, m.deleted "
+        "FROM messages m JOIN user u ON u.username = m.author;",
+    )
+    conn.execute("CREATE INDEX messages_room_id ON messages (room_id, id);")
+    for trigger in FTS_TRIGGERS:
+        conn.execute(trigger)
+
+    _rebuild(
+        conn,
+        "room",
+        "CREATE TABLE {name} ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "name TEXT NOT NULL,"
+        "creator_id INTEGER,"
+        f"created INTEGER NOT NULL DEFAULT ({NOW_MS}),"
+        "deleted INTEGER NOT NULL DEFAULT 0,"
+        "max_age_days INTEGER,"
+        "max_count INTEGER,"
+        "cleared_id INTEGER NOT NULL DEFAULT 0,"
+        "FOREIGN KEY (creator_id) REFERENCES user (id)"
+        ");",
+        "INSERT INTO room_new (id, name, creator_id, created, deleted, "
+        "max_age_days, max_count, cleared_id) "
+        "SELECT r.id, r.name, u.id, r.created, r.deleted, "
+        "r.max_age_days, r.max_count, r.cleared_id "
+        "FROM room r LEFT JOIN user u ON u.username = r.creator;",
+    )
+    conn.execute("CREATE UNIQUE INDEX room_name ON room (name) WHERE deleted = 0;")
+
+    _rebuild(
+        conn,
+        "room_members",
+        "CREATE TABLE {name} ("
+        "room_id INTEGER NOT NULL,"
+        "user_id INTEGER NOT NULL,"
+        "isadmin INTEGER NOT NULL DEFAULT 0,"
+        "PRIMARY KEY (room_id, user_id),"
+        "FOREIGN KEY (room_id) REFERENCES room (id) ON DELETE CASCADE,"
+        "FOREIGN KEY (user_id) REFERENCES user (id) ON DELETE CASCADE"
+        ") WITHOUT ROWID;",
+        "INSERT INTO room_members_new (room_id, user_id, isadmin) "
+        "SELECT m.room_id, u.id, m.isadmin FROM room_members m "
+        "JOIN user u ON u.username = m.member;",
+    )
+    conn.execute(
+        "CREATE INDEX room_members_user_id ON room_members (user_id, room_id);"
+    )
+
+    _rebuild(
+        conn,
+        "read_markers",
+        "CREATE TABLE {name} ("
+        "user_id INTEGER NOT NULL,"
+        "room_id INTEGER NOT NULL,"
+        "last_read_id INTEGER NOT NULL DEFAULT 0,"
+        "PRIMARY KEY (room_id, user_id),"
+        "FOREIGN KEY (room_id) REFERENCES room (id) ON DELETE CASCADE,"
+        "FOREIGN KEY (user_id) REFERENCES user (id) ON DELETE CASCADE"
+        ") WITHOUT ROWID;",
+        "INSERT INTO read_markers_new (user_id, room_id, last_read_id) "
+        "SELECT u.id, k.room_id, k.last_read_id FROM read_markers k "
+        "JOIN user u ON u.username = k.user;",
+    )
+    conn.execute("CREATE INDEX read_markers_user_id ON read_markers (user_id);")
+
+    _rebuild(
+        conn,
+        "apitokens",
+        "CREATE TABLE {name} ("
+        "token TEXT PRIMARY KEY,"
+        "user_id INTEGER NOT NULL,"
+        "tokenname TEXT NOT NULL,"
+        "created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+        "FOREIGN KEY (user_id) REFERENCES user (id) ON DELETE CASCADE"
+        ");",
+        "INSERT INTO apitokens_new (token, user_id, tokenname, created) "
+        "SELECT t.token, u.id, t.tokenname, t.created FROM apitokens t "
+        "JOIN user u ON u.username = t.username;",
+    )
+    conn.execute(
+        "CREATE INDEX apitokens_user_id_tokenname ON apitokens (user_id, tokenname);"
+    )
+
+    _rebuild(
+        conn,
+        "invitelinks",
+        "CREATE TABLE {name} ("
+        "token TEXT PRIMARY KEY,"
+        "user_id INTEGER NOT NULL,"
+        "invite_name TEXT NOT NULL,"
+        "room_id INTEGER NOT NULL,"
+        "created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+        "FOREIGN KEY (user_id) REFERENCES user (id) ON DELETE CASCADE,"
+        "FOREIGN KEY (room_id) REFERENCES room (id) ON DELETE CASCADE"
+        ");",
+        "INSERT INTO invitelinks_new (token, user_id, invite_name, room_id, created) "
+        "SELECT i.token, u.id, i.invite_name, i.room_id, i.created "
+        "FROM invitelinks i JOIN user u ON u.username = i.username;",
+    )
+    conn.execute(
+        "CREATE INDEX invitelinks_user_id_invite_name "
+        "ON invitelinks (user_id, invite_name);"
+    )
+    conn.execute("CREATE INDEX invitelinks_room_id ON invitelinks (room_id);")
+    return dropped
+
+
 def update_db(version):
     with DBConnection() as conn:
         num = conn.execute("SELECT * FROM schema_version").fetchone()[0]
@@ -78,31 +697,163 @@ def update_db(version):
     elif num < version:
         click.echo("Updating database... ", nl=False)
         with DBConnection() as conn:
-            if num == 1:
+            # Tables that others refer to are rebuilt on the way, so foreign
+            # keys are checked once at the end instead, and the whole update
+            # goes in one transaction.
+            foreign_keys = conn.execute("PRAGMA foreign_keys;").fetchone()[0]
+            conn.execute("PRAGMA foreign_keys = OFF;")
+            dropped = 0
+            try:
+                conn.execute("BEGIN;")
+                if num == 1 and version > 1:
+                    conn.execute(
+                        "CREATE TABLE invitelinks ("
+                        "token TEXT PRIMARY KEY,"
+                        "username TEXT NOT NULL,"
+                        "invite_name TEXT NOT NULL,"
+                        "room TEXT NOT NULL,"
+                        "created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+                        "FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE"
+                        ");"
+                    )
+                    num = 2
+                if num == 2 and version > 2:
+                    conn.execute(
+                        'DELETE FROM messages WHERE room = "lobby";'
+                    )  # Version 2 still had traces
+                    conn.execute(
+                        'DELETE FROM rooms WHERE roomname = "lobby";'
+                    )  # of the original mono-room
+                    num = 3
+                if num == 3 and version > 3:
+                    # Duplicate memberships would block the unique index, so
+                    # merge them first, keeping admin status if any row had it.
+                    conn.execute(
+                        "UPDATE rooms SET isadmin = 1 WHERE isadmin = 0 AND EXISTS ("
+                        "SELECT 1 FROM rooms r WHERE r.roomname = rooms.roomname "
+                        "AND r.member = rooms.member AND r.isadmin = 1);"
+                    )
+                    conn.execute(
+                        "DELETE FROM rooms WHERE rowid NOT IN ("
+                        "SELECT MIN(rowid) FROM rooms GROUP BY roomname, member);"
+                    )
+                    for index in INDEXES:
+                        conn.execute(index)
+                    num = 4
+                if num == 4 and version > 4:
+                    # API tokens are stored hashed from now on (see auth.hash_token)
+                    tokens = conn.execute("SELECT token FROM apitokens;").fetchall()
+                    conn.executemany(
+                        "UPDATE apitokens SET token = ? WHERE token = ?;",
+                        [
+                            (hashlib.sha256(t[0].encode()).hexdigest(), t[0])
+                            for t in tokens
+                        ],
+                    )
+                    num = 5
+                if num == 5 and version > 5:
+                    conn.execute(
+                        "CREATE TABLE read_markers ("
+                        "user TEXT NOT NULL,"
+                        "room TEXT NOT NULL,"
+                        "last_read_id INTEGER NOT NULL DEFAULT 0,"
+                        "PRIMARY KEY (room, user)"
+                        ") WITHOUT ROWID;"
+                    )
+                    num = 6
+                if num == 6 and version > 6:
+                    # Message times become integer milliseconds since the epoch
+                    # (UTC), which means rebuilding the table.
+                    _rebuild(
+                        conn,
+                        "messages",
+                        MESSAGES_TABLE_V7,
+                        "INSERT INTO messages_new "
+                        "(id, author, created, content, room, edited, deleted) "
+                        "SELECT id, author, CAST(ROUND("
+                        "(julianday(created) - 2440587.5) * 86400000) AS INTEGER), "
+                        "content, room, edited, deleted FROM messages;",
+                    )
+                    conn.execute(INDEXES[0])
+                    num = 7
+                if num == 7 and version > 7:
+                    conn.execute(FTS_TABLE)
+                    for trigger in FTS_TRIGGERS:
+                        conn.execute(trigger)
+                    # Index the messages that are already there
+                    conn.execute(
+                        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');"
+                    )
+                    num = 8
+                if num == 8 and version > 8:
+                    conn.execute(
+                        "CREATE TABLE room_settings ("
+                        "room TEXT PRIMARY KEY,"
+                        "max_age_days INTEGER,"
+                        "max_count INTEGER"
+                        ") WITHOUT ROWID;"
+                    )
+                    num = 9
+                if num == 9 and version > 9:
+                    # Messages at or below cleared_id are hidden until they are
+                    # deleted in the background
+                    conn.execute(
+                        "ALTER TABLE room_settings "
+                        "ADD COLUMN cleared_id INTEGER NOT NULL DEFAULT 0;"
+                    )
+                    num = 10
+                if num == 10 and version > 10:
+                    # Bumped by every password change, to end older sessions
+                    conn.execute(
+                        "ALTER TABLE user "
+                        "ADD COLUMN credential_epoch INTEGER NOT NULL DEFAULT 0;"
+                    )
+                    num = 11
+                if num == 11 and version > 11:
+                    _rooms_by_id(conn)
+                    num = 12
+                if num == 12 and version > 12:
+                    dropped = _users_by_id(conn)
+                    num = 13
+                if num == 13 and version > 13:
+                    # Shared by every worker, unlike the per-worker versions before
+                    conn.execute(
+                        "ALTER TABLE room ADD COLUMN version INTEGER NOT NULL DEFAULT 0;"
+                    )
+                    num = 14
+                if num == 14 and version > 14:
+                    # The sqlite message bus made this table itself before,
+                    # so it may be there already
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS bus_events ("
+                        "id INTEGER PRIMARY KEY,"
+                        "origin TEXT NOT NULL,"
+                        "channel TEXT NOT NULL,"
+                        "payload TEXT NOT NULL,"
+                        "created REAL NOT NULL"
+                        ");"
+                    )
+                    num = 15
+                violation = conn.execute("PRAGMA foreign_key_check;").fetchone()
+                if violation is not None:
+                    raise sqlite3.IntegrityError(
+                        f"Table {violation[0]} has rows that refer to missing rows "
+                        f"in {violation[2]}."
+                    )
                 conn.execute(
-                    "CREATE TABLE invitelinks ("
-                    "token TEXT PRIMARY KEY,"
-                    "username TEXT NOT NULL,"
-                    "invite_name TEXT NOT NULL,"
-                    "room TEXT NOT NULL,"
-                    "created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,"
-                    "FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE"
-                    ");"
+                    "INSERT OR REPLACE INTO schema_version (num, enforcer) VALUES (?, 0);",
+                    (version,),
                 )
-                num = 2
-            if num == 2:
-                conn.execute(
-                    'DELETE FROM messages WHERE room = "lobby";'
-                )  # Version 2 still had traces
-                conn.execute(
-                    'DELETE FROM rooms WHERE roomname = "lobby";'
-                )  # of the original mono-room
-            conn.execute(
-                "INSERT OR REPLACE INTO schema_version (num, enforcer) VALUES (?, 0);",
-                (version,),
-            )
-            conn.commit()
+                conn.commit()
+            finally:
+                # A failed update is rolled back first, as the pragma does
+                # nothing inside a transaction
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.execute(f"PRAGMA foreign_keys = {foreign_keys};")
         click.echo("Done!")
+        if dropped:
+            click.echo(f"Dropped {dropped} messages by users that no longer exist.")
     else:
         click.echo(
             f"Error updating! Expected version number to be <= {version} Got: {num}"
@@ -2,6 +2,8 @@ import flask as f
 from werkzeug.exceptions import abort
 
 import backend as cb
+import responses
+import stream as st
 from auth import login_required
 
 STATUS_USER = "Message Jar"
@@ -19,7 +21,10 @@ def page_not_found(_):
 def index():
     if f.request.method == "GET":
         return f.render_template(
-            "jars/main.html", room_list=cb.get_rooms(f.g.user["username"])
+            "jars/main.html",
+            room_list=cb.get_rooms(f.g.user["username"]),
+            unread=cb.unread_counts(f.g.user["username"]),
+            **search_results(f.g.user["username"]),
         )
 
     error = None
@@ -40,10 +45,32 @@ def index():
 
     f.flash(error)
     return f.render_template(
-        "jars/main.html", room_list=cb.get_rooms(f.g.user["username"])
+        "jars/main.html",
+        room_list=cb.get_rooms(f.g.user["username"]),
+        unread=cb.unread_counts(f.g.user["username"]),
+        **search_results(f.g.user["username"]),
     )
 
 
+def search_results(username):
+    """Run the search asked for in the query string (``q``, and optionally
+    ``room`` and ``offset``), for the template."""
+
+    query = f.request.args.get("q", "").strip()
+    room_name = f.request.args.get("room") or None
+
+    try:
+        offset = max(0, int(f.request.args.get("offset", 0)))
+    except ValueError:
+        offset = 0
+
+    results = None
+    if query:
+        results = cb.search(username, query, room_name, offset=offset)
+
+    return {"query": query, "search_room": room_name, "results": results}
+
+
 @jar.route("/<room_name>")
 @login_required
 def room(room_name):
@@ -62,15 +89,71 @@ def endpoint(room_name):
         f.g.user["username"]
     ):
         if f.request.method == "GET":
+            try:
+                cursor = cb.page_args(f.request.args)
+            except ValueError:
+                return f.jsonify({"e": "Cursor arguments must be integers!"}), 400
+
+            try:
+                fmt = responses.message_format(f.request)
+            except responses.NotAcceptable as e:
+                return f.jsonify({"e": e.message}), 406
+
             try:
                 latest = int(f.request.args.get("latest", 0))
             except (ValueError, TypeError):
                 latest = 0
 
-            return f.jsonify(cb.get_messages(room_name, latest))
+            tag = responses.etag(room_name, fmt, cursor, latest)
+            unchanged = responses.not_modified(tag)
+            if unchanged is not None:
+                return unchanged
+
+            if fmt is not None:
+                cursor = cursor or dict(after_id=latest, before_id=None, limit=None)
+                page = cb.get_column_page(room_name, **cursor)
+                response = responses.columns_response(page, fmt)
+            elif cursor is not None:
+                response = f.jsonify(cb.get_page(room_name, **cursor))
+            else:
+                response = f.jsonify(cb.get_messages(room_name, latest))
+            return responses.finish(response, tag)
 
         content = f.request.form["message"]
         cb.add_message(str(f.g.user["username"]), content, room_name)
         return f.jsonify({"status": "ok"})
 
     f.abort(404)
+
+
+@jar.route("/read/<room_name>", methods=["POST"])
+@login_required
+def read(room_name):
+    username = f.g.user["username"]
+
+    if room_name not in cb.get_rooms(username):
+        f.abort(404)
+
+    try:
+        message_id = int(f.request.form["message_id"])
+    except (KeyError, ValueError):
+        return f.jsonify({"e": "message_id must be an integer!"}), 400
+
+    cb.mark_read(username, room_name, message_id)
+    return f.jsonify({"status": "ok"})
+
+
+@jar.route("/stream/<room_name>")
+@login_required
+def stream(room_name):
+    username = f.g.user["username"]
+
+    if room_name not in cb.get_rooms(username):
+        f.abort(404)
+
+    try:
+        after_id = st.start_cursor(f.request, f.request.args.get("after_id"))
+    except ValueError:
+        return f.jsonify({"e": "Cursor arguments must be integers!"}), 400
+
+    return st.stream_response(room_name, username, after_id)
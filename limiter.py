@@ -1,5 +1,15 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from math import floor
+
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits.storage import SlidingWindowCounterSupport, Storage
+from limits.storage.base import TimestampedSlidingWindow
 
 # From the docs:
 # https://flask-limiter.readthedocs.io/en/stable/configuration.html#rate-limit-string-notation
@@ -9,18 +19,186 @@ from flask_limiter.util import get_remote_address
 # [count] [per|/] [n (optional)] [second|minute|hour|day|month|year][s]
 # You can combine multiple rate limits by separating them with a delimiter of your choice.
 
-limiter = None
+
+class SQLiteStorage(Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow):
+    """
+    Rate limit counters in an SQLite database, shared by every worker process
+    on the host. Use it with ``RATELIMIT_STORAGE_URI = "sqlite:///path"``.
+
+    Each check is one short write transaction on a small table of its own,
+    in a file of its own, so the limiter never waits on the message database.
+    """
+
+    STORAGE_SCHEME = ["sqlite"]
+
+    # How often each worker deletes expired counters, in seconds
+    CLEANUP_INTERVAL = 60
+
+    def __init__(self, uri, wrap_exceptions=False, **options):
+        self.path = urllib.parse.urlparse(uri).path
+        self._local = threading.local()
+        self._cleaned = time.time()
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connect(self):
+        """This thread's connection, opened again in forked workers."""
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout = 5000;")
+            conn.execute("PRAGMA journal_mode = WAL;")
+            # Losing the last few hits in a power cut does not matter
+            conn.execute("PRAGMA synchronous = OFF;")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                "key TEXT PRIMARY KEY,"
+                "count INTEGER NOT NULL,"
+                "expires REAL NOT NULL"
+                ") WITHOUT ROWID;"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK;")
+            raise
+        conn.execute("COMMIT;")
+
+    def _incr(self, conn, key, expiry, amount, now):
+        # An expired counter starts again from nothing
+        return conn.execute(
+            """
+        INSERT INTO counters (key, count, expires) VALUES (?, ?, ?)
+        ON CONFLICT (key) DO UPDATE SET
+            count = CASE WHEN expires <= ? THEN excluded.count
+                ELSE count + excluded.count END,
+            expires = CASE WHEN expires <= ? THEN excluded.expires
+                ELSE expires END
+        RETURNING count;""",
+            (key, amount, now + expiry, now, now),
+        ).fetchone()[0]
+
+    def _get(self, conn, key, now):
+        r = conn.execute(
+            "SELECT count FROM counters WHERE key = ? AND expires > ?;", (key, now)
+        ).fetchone()
+        return 0 if r is None else r[0]
+
+    def _cleanup(self, conn, now):
+        if now - self._cleaned < self.CLEANUP_INTERVAL:
+            return
+        self._cleaned = now
+        conn.execute("DELETE FROM counters WHERE expires <= ?;", (now,))
+
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        with self._transaction() as conn:
+            self._cleanup(conn, now)
+            return self._incr(conn, key, expiry, amount, now)
+
+    def get(self, key):
+        return self._get(self._connect(), key, time.time())
+
+    def get_expiry(self, key):
+        now = time.time()
+        r = (
+            self._connect()
+            .execute(
+                "SELECT expires FROM counters WHERE key = ? AND expires > ?;",
+                (key, now),
+            )
+            .fetchone()
+        )
+        return now if r is None else r[0]
+
+    def check(self):
+        try:
+            self._connect().execute("SELECT 1;")
+        except sqlite3.Error:
+            return False
+        return True
+
+    def reset(self):
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM counters;").rowcount
+
+    def clear(self, key):
+        self._connect().execute("DELETE FROM counters WHERE key = ?;", (key,))
+
+    def _sliding_window(self, conn, key, expiry, now):
+        """The same weighting as the limits library's memory storage."""
+
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        previous = self._get(conn, previous_key, now)
+        current = self._get(conn, current_key, now)
+
+        previous_ttl = 0.0
+        if previous:
+            previous_ttl = (1 - (((now - expiry) / expiry) % 1)) * expiry
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous, previous_ttl, current, current_ttl
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+
+        now = time.time()
+        # Checking and counting in one transaction, so two workers cannot
+        # both take the last slot
+        with self._transaction() as conn:
+            self._cleanup(conn, now)
+            previous, previous_ttl, current, _ = self._sliding_window(
+                conn, key, expiry, now
+            )
+            if floor(previous * previous_ttl / expiry + current) + amount > limit:
+                return False
+
+            _, current_key = self.sliding_window_keys(key, expiry, now)
+            self._incr(conn, current_key, 2 * expiry, amount, now)
+            return True
+
+    def get_sliding_window(self, key, expiry):
+        return self._sliding_window(self._connect(), key, expiry, time.time())
+
+    def clear_sliding_window(self, key, expiry):
+        previous_key, current_key = self.sliding_window_keys(key, expiry, time.time())
+        self.clear(previous_key)
+        self.clear(current_key)
+
+
+redis = None  # shared with the message bus when redislite is installed
 try:
     from redislite import StrictRedis  # type: ignore
 except ImportError:
-    limiter = Limiter(
-        get_remote_address,
-        storage_uri=f"memory://",
-    )
+    # A file in the app's instance folder, see init_limiter
+    DEFAULT_STORAGE_URI = None
 else:
     redis = StrictRedis("/dev/shm/cache.rdb")
-    limiter = Limiter(
-        get_remote_address,
-        storage_uri=f"redis+unix://{redis.socket_file}",
-    )
+    DEFAULT_STORAGE_URI = f"redis+unix://{redis.socket_file}"
 
+limiter = Limiter(get_remote_address)
+
+
+def init_limiter(app):
+    """Set up the limiter for an app. ``RATELIMIT_STORAGE_URI`` and
+    ``RATELIMIT_STRATEGY`` in the config override the defaults."""
+
+    # Shared by the workers of this app, unlike memory://
+    storage_uri = DEFAULT_STORAGE_URI or "sqlite://" + os.path.join(
+        app.instance_path, "ratelimit.sqlite"
+    )
+    app.config.setdefault("RATELIMIT_STORAGE_URI", storage_uri)
+    app.config.setdefault("RATELIMIT_STRATEGY", "sliding-window-counter")
+    limiter.init_app(app)
@@ -0,0 +1,201 @@
+"""
+Password hashing, away from the request workers.
+
+Hashing and checking passwords is deliberately slow, so it is done in a small
+pool of processes, with at most ``PASSWORD_MAX_PENDING`` jobs handed to it at
+once. Successful checks are remembered for ``PASSWORD_CACHE_TTL`` seconds, so
+a script calling the API with the same password over and over pays for the
+KDF once.
+
+Config:
+    PASSWORD_METHOD: werkzeug hash method for new hashes ("scrypt" by
+        default, e.g. "pbkdf2:sha256:600000"). Older hashes are replaced the
+        next time their user logs in.
+    PASSWORD_WORKERS: processes in the pool (2). 0 hashes in the worker
+        itself.
+    PASSWORD_MAX_PENDING: jobs allowed in the pool at once (4 per process).
+    PASSWORD_QUEUE_TIMEOUT: seconds to wait for room in the pool (10)
+        before giving up with Busy.
+    PASSWORD_CACHE_TTL: seconds a successful check is remembered (60).
+"""
+
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import flask as f
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS,
+    check_password_hash,
+    generate_password_hash,
+)
+
+from cache import TTLCache
+
+_pool = None
+_pool_pid = None
+_slots = None
+_pool_lock = threading.Lock()
+
+# HMAC of (username, password, stored hash) -> True. The key never leaves
+# this process, so the cache holds nothing that could be checked offline.
+_verified_key = secrets.token_bytes(32)
+_verified = TTLCache(4096)
+
+_stats_lock = threading.Lock()
+_stats = {"jobs": 0, "busy": 0, "queue_time": 0.0, "max_queue": 0.0, "run_time": 0.0}
+
+
+class Busy(Exception):
+    """Raised when the hashing pool stayed full for too long."""
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+# Run in the pool. Each returns its result and the time it started, which
+# tells queueing apart from hashing.
+
+
+def _check(pwhash, password):
+    started = time.time()
+    return check_password_hash(pwhash, password), started
+
+
+def _hash(password, method):
+    started = time.time()
+    return generate_password_hash(password, method), started
+
+
+def _executor():
+    """The pool and its slots, started on first use in each process."""
+
+    global _pool, _pool_pid, _slots
+
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            config = f.current_app.config
+            workers = config.get("PASSWORD_WORKERS", 2)
+            # Spawned, not forked: the worker has threads of its own
+            _pool = None
+            if workers:
+                _pool = ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            _slots = threading.BoundedSemaphore(
+                config.get("PASSWORD_MAX_PENDING", 4 * max(workers, 1))
+            )
+            _pool_pid = os.getpid()
+
+        return _pool, _slots
+
+
+def _reset_pool():
+    """Start a new pool next time, after a pool process died."""
+
+    global _pool_pid
+
+    with _pool_lock:
+        _pool_pid = None
+
+
+def _run(func, *args):
+    pool, slots = _executor()
+    submitted = time.time()
+
+    timeout = f.current_app.config.get("PASSWORD_QUEUE_TIMEOUT", 10)
+    if not slots.acquire(timeout=timeout):
+        with _stats_lock:
+            _stats["busy"] += 1
+        raise Busy("Too many logins at once, please try again shortly.")
+
+    try:
+        if pool:
+            try:
+                result, started = pool.submit(func, *args).result()
+            except BrokenProcessPool:
+                _reset_pool()
+                raise
+        else:
+            result, started = func(*args)
+    finally:
+        slots.release()
+
+    done = time.time()
+    with _stats_lock:
+        _stats["jobs"] += 1
+        _stats["queue_time"] += started - submitted
+        _stats["max_queue"] = max(_stats["max_queue"], started - submitted)
+        _stats["run_time"] += done - started
+
+    return result
+
+
+def method():
+    """The configured hash method, in full, as it appears in new hashes."""
+
+    name, *params = f.current_app.config.get("PASSWORD_METHOD", "scrypt").split(":")
+    defaults = {
+        "scrypt": ["32768", "8", "1"],
+        "pbkdf2": ["sha256", str(DEFAULT_PBKDF2_ITERATIONS)],
+    }.get(name, [])
+
+    return ":".join([name, *params, *defaults[len(params) :]])
+
+
+def hash_password(password):
+    """Hash a password with the configured method."""
+
+    return _run(_hash, password, method())
+
+
+def check_password(username, password, pwhash):
+    """Check a password against a user's stored hash."""
+
+    key = hmac.new(
+        _verified_key,
+        "\0".join((username, password, pwhash)).encode(),
+        hashlib.sha256,
+    ).digest()
+
+    if _verified.get(key, False):
+        return True
+
+    if not _run(_check, pwhash, password):
+        return False
+
+    _verified.set(key, True, f.current_app.config.get("PASSWORD_CACHE_TTL", 60))
+    return True
+
+
+def needs_rehash(pwhash):
+    """Whether a stored hash was made with other settings than the current
+    ones."""
+
+    return pwhash.split("$", 1)[0] != method()
+
+
+def _ms(seconds):
+    return round(1000 * seconds, 2)
+
+
+def stats():
+    with _stats_lock:
+        jobs = _stats["jobs"]
+        result = {
+            "jobs": jobs,
+            "busy": _stats["busy"],
+            "queue_ms_avg": _ms(_stats["queue_time"] / jobs) if jobs else 0,
+            "queue_ms_max": _ms(_stats["max_queue"]),
+            "run_ms_avg": _ms(_stats["run_time"] / jobs) if jobs else 0,
+        }
+
+    result["verified_cache"] = _verified.stats()
+    return result
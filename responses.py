@@ -0,0 +1,129 @@
+"""
+Response formats, caching and compression for message lists.
+
+Messages are sent as JSON objects by default. Clients can ask for a columnar
+page instead, with ``format=columns`` (as JSON) or an ``Accept:
+application/msgpack`` header (as MessagePack, if msgpack is installed).
+
+Message responses carry an ETag built from the state of the room, so polls
+that would get the same answer are told ``304 Not Modified`` without any
+messages being read, and large responses are compressed.
+"""
+
+import gzip
+import hashlib
+import json
+
+import flask as f
+
+import backend as cb
+
+try:
+    import msgpack  # type: ignore
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+MSGPACK = "application/msgpack"
+
+
+class NotAcceptable(Exception):
+    """The client only accepts a format that cannot be produced here."""
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def message_format(request, requested=None):
+    """Work out which format a request wants: "msgpack", "columns" or None
+    for the usual list of objects. ``requested`` is a ``format`` argument
+    from the request body, which wins over the query string.
+
+    Raises NotAcceptable when MessagePack is the only acceptable format but
+    msgpack is not installed.
+    """
+
+    requested = requested or request.args.get("format")
+    if requested == "msgpack":
+        if msgpack is None:
+            raise NotAcceptable("MessagePack responses are not available.")
+        return "msgpack"
+    if requested == "columns":
+        return "columns"
+
+    accept = request.accept_mimetypes
+    if accept.best == MSGPACK:
+        if msgpack is not None:
+            return "msgpack"
+        if not accept.quality("application/json"):
+            raise NotAcceptable("MessagePack responses are not available.")
+
+    return None
+
+
+def columns_response(page, fmt):
+    """Send a page from backend.get_column_page in the given format."""
+
+    if fmt == "msgpack":
+        return f.Response(msgpack.packb(page), mimetype=MSGPACK)
+    return f.jsonify(page)
+
+
+def encoding(request):
+    """The content coding to compress responses with, or None."""
+
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered)
+
+
+def etag(room, *args):
+    """A strong ETag for a response about ``room``. ``args`` are whatever
+    else the response depends on, such as the cursor and format."""
+
+    latest, version = cb.room_state(room)
+    key = json.dumps([room, latest, version, encoding(f.request), args])
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def not_modified(tag):
+    """A 304 response if the client already has the response tagged ``tag``,
+    otherwise None."""
+
+    if not f.request.if_none_match.contains(tag):
+        return None
+
+    response = f.Response(status=304)
+    response.set_etag(tag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def finish(response, tag):
+    """Tag a message response and compress it if it is big enough."""
+
+    response.set_etag(tag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Accept-Encoding")
+
+    coding = encoding(f.request)
+    minimum = f.current_app.config.get("COMPRESS_MIN_SIZE", 1024)
+    if coding is None or response.status_code != 200:
+        return response
+
+    data = response.get_data()
+    if len(data) < minimum:
+        return response
+
+    if coding == "br":
+        data = brotli.compress(data, quality=4)
+    else:
+        data = gzip.compress(data, compresslevel=6)
+
+    response.set_data(data)
+    response.headers["Content-Encoding"] = coding
+    return response
@@ -1,56 +1,129 @@
 -- Initialize the database.
 -- Drop any existing data and create empty tables.
 
-DROP TABLE IF EXISTS user;
+-- Tables that refer to others go first, as foreign keys are enforced.
+
+DROP TABLE IF EXISTS messages_fts;
 DROP TABLE IF EXISTS messages;
-DROP TABLE IF EXISTS rooms;
+DROP TABLE IF EXISTS room_members;
 DROP TABLE IF EXISTS apitokens;
 DROP TABLE IF EXISTS invitelinks;
+DROP TABLE IF EXISTS read_markers;
+-- replaced by room and room_members in version 12
+DROP TABLE IF EXISTS rooms;
+DROP TABLE IF EXISTS room_settings;
+DROP TABLE IF EXISTS room;
+DROP TABLE IF EXISTS user;
+DROP TABLE IF EXISTS bus_events;
 DROP TABLE IF EXISTS schema_version;
 
 CREATE TABLE user (
---  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
   username TEXT UNIQUE NOT NULL,
-  password TEXT NOT NULL
+  password TEXT NOT NULL,
+  -- bumped when the password changes, which ends the user's other sessions
+  credential_epoch INTEGER NOT NULL DEFAULT 0
 );
 
 CREATE TABLE messages (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
-  author TEXT NOT NULL,
-  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  author_id INTEGER NOT NULL,
+  -- milliseconds since the Unix epoch, UTC
+  created INTEGER NOT NULL DEFAULT (CAST(ROUND((julianday('now') - 2440587.5) * 86400000) AS INTEGER)),
   content TEXT NOT NULL,
-  room TEXT NOT NULL,
+  room_id INTEGER NOT NULL,
   edited INTEGER NOT NULL DEFAULT 0, -- TODO: implement editing 
   deleted INTEGER NOT NULL DEFAULT 0, -- TODO: and deletion
---  FOREIGN KEY (author) REFERENCES user (username),
- FOREIGN KEY (room) REFERENCES rooms (roomname) ON DELETE CASCADE
+  FOREIGN KEY (author_id) REFERENCES user (id),
+  FOREIGN KEY (room_id) REFERENCES room (id) ON DELETE CASCADE
 );
 
+-- Full-text index over message contents
+CREATE VIRTUAL TABLE messages_fts USING fts5(content, content='messages', content_rowid='id');
+
+CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+  INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+
+CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+  INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+
+CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+  INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+  INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+
 CREATE TABLE apitokens (
-  token TEXT PRIMARY KEY,
-  username TEXT NOT NULL,
+  token TEXT PRIMARY KEY, -- SHA-256 hex digest of the token
+  user_id INTEGER NOT NULL,
   tokenname TEXT NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-  FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE
+  FOREIGN KEY (user_id) REFERENCES user (id) ON DELETE CASCADE
 );
 
 CREATE TABLE invitelinks (
   token TEXT PRIMARY KEY,
-  username TEXT NOT NULL,
+  user_id INTEGER NOT NULL,
   invite_name TEXT NOT NULL,
-  room TEXT NOT NULL,
+  room_id INTEGER NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-  FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE
+  FOREIGN KEY (user_id) REFERENCES user (id) ON DELETE CASCADE,
+  FOREIGN KEY (room_id) REFERENCES room (id) ON DELETE CASCADE
 );
 
+CREATE TABLE room (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  name TEXT NOT NULL,
+  creator_id INTEGER,
+  created INTEGER NOT NULL DEFAULT (CAST(ROUND((julianday('now') - 2440587.5) * 86400000) AS INTEGER)),
+  -- deleted rooms stay until their messages have been deleted in the background
+  deleted INTEGER NOT NULL DEFAULT 0,
+  -- retention policy, enforced by "flask prune"
+  max_age_days INTEGER,
+  max_count INTEGER,
+  -- messages up to this id were cleared and are waiting to be deleted
+  cleared_id INTEGER NOT NULL DEFAULT 0,
+  -- bumped when the membership changes or messages are removed, for ETags
+  version INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY (creator_id) REFERENCES user (id)
+);
 
-CREATE TABLE rooms (
-  roomname TEXT NOT NULL,
-  member TEXT NOT NULL,
+CREATE TABLE room_members (
+  room_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
   isadmin INTEGER NOT NULL DEFAULT 0,
-  FOREIGN KEY (member) REFERENCES user (username)
+  PRIMARY KEY (room_id, user_id),
+  FOREIGN KEY (room_id) REFERENCES room (id) ON DELETE CASCADE,
+  FOREIGN KEY (user_id) REFERENCES user (id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE TABLE read_markers (
+  user_id INTEGER NOT NULL,
+  room_id INTEGER NOT NULL,
+  last_read_id INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (room_id, user_id),
+  FOREIGN KEY (room_id) REFERENCES room (id) ON DELETE CASCADE,
+  FOREIGN KEY (user_id) REFERENCES user (id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+-- broadcasts between workers for the sqlite message bus, pruned after a minute
+CREATE TABLE bus_events (
+  id INTEGER PRIMARY KEY,
+  origin TEXT NOT NULL,
+  channel TEXT NOT NULL,
+  payload TEXT NOT NULL,
+  created REAL NOT NULL
 );
 
+CREATE INDEX messages_room_id ON messages (room_id, id);
+CREATE UNIQUE INDEX room_name ON room (name) WHERE deleted = 0;
+CREATE INDEX room_members_user_id ON room_members (user_id, room_id);
+CREATE INDEX read_markers_user_id ON read_markers (user_id);
+CREATE INDEX apitokens_user_id_tokenname ON apitokens (user_id, tokenname);
+CREATE INDEX invitelinks_user_id_invite_name ON invitelinks (user_id, invite_name);
+CREATE INDEX invitelinks_room_id ON invitelinks (room_id);
+
 CREATE TABLE schema_version (
   num INT NOT NULL PRIMARY KEY, 
   enforcer INT DEFAULT 0 NOT NULL CHECK(enforcer == 0), 
@@ -58,4 +131,4 @@ CREATE TABLE schema_version (
 ) WITHOUT ROWID;
 
 INSERT INTO user (username, password) VALUES ("Message Jar", "I am good at choosing passwords");
-INSERT OR REPLACE INTO schema_version (num, enforcer) VALUES (3, 0);
\ No newline at end of file
+INSERT OR REPLACE INTO schema_version (num, enforcer) VALUES (15, 0);
\ No newline at end of file
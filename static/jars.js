@@ -50,44 +50,139 @@
         }, { once: true });
     }
 
+    // Only the newest page is loaded at first. Older pages are fetched with
+    // before_id when scrolling up, and at most MAX_RENDERED messages are kept
+    // in the page: the far end is dropped and fetched again when needed.
+    const PAGE_SIZE = 100;
+    const MAX_RENDERED = 500;
+    let hasOlder = false;
+    let detachedNewer = false; // newer messages were dropped from the bottom
+    let loadingPage = false;
+
+    function messageElement(m) {
+        const author = m.author || "Error getting author";
+        const content = m.content || "Error getting message";
+
+        const p = document.createElement('p');
+        p.className = 'message';
+        p.textContent = author + ': ' + content;
+        p.setAttribute("id", m.id);
+
+        const ts = document.createElement('span');
+        ts.className = 'ts';
+        ts.textContent = m.created ? m.created : 'No timestamp';
+
+        if (author == window.username) {
+            p.classList.add("sent-by-me")
+        }
+
+        p.appendChild(ts);
+        return p;
+    }
+
     function renderMessages(messages) {
         const container = document.getElementById('container');
-        if (!container) return;
+        if (!container || detachedNewer) return;
 
         for (let i = 0; i < messages.length; ++i) {
             const m = messages[i];
-            // backend returns id as sequential index starting at 0
             if (typeof m.id === 'number' && m.id <= window.lastSeenId) continue;
-            if (container.lastElementChild && container.lastElementChild.id >= String(m.id)) {
-                continue;
+
+            const p = messageElement(m);
+            if (window.lastSeenId !== 0) {
+                p.classList.add('new-arrival');
             }
+            container.appendChild(p);
+        }
+        trimTop(container);
+        scrollToBottom();
+    }
 
+    function renderedId(el) {
+        return el ? Number(el.getAttribute('id')) : 0;
+    }
 
-            const author = m.author || "Error getting author";
-            const content = m.content || "Error getting message";
+    function trimTop(container) {
+        while (container.children.length > MAX_RENDERED) {
+            const first = container.firstElementChild;
+            const height = first.offsetHeight;
+            container.removeChild(first);
+            container.scrollTop -= height;
+            hasOlder = true;
+        }
+    }
 
-            const p = document.createElement('p');
-            p.className = 'message';
-            p.textContent = author + ': ' + content;
-            p.setAttribute("id", m.id);
+    function trimBottom(container) {
+        while (container.children.length > MAX_RENDERED) {
+            container.removeChild(container.lastElementChild);
+            detachedNewer = true;
+        }
+    }
 
-            const ts = document.createElement('span');
-            ts.className = 'ts';
-            ts.textContent = m.created ? m.created : 'No timestamp';
+    function fetchPage(query) {
+        const room = window.room_name || '';
+        return fetch('/jar/endpoint/' + encodeURIComponent(room) + '?' + query, {
+            method: 'GET',
+            credentials: 'include',
+            headers: { 'Accept': 'application/json' }
+        }).then(function (res) {
+            if (!res.ok) throw new Error('Network response was not ok');
+            return res.json();
+        });
+    }
 
-            if (window.lastSeenId !== 0) {
-                p.classList.add('new-arrival');
-            }
+    function loadOlder() {
+        const container = document.getElementById('container');
+        if (!container || !hasOlder || loadingPage) return;
+        loadingPage = true;
+
+        const before = renderedId(container.firstElementChild);
+        fetchPage('before_id=' + before + '&limit=' + PAGE_SIZE).then(function (data) {
+            const messages = localizeTimestamps(data.messages || []);
+            hasOlder = data.next_cursor !== null;
+
+            // Keep what is on screen in place while the page grows above it
+            const height = container.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            messages.forEach(m => fragment.appendChild(messageElement(m)));
+            container.insertBefore(fragment, container.firstElementChild);
+            container.scrollTop += container.scrollHeight - height;
+
+            trimBottom(container);
+        }).catch(function (err) {
+            console.error('Failed to load older messages:', err);
+        }).finally(function () {
+            loadingPage = false;
+        });
+    }
 
-            if (author == window.username) {
-                p.classList.add("sent-by-me")
+    function loadNewer() {
+        const container = document.getElementById('container');
+        if (!container || !detachedNewer || loadingPage) return;
+        loadingPage = true;
+
+        const after = renderedId(container.lastElementChild);
+        fetchPage('after_id=' + after + '&limit=' + PAGE_SIZE).then(function (data) {
+            const messages = localizeTimestamps(data.messages || []);
+            messages.forEach(m => container.appendChild(messageElement(m)));
+            if (data.next_cursor >= window.lastSeenId) {
+                detachedNewer = false;
             }
+            trimTop(container);
+        }).catch(function (err) {
+            console.error('Failed to load newer messages:', err);
+        }).finally(function () {
+            loadingPage = false;
+        });
+    }
 
-            p.appendChild(ts);
-
-            container.appendChild(p);
+    function onScroll() {
+        const container = document.getElementById('container');
+        if (container.scrollTop < 50) {
+            loadOlder();
+        } else if (container.scrollHeight - container.scrollTop - container.clientHeight < 50) {
+            loadNewer();
         }
-        scrollToBottom();
     }
 
     function localizeTimestamps(posts) {
@@ -106,14 +201,72 @@
         });
     }
 
-    function updateLastSeenFrom(allMessages) {
-        if (!Array.isArray(allMessages) || allMessages.length === 0) return;
-        window.lastSeenId += allMessages.length;
+    function updateLastSeenFrom(cursor) {
+        if (typeof cursor !== 'number' || cursor <= window.lastSeenId) return;
+        window.lastSeenId = cursor;
+    }
+
+    function handleMessages(all) {
+        if (!all.length) return;
+
+        notifyPing();
+        flashTabTitle();
+
+        const messages = localizeTimestamps(all)
+
+        if (window.lastSeenId !== 0) {
+            messages.forEach(m => {
+                if (m.id > window.lastSeenId && m.author !== window.username) {
+                    triggerDesktopNotification(m.author, m.content);
+                }
+            });
+        }
+
+        // Render only new messages (renderMessages will skip already-seen using id)
+        renderMessages(messages);
+    }
+
+    // Tell the server how far this room has been read, at most once a
+    // second and only while the page is being looked at.
+    let markedId = 0;
+    let markTimer = null;
+
+    function markRead() {
+        if (markTimer || document.hidden || window.lastSeenId <= markedId) return;
+        markTimer = setTimeout(function () {
+            markTimer = null;
+            const id = window.lastSeenId;
+            const formData = new URLSearchParams();
+            formData.append('message_id', id);
+
+            fetch('/jar/read/' + encodeURIComponent(window.room_name || ''), {
+                method: 'POST',
+                credentials: 'include',
+                headers: {
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'X-CSRFToken': window.csrf_token
+                },
+                body: formData.toString()
+            }).then(function (res) {
+                if (res.ok) markedId = Math.max(markedId, id);
+            }).catch(function (err) {
+                console.error('Failed to mark messages read:', err);
+            });
+        }, 1000);
     }
 
+    document.addEventListener('visibilitychange', markRead);
+
+    let fetching = false;
+
     function getMessages() {
+        if (fetching) return Promise.resolve();
+        fetching = true;
         const room = window.room_name || '';
-        return fetch('/jar/endpoint/' + encodeURIComponent(room) + '?latest=' + window.lastSeenId, {
+        const first = window.lastSeenId === 0;
+        // Start with the newest page; after that, everything since the last id
+        const query = first ? 'limit=' + PAGE_SIZE : 'after_id=' + window.lastSeenId;
+        return fetch('/jar/endpoint/' + encodeURIComponent(room) + '?' + query, {
             method: 'GET',
             credentials: 'include',
             headers: { 'Accept': 'application/json' }
@@ -130,34 +283,63 @@
         }).then(function (data) {
             const all = (data && data.messages) ? data.messages : Array.isArray(data) ? data : [];
 
-            if (!all.length) return;
-
-            notifyPing();
-            flashTabTitle();
-
-            const messages = localizeTimestamps(all)
+            if (first) hasOlder = all.length >= PAGE_SIZE;
 
-            if (window.lastSeenId !== 0) {
-                messages.forEach(m => {
-                    if (m.id > window.lastSeenId && m.author !== window.username) {
-                        triggerDesktopNotification(m.author, m.content);
-                    }
-                });
-            }
+            handleMessages(all);
+            updateLastSeenFrom(data ? data.next_cursor : undefined);
+            markRead();
 
-            // On first load, render everything
-            if (window.lastSeenId === 0) {
-                renderMessages(messages);
-                updateLastSeenFrom(messages);
-                return;
+            // A full page means there is more to catch up on
+            if (!first && all.length >= PAGE_SIZE) {
+                fetching = false;
+                return getMessages();
             }
-
-            // Render only new messages (renderMessages will skip already-seen using id)
-            renderMessages(messages);
-            updateLastSeenFrom(messages);
         }).catch(function (err) {
             console.error('Failed to fetch messages:', err);
+        }).finally(function () {
+            fetching = false;
+        });
+    }
+
+    let pollTimer = null;
+
+    function startPolling() {
+        if (pollTimer) return;
+        pollTimer = setInterval(getMessages, 1000);
+    }
+
+    // Push new messages over Server-Sent Events, falling back to polling
+    // if the browser lacks EventSource or the stream keeps failing.
+    function startStream() {
+        if (!window.EventSource) {
+            startPolling();
+            return;
+        }
+
+        const room = window.room_name || '';
+        const source = new EventSource('/jar/stream/' + encodeURIComponent(room) + '?after_id=' + window.lastSeenId);
+        let failures = 0;
+
+        source.addEventListener('open', function () {
+            failures = 0;
         });
+        source.addEventListener('message', function (e) {
+            const m = JSON.parse(e.data);
+            handleMessages([m]);
+            updateLastSeenFrom(m.id);
+            markRead();
+        });
+        source.addEventListener('close', function () {
+            source.close();
+            flashError("You are no longer a member of this room.")
+        });
+        source.onerror = function () {
+            failures += 1;
+            if (source.readyState === EventSource.CLOSED || failures >= 3) {
+                source.close();
+                startPolling();
+            }
+        };
     }
 
     function sendMessage() {
@@ -225,12 +407,14 @@
         }
     }
 
+    const container = document.getElementById('container');
+    if (container) container.addEventListener('scroll', onScroll);
+
     const btnBottom = document.getElementById('toTheBottom');
     if (btnBottom) btnBottom.addEventListener('click', scrollToBottom);
 
-    // initial load and periodic sync
-    getMessages();
-    setInterval(getMessages, 1000);
+    // initial load, then live updates
+    getMessages().then(startStream);
 
     const sendBtn = document.getElementById('sendMessageButton');
     if (sendBtn) sendBtn.addEventListener('click', sendMessage);
@@ -0,0 +1,83 @@
+import json
+import time
+
+import flask as f
+
+import backend as cb
+from db import release_db
+
+
+def start_cursor(request, after_id=None):
+    """Work out where a stream should start.
+
+    A ``Last-Event-ID`` header (sent by browsers when they reconnect) wins over
+    the ``after_id`` argument. With neither, the stream starts after the newest
+    message, so only new messages are sent. Raises ValueError on bad values.
+    """
+
+    last_event_id = request.headers.get("Last-Event-ID")
+    if last_event_id:
+        return int(last_event_id)
+    if after_id is not None and after_id != "":
+        return int(after_id)
+    return None
+
+
+def event(name, data, event_id=None):
+    """Format one Server-Sent Event."""
+
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines.append(f"event: {name}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def stream_response(room, username, after_id=None):
+    """Stream the messages of a room to a member as Server-Sent Events.
+
+    Every message is sent as a ``message`` event with its id as the event id,
+    so reconnecting clients resume where they left off. A comment line is sent
+    every STREAM_HEARTBEAT seconds with nothing new. Membership is checked
+    again before every page, and a ``close`` event ends the stream if the user
+    left.
+    Streams end after STREAM_LIFETIME seconds and clients reconnect, which
+    keeps workers from being held forever.
+    """
+
+    config = f.current_app.config
+    heartbeat = config.get("STREAM_HEARTBEAT", 15)
+    lifetime = config.get("STREAM_LIFETIME", 300)
+
+    if after_id is None:
+        after_id = cb.latest_id(room)
+    release_db()
+
+    @f.stream_with_context
+    def events():
+        cursor = after_id
+        deadline = time.monotonic() + lifetime
+
+        yield "retry: 1000\n\n"
+
+        while time.monotonic() < deadline:
+            if room not in cb.get_rooms(username):
+                yield event("close", {"e": "Not a member of this room!"})
+                return
+            page = cb.get_page(room, after_id=cursor)
+            release_db()
+
+            for message in page["messages"]:
+                yield event("message", message, message["id"])
+            cursor = page["next_cursor"]
+
+            if page["messages"]:
+                continue
+
+            if not cb.wait_for_messages(room, cursor, heartbeat):
+                yield ": heartbeat\n\n"
+
+    return f.Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,12 +1,37 @@
+import ast
+import contextlib
+import gzip
+import io
 import json
 import os
+import re
+import shutil
 import signal
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import unittest
 import urllib.request
 
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack  # type: ignore
+except ImportError:
+    msgpack = None
+
+import auth
+import backend
+import bus
+import db
+from app import SCHEMA_VERSION, create_app
+
 # Configuration
 HOST = "127.0.0.1"
 PORT = 5000
@@ -222,6 +247,64 @@ class TestChatIntegration(unittest.TestCase):
 
         self.assertTrue(match, f"Message from {U1} not found in response. Resp: {resp}")
 
+    def test_13b_get_messages_cursor(self):
+        for i in range(3):
+            self._post(
+                "/api/v1/send",
+                {
+                    "token": self.__class__.token1,
+                    "room": "test",
+                    "message": f"page {i}",
+                },
+            )
+
+        resp = self._post(
+            "/api/v1/get", {"token": self.__class__.token1, "room": "test", "limit": 2}
+        )
+        self.assertEqual(
+            [m["content"] for m in resp["messages"]],
+            ["page 1", "page 2"],
+            f"Newest page wrong. Resp: {resp}",
+        )
+        newest = resp["next_cursor"]
+
+        resp = self._post(
+            "/api/v1/get",
+            {"token": self.__class__.token1, "room": "test", "after_id": newest},
+        )
+        self.assertEqual(resp["messages"], [], "after_id returned old messages")
+        self.assertEqual(resp["next_cursor"], newest, "next_cursor moved")
+
+        resp = self._post(
+            "/api/v1/get",
+            {
+                "token": self.__class__.token1,
+                "room": "test",
+                "before_id": newest,
+                "limit": 1,
+            },
+        )
+        self.assertEqual(
+            [m["content"] for m in resp["messages"]],
+            ["page 1"],
+            f"before_id page wrong. Resp: {resp}",
+        )
+
+        resp = self._post(
+            "/api/v1/get",
+            {"token": self.__class__.token1, "room": "test", "latest": newest - 1},
+        )
+        self.assertEqual(
+            [m["id"] for m in resp], [newest], f"latest was not an id. Resp: {resp}"
+        )
+
+        for bad in ({"after_id": {"x": 1}}, {"limit": [1]}, {"before_id": 10**30}):
+            with self.subTest(args=bad):
+                resp = self._post(
+                    "/api/v1/get", {"token": self.__class__.token1, "room": "test", **bad}
+                )
+                self.assertEqual(resp.get("e"), "Cursor arguments must be integers!")
+
     def test_14_add_to_room(self):
         resp = self._post(
             "/api/v1/send",
@@ -336,6 +419,1246 @@ class TestChatIntegration(unittest.TestCase):
     def test_24_check_exists(self):
         self.assertTrue(self._post("/api/v1/user/exists", {"username": U1}))
 
+    def test_25_stats(self):
+        resp = self._post("/api/v1/stats", {"token": self.__class__.token2})
+        self.assertNotEqual(resp.get("e"), None, "stats open to non logs members")
+
+        resp = self._post(
+            "/api/v1/rooms/create", {"token": self.__class__.token2, "room": "logs"}
+        )
+        self.assertEqual(resp, {"status": "ok"}, "create logs room failed")
+
+        resp = self._post("/api/v1/stats", {"token": self.__class__.token2})
+        pool = resp["db_pool"][0]
+        self.assertGreater(pool["checkouts"], 0, f"pool unused. Resp: {resp}")
+        self.assertGreater(pool["hits"], 0, f"connections not reused. Resp: {resp}")
+
+    def test_26_wal_mode(self):
+        conn = sqlite3.connect("instance/db.sqlite")
+        try:
+            mode = conn.execute("PRAGMA journal_mode;").fetchone()[0]
+        finally:
+            conn.close()
+        self.assertEqual(mode, "wal", "database not switched to WAL")
+
+    def _stream_events(self, data_dict, count, headers=None):
+        """Read the first ``count`` message events from an SSE endpoint."""
+        req = urllib.request.Request(
+            f"{BASE_URL}/api/v1/stream",
+            data=json.dumps(data_dict).encode("utf-8"),
+            method="POST",
+            headers={"Content-Type": "application/json", **(headers or {})},
+        )
+        events = []
+        with urllib.request.urlopen(req, timeout=10) as response:
+            self.assertEqual(
+                response.headers.get_content_type(), "text/event-stream"
+            )
+            event = {}
+            for line in response:
+                line = line.decode("utf-8").rstrip("\n")
+                if not line:
+                    if event.get("event") == "message":
+                        events.append(event)
+                        if len(events) == count:
+                            break
+                    event = {}
+                elif not line.startswith(":"):
+                    key, _, value = line.partition(": ")
+                    event[key] = value
+        return events
+
+    def test_27_stream(self):
+        events = self._stream_events(
+            {"token": self.__class__.token2, "room": "logs", "after_id": 0}, 2
+        )
+        self.assertEqual(len(events), 2, "stream did not send history")
+        message = json.loads(events[0]["data"])
+        self.assertEqual(str(message["id"]), events[0]["id"], "event id mismatch")
+
+        resumed = self._stream_events(
+            {"token": self.__class__.token2, "room": "logs"},
+            1,
+            {"Last-Event-ID": events[0]["id"]},
+        )
+        self.assertEqual(resumed[0]["id"], events[1]["id"], "resume failed")
+
+        sender = threading.Timer(
+            0.5,
+            self._post,
+            (
+                "/api/v1/send",
+                {"token": self.__class__.token2, "room": "logs", "message": "live"},
+            ),
+        )
+        sender.start()
+        live = self._stream_events({"token": self.__class__.token2, "room": "logs"}, 1)
+        sender.join()
+        self.assertEqual(json.loads(live[0]["data"])["content"], "live", "no push")
+
+    def test_28_long_poll(self):
+        latest = self._post(
+            "/api/v1/get", {"token": self.__class__.token2, "room": "logs", "limit": 1}
+        )["next_cursor"]
+
+        start = time.monotonic()
+        resp = self._post(
+            "/api/v1/get",
+            {
+                "token": self.__class__.token2,
+                "room": "logs",
+                "after_id": latest,
+                "wait": 0.5,
+            },
+        )
+        self.assertEqual(resp["messages"], [], "long poll timeout not empty")
+        self.assertGreaterEqual(time.monotonic() - start, 0.5, "did not wait")
+
+        sender = threading.Timer(
+            0.3,
+            self._post,
+            (
+                "/api/v1/send",
+                {"token": self.__class__.token2, "room": "logs", "message": "polled"},
+            ),
+        )
+        sender.start()
+        start = time.monotonic()
+        resp = self._post(
+            "/api/v1/get",
+            {
+                "token": self.__class__.token2,
+                "room": "logs",
+                "after_id": latest,
+                "wait": 10,
+            },
+        )
+        sender.join()
+        self.assertLess(time.monotonic() - start, 5, "long poll not woken")
+        self.assertIn("polled", [m["content"] for m in resp["messages"]])
+
+    def test_29_membership_cache(self):
+        self._post("/api/v1/rooms/list", {"token": self.__class__.token2})
+        self._post("/api/v1/rooms/list", {"token": self.__class__.token2})
+        resp = self._post("/api/v1/stats", {"token": self.__class__.token2})
+        cache = resp["membership_cache"]["user_rooms"]
+        self.assertGreater(cache["hits"], 0, f"membership not cached. Resp: {resp}")
+
+    def test_30_revoke_cached_token(self):
+        token = self._post(
+            "/api/v1/user/generate",
+            {"username": U2, "password": P2, "name": "temp"},
+        )["token"]
+        for _ in range(2):
+            resp = self._post("/api/v1/token/username", {"token": token})
+            self.assertEqual(resp.get("username"), U2, "new token not valid")
+
+        resp = self._post("/api/v1/user/tokens", {"username": U2, "password": P2})
+        self.assertNotIn("token", resp[0], "token listed in the clear")
+
+        resp = self._post(
+            "/api/v1/user/revoke", {"username": U2, "password": P2, "name": "temp"}
+        )
+        self.assertEqual(resp, {"status": "ok"}, "revoke by name failed")
+
+        resp = self._post("/api/v1/token/username", {"token": token})
+        self.assertNotEqual(resp.get("e"), None, "revoked token still cached")
+
+        conn = sqlite3.connect("instance/db.sqlite")
+        try:
+            stored = [r[0] for r in conn.execute("SELECT token FROM apitokens")]
+        finally:
+            conn.close()
+        self.assertNotIn(self.__class__.token2, stored, "token stored in the clear")
+
+    def test_31_logs_batched(self):
+        latest = self._post(
+            "/api/v1/get", {"token": self.__class__.token2, "room": "logs", "limit": 1}
+        )["next_cursor"]
+
+        for _ in range(3):
+            resp = self._post(
+                "/api/v1/user/verify", {"username": U2, "password": "wrong"}
+            )
+
+        logged = []
+        deadline = time.monotonic() + 5
+        while len(logged) < 3 and time.monotonic() < deadline:
+            resp = self._post(
+                "/api/v1/get",
+                {
+                    "token": self.__class__.token2,
+                    "room": "logs",
+                    "after_id": latest,
+                    "wait": 2,
+                },
+            )
+            latest = resp["next_cursor"]
+            logged += [
+                m for m in resp["messages"] if "Failed attempt" in m["content"]
+            ]
+        self.assertEqual(len(logged), 3, "failed logins not logged")
+
+        resp = self._post("/api/v1/stats", {"token": self.__class__.token2})
+        self.assertGreater(resp["log_handler"]["batches"], 0, f"Resp: {resp}")
+        self.assertEqual(resp["log_handler"]["dropped"], 0, f"Resp: {resp}")
+
+    def test_32_send_batch(self):
+        token = self.__class__.token2
+        entries = [{"room": "logs", "message": f"batch {i}"} for i in range(5)]
+        entries.append({"room": "logs", "message": "/help"})
+        resp = self._post("/api/v1/send_batch", {"token": token, "messages": entries})
+        ids = resp.get("ids")
+        self.assertEqual(len(ids or []), 6, f"batch send failed. Resp: {resp}")
+        self.assertEqual(ids, sorted(ids), "ids out of order")
+
+        resp = self._post(
+            "/api/v1/get",
+            {"token": token, "room": "logs", "after_id": ids[0] - 1, "limit": 50},
+        )
+        by_id = {m["id"]: m["content"] for m in resp["messages"]}
+        self.assertEqual(by_id[ids[0]], "batch 0")
+        self.assertEqual(by_id[ids[4]], "batch 4")
+        self.assertTrue(
+            any("/help" in c for i, c in by_id.items() if i > ids[5]),
+            "slash command not run",
+        )
+
+        resp = self._post(
+            "/api/v1/send_batch",
+            {"token": token, "messages": [{"room": "not mine", "message": "x"}]},
+        )
+        self.assertIn("e", resp, "batch sent to a room the user is not in")
+
+    def test_33_sync(self):
+        token = self.__class__.token2
+        rooms = self._post("/api/v1/rooms/list", {"token": token})
+        latest = self._post(
+            "/api/v1/get", {"token": token, "room": "logs", "limit": 1}
+        )["next_cursor"]
+        self._post("/api/v1/send", {"token": token, "room": "logs", "message": "s1"})
+        self._post("/api/v1/send", {"token": token, "room": "logs", "message": "s2"})
+
+        resp = self._post(
+            "/api/v1/sync",
+            {
+                "token": token,
+                "rooms": {"logs": latest, "no such room": 0},
+                "limit": 1,
+            },
+        )
+        logs = resp["rooms"]["logs"]
+        self.assertEqual(len(logs["messages"]), 1, f"limit ignored. Resp: {resp}")
+        self.assertEqual(logs["messages"][0]["content"], "s1")
+        self.assertEqual(resp["left"], ["no such room"])
+        self.assertNotIn("deleted", resp, "sync tells whether rooms exist")
+        self.assertEqual(sorted(resp["joined"]), sorted(r for r in rooms if r != "logs"))
+
+        resp = self._post(
+            "/api/v1/sync",
+            {"token": token, "rooms": {"logs": logs["next_cursor"]}},
+        )
+        contents = [m["content"] for m in resp["rooms"]["logs"]["messages"]]
+        self.assertEqual(contents[0], "s2", f"sync did not resume. Resp: {resp}")
+
+        cursors = {f"room {i}": 0 for i in range(2 * len(rooms) + 17)}
+        resp = self._post("/api/v1/sync", {"token": token, "rooms": cursors})
+        self.assertNotEqual(resp.get("e"), None, "unbounded sync allowed")
+
+        resp = self._post("/api/v1/sync", {"token": token, "rooms": {"logs": 10**30}})
+        self.assertIn("e", resp, "cursor beyond SQLite integers allowed")
+        resp = self._post(
+            "/api/v1/sync", {"token": token, "rooms": {"logs": 2**63 - 1}}
+        )
+        self.assertEqual(resp["rooms"]["logs"]["messages"], [])
+
+    def test_34_unread(self):
+        token = self.__class__.token2
+        latest = self._post(
+            "/api/v1/get", {"token": token, "room": "logs", "limit": 1}
+        )["next_cursor"]
+
+        resp = self._post("/api/v1/rooms/read", {"token": token, "room": "logs"})
+        self.assertIn("e", resp, "read marker moved without an id")
+
+        resp = self._post(
+            "/api/v1/rooms/read",
+            {"token": token, "room": "logs", "message_id": latest},
+        )
+        self.assertEqual(resp, {"status": "ok"}, "read marker not moved")
+        resp = self._post("/api/v1/rooms/unread", {"token": token})
+        self.assertEqual(resp.get("logs"), 0, f"unread count wrong. Resp: {resp}")
+
+        self._post("/api/v1/send", {"token": token, "room": "logs", "message": "u1"})
+        self._post("/api/v1/send", {"token": token, "room": "logs", "message": "u2"})
+        resp = self._post("/api/v1/rooms/unread", {"token": token})
+        self.assertEqual(resp.get("logs"), 0, "own messages counted")
+
+        # The reply comes from Message Jar
+        self._post("/api/v1/send", {"token": token, "room": "logs", "message": "/help"})
+        resp = self._post("/api/v1/rooms/unread", {"token": token})
+        self.assertGreaterEqual(resp.get("logs"), 1, "new messages not counted")
+
+        resp = self._post(
+            "/api/v1/rooms/read",
+            {"token": token, "room": "logs", "message_id": latest},
+        )
+        resp = self._post("/api/v1/rooms/unread", {"token": token})
+        self.assertGreaterEqual(resp.get("logs"), 1, "read marker moved back")
+
+    def test_35_columns(self):
+        token = self.__class__.token2
+        args = {"token": token, "room": "logs", "limit": 20}
+        plain = self._post("/api/v1/get", args)
+        resp = self._post("/api/v1/get", {**args, "format": "columns"})
+        self.assertEqual(resp["next_cursor"], plain["next_cursor"])
+
+        columns = resp["messages"]
+        rows = [
+            {
+                "id": columns["id"][i],
+                "author": columns["authors"][columns["author"][i]],
+                "created": columns["created"][i],
+                "content": columns["content"][i],
+            }
+            for i in range(len(columns["id"]))
+        ]
+        self.assertEqual(rows, plain["messages"], "columns differ from rows")
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_35b_msgpack(self):
+        token = self.__class__.token2
+        args = {"token": token, "room": "logs", "limit": 20}
+        # msgpack responses carry the column layout
+        resp = self._post("/api/v1/get", {**args, "format": "columns"})
+
+        req = urllib.request.Request(
+            f"{BASE_URL}/api/v1/get",
+            data=json.dumps(args).encode("utf-8"),
+            method="POST",
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/msgpack",
+            },
+        )
+        with urllib.request.urlopen(req) as response:
+            self.assertEqual(response.headers["Content-Type"], "application/msgpack")
+            self.assertEqual(msgpack.unpackb(response.read()), resp)
+
+        status, headers, body = self._raw_post(
+            "/api/v1/get", {**args, "format": "msgpack"}, {}
+        )
+        self.assertEqual(headers["Content-Type"], "application/msgpack")
+        self.assertEqual(msgpack.unpackb(body), resp, "format=msgpack not honoured")
+
+    def _raw_post(self, endpoint, data_dict, headers):
+        """POST JSON with extra headers; returns (status, headers, body)."""
+        req = urllib.request.Request(
+            f"{BASE_URL}{endpoint}",
+            data=json.dumps(data_dict).encode("utf-8"),
+            method="POST",
+            headers={"Content-Type": "application/json", **headers},
+        )
+        try:
+            with urllib.request.urlopen(req) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def test_36_etag_and_compression(self):
+        token = self.__class__.token2
+        args = {"token": token, "room": "logs", "limit": 100}
+
+        status, headers, body = self._raw_post("/api/v1/get", args, {})
+        self.assertEqual(status, 200)
+        tag = headers["ETag"]
+        self.assertTrue(tag, "no ETag sent")
+
+        status, _, body = self._raw_post("/api/v1/get", args, {"If-None-Match": tag})
+        self.assertEqual(status, 304, "unchanged poll not short-circuited")
+        self.assertEqual(body, b"")
+
+        status, _, _ = self._raw_post(
+            "/api/v1/get", {**args, "limit": 99}, {"If-None-Match": tag}
+        )
+        self.assertEqual(status, 200, "ETag ignores the cursor arguments")
+
+        self._post("/api/v1/send", {"token": token, "room": "logs", "message": "e"})
+        status, _, _ = self._raw_post("/api/v1/get", args, {"If-None-Match": tag})
+        self.assertEqual(status, 200, "stale ETag matched after a new message")
+
+        status, headers, body = self._raw_post(
+            "/api/v1/get", args, {"Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(headers["Content-Encoding"], "gzip", "not compressed")
+        plain = self._post("/api/v1/get", args)
+        self.assertEqual(json.loads(gzip.decompress(body)), plain)
+
+    @unittest.skipIf(brotli is None, "brotli is not installed")
+    def test_36b_brotli(self):
+        args = {"token": self.__class__.token2, "room": "logs", "limit": 100}
+        plain = self._post("/api/v1/get", args)
+
+        status, headers, body = self._raw_post(
+            "/api/v1/get", args, {"Accept-Encoding": "br, gzip"}
+        )
+        self.assertEqual(headers["Content-Encoding"], "br", "brotli not used")
+        self.assertEqual(json.loads(brotli.decompress(body)), plain)
+
+    def test_37_created_epoch_ms(self):
+        token = self.__class__.token2
+        self._post("/api/v1/send", {"token": token, "room": "logs", "message": "now"})
+        resp = self._post("/api/v1/get", {"token": token, "room": "logs", "limit": 1})
+        created = resp["messages"][-1]["created"]
+        self.assertIsInstance(created, int, "created is not epoch milliseconds")
+        self.assertLess(abs(created - time.time() * 1000), 60_000, "created not UTC")
+
+    def test_38_search(self):
+        token = self.__class__.token2
+        for message in ("the quick brown fox", "a quick <b>reply</b>", "slow"):
+            self._post(
+                "/api/v1/send", {"token": token, "room": "logs", "message": message}
+            )
+
+        resp = self._post("/api/v1/search", {"token": token, "query": "quick"})
+        snippets = [r["snippet"] for r in resp["results"]]
+        self.assertEqual(len(snippets), 2, f"search failed. Resp: {resp}")
+        self.assertIn("<mark>quick</mark>", snippets[0])
+        self.assertIn("&lt;b&gt;reply&lt;/b&gt;", " ".join(snippets), "not escaped")
+
+        resp = self._post(
+            "/api/v1/search", {"token": token, "query": "qui*", "limit": 1}
+        )
+        self.assertEqual(len(resp["results"]), 1)
+        self.assertEqual(resp["next_offset"], 1, "no next page")
+
+        resp = self._post(
+            "/api/v1/search", {"token": token, "query": 'quick "', "room": "nope"}
+        )
+        self.assertIn("e", resp, "searched a room the user is not in")
+
+    def test_39_retention(self):
+        token = self.__class__.token2
+        self._post("/api/v1/rooms/create", {"token": token, "room": "short lived"})
+        for i in range(5):
+            self._post(
+                "/api/v1/send",
+                {"token": token, "room": "short lived", "message": f"r{i}"},
+            )
+        self._post(
+            "/api/v1/send",
+            {"token": token, "room": "short lived", "message": "/retention count 3"},
+        )
+        resp = self._post(
+            "/api/v1/get", {"token": token, "room": "short lived", "limit": 1}
+        )
+        self.assertIn("newest 3", resp["messages"][-1]["content"])
+
+        archive = os.path.join("instance", "test_archive.sqlite")
+        if os.path.exists(archive):
+            os.remove(archive)
+        env = {**os.environ, "FLASK_APP": "app.py"}
+        result = subprocess.run(
+            [PYTHON_EXE, "-m", "flask", "prune", "--pause", "0", "--archive", archive],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertIn("short lived: 5 messages", result.stdout)
+
+        resp = self._post("/api/v1/get", {"token": token, "room": "short lived"})
+        self.assertEqual(len(resp), 3, f"room not pruned. Resp: {resp}")
+
+        conn = sqlite3.connect(archive)
+        try:
+            archived = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        finally:
+            conn.close()
+            os.remove(archive)
+        self.assertEqual(archived, 5, "pruned messages not archived")
+
+    def test_40_clear_and_delete(self):
+        token = self.__class__.token2
+        room = "cleared"
+        self._post("/api/v1/rooms/create", {"token": token, "room": room})
+        self._post(
+            "/api/v1/send_batch",
+            {
+                "token": token,
+                "messages": [{"room": room, "message": f"c{i}"} for i in range(50)],
+            },
+        )
+        self._post("/api/v1/send", {"token": token, "room": room, "message": "/clear"})
+
+        resp = self._post("/api/v1/get", {"token": token, "room": room})
+        contents = [m["content"] for m in resp]
+        self.assertFalse(
+            [c for c in contents if c.startswith("c")], f"room not cleared: {resp}"
+        )
+        self.assertIn("Room cleared", contents[0])
+        found = self._post(
+            "/api/v1/search", {"token": token, "query": "c1", "room": room}
+        )
+        self.assertFalse(found["results"], "cleared messages found by search")
+
+        # The rows go in the background, and the room is told when they have
+        for _ in range(50):
+            resp = self._post("/api/v1/get", {"token": token, "room": room})
+            if "cleared messages deleted" in resp[-1]["content"]:
+                break
+            time.sleep(0.1)
+        # The 50 plus the room's first message and the /clear itself
+        self.assertIn("52 cleared messages deleted", resp[-1]["content"])
+
+        self._post("/api/v1/send", {"token": token, "room": room, "message": "old"})
+        self._post("/api/v1/send", {"token": token, "room": room, "message": "/delete"})
+        self.assertNotIn(room, self._post("/api/v1/rooms/list", {"token": token}))
+
+        # A new room with the same name starts out empty
+        self._post("/api/v1/rooms/create", {"token": token, "room": room})
+        resp = self._post("/api/v1/get", {"token": token, "room": room})
+        self.assertEqual(len(resp), 1, f"deleted room's messages came back: {resp}")
+
+    def test_41_password_checks_cached(self):
+        for _ in range(3):
+            resp = self._post("/api/v1/user/verify", {"username": U2, "password": P2})
+            self.assertEqual(resp, {"status": "ok"}, "verify failed")
+
+        resp = self._post("/api/v1/stats", {"token": self.__class__.token2})
+        passwords = resp["passwords"]
+        self.assertGreater(passwords["jobs"], 0, f"Resp: {resp}")
+        self.assertGreaterEqual(passwords["verified_cache"]["hits"], 2, f"Resp: {resp}")
+        for key in ("busy", "queue_ms_avg", "queue_ms_max", "run_ms_avg"):
+            self.assertGreaterEqual(passwords[key], 0, f"{key}. Resp: {resp}")
+        self.assertGreaterEqual(
+            passwords["queue_ms_max"], passwords["queue_ms_avg"], f"Resp: {resp}"
+        )
+
+
+class TestQueryPlans(unittest.TestCase):
+    """Checks that every query in the database modules is served by an index."""
+
+    MODULES = ["backend.py", "auth.py", "user.py"]
+    SQL_KEYWORDS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+    # Maintenance queries that are meant to read a whole (small) table
+    FULL_SCANS = (
+        "SELECT id, name, deleted, max_age_days, max_count, cleared_id FROM room",
+    )
+
+    # Scans that only read what the query was given, or go through the
+    # full-text index
+    LISTS = (
+        "SCAN CONSTANT ROW",
+        "SCAN cursors",
+        "SCAN messages_fts VIRTUAL TABLE INDEX 0:M",  # MATCH
+    )
+    # What the run-time parts of f-string queries are filled in with
+    FRAGMENTS = {
+        "placeholders": "?, ?, ?",
+        "values": "(?, ?), (?, ?), (?, ?)",
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.conn = sqlite3.connect(":memory:")
+        with open("schema.sql") as file:
+            cls.conn.executescript(file.read())
+        # flask prune --archive copies messages to an attached database
+        cls.conn.execute("ATTACH DATABASE ':memory:' AS archive;")
+        cls.conn.execute(
+            "CREATE TABLE archive.messages AS SELECT * FROM main.messages WHERE 0;"
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.close()
+
+    def _queries(self, module):
+        with open(module) as file:
+            tree = ast.parse(file.read())
+
+        # Pieces of f-strings are not whole queries, so they are only looked
+        # at as part of the f-string, rendered by _render.
+        fragments = {
+            id(value)
+            for node in ast.walk(tree)
+            if isinstance(node, ast.JoinedStr)
+            for value in node.values
+        }
+
+        for node in ast.walk(tree):
+            if id(node) in fragments:
+                continue
+            if isinstance(node, ast.JoinedStr):
+                query = " ".join(self._render(node).split())
+            elif isinstance(node, ast.Constant) and isinstance(node.value, str):
+                query = " ".join(node.value.split())
+            else:
+                continue
+            if query.startswith(self.SQL_KEYWORDS):
+                yield query
+
+    def _render(self, node):
+        """Fill in an f-string query the way it is at run time, with a few
+        rooms' worth of placeholders."""
+
+        first = node.values[0] if node.values else None
+        if not (isinstance(first, ast.Constant) and first.value.lstrip().startswith(
+            self.SQL_KEYWORDS
+        )):
+            return ""
+
+        return "".join(
+            (
+                value.value
+                if isinstance(value, ast.Constant)
+                else self.FRAGMENTS[ast.unparse(value.value)]
+            )
+            for value in node.values
+        )
+
+    def test_queries_use_indexes(self):
+        for module in self.MODULES:
+            queries = list(self._queries(module))
+            self.assertTrue(queries, f"No queries found in {module}")
+
+            for query in queries:
+                if query.startswith(self.FULL_SCANS):
+                    continue
+                with self.subTest(module=module, query=query):
+                    plan = self.conn.execute(
+                        "EXPLAIN QUERY PLAN " + query, [None] * query.count("?")
+                    ).fetchall()
+                    scans = [
+                        row[3]
+                        for row in plan
+                        if row[3].startswith("SCAN")
+                        and not row[3].startswith(self.LISTS)
+                        and not re.fullmatch(r"SCAN \d+ CONSTANT ROWS", row[3])
+                    ]
+                    self.assertEqual(scans, [], f"Full scan in {module}: {query}")
+
+
+class TestSessions(unittest.TestCase):
+    """Web sessions, with the Flask test client and a throwaway database."""
+
+    @classmethod
+    def setUpClass(cls):
+        handle, cls.database = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        cls.app = create_app(
+            {
+                "DATABASE": cls.database,
+                "MESSAGE_BUS": "memory",
+                "PASSWORD_WORKERS": 0,
+                "RATELIMIT_ENABLED": False,
+                "WTF_CSRF_ENABLED": False,
+                "SESSION_COOKIE_SECURE": False,
+            }
+        )
+        with cls.app.app_context():
+            db.init_db(True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app.extensions["log_handler"].close()
+        os.remove(cls.database)
+
+    def _login(self, username, password):
+        client = self.app.test_client()
+        resp = client.post(
+            "/auth/login", data={"username": username, "password": password}
+        )
+        self.assertEqual(resp.status_code, 302, "login failed")
+        return client
+
+    def test_password_change_ends_other_sessions(self):
+        with self.app.app_context():
+            auth.register_user("s", "password1")
+
+        first = self._login("s", "password1")
+        second = self._login("s", "password1")
+        self.assertEqual(first.get("/jar/").status_code, 200)
+
+        resp = second.post(
+            "/user/passchange",
+            data={
+                "old_password": "password1",
+                "new_password": "password2",
+                "new_password_rep": "password2",
+            },
+        )
+        self.assertEqual(resp.status_code, 302, "password change failed")
+
+        self.assertEqual(second.get("/jar/").status_code, 200, "changer logged out")
+        resp = first.get("/jar/")
+        self.assertEqual(resp.status_code, 302, "old session still valid")
+        self.assertIn("/auth/login", resp.headers["Location"])
+
+    def test_old_sessions_logged_out(self):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["username"] = "s"  # from before sessions had a version
+
+        self.assertEqual(client.get("/jar/").status_code, 302)
+
+    def test_bus_listens_from_first_request(self):
+        bus._forget_bus()  # as in a freshly forked worker
+        self.app.test_client().get("/auth/login")
+        self.assertLessEqual(
+            {"tokens", "epochs", "membership", "unread", "removed"},
+            set(bus.get_bus()._subscribers),
+        )
+
+    def test_new_token_shown_once(self):
+        with self.app.app_context():
+            auth.register_user("k", "password1")
+        client = self._login("k", "password1")
+
+        resp = client.post("/user/tokens", data={"token_name": "laptop"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Cache-Control"], "no-store")
+        token = re.search(r"<code>([^<]+)</code>", resp.get_data(as_text=True))[1]
+        with self.app.app_context():
+            self.assertEqual(auth.check_valid_token(token), "k")
+        with client.session_transaction() as session:
+            self.assertNotIn(token, json.dumps(dict(session)), "token in cookie")
+
+        page = client.get("/user/tokens").get_data(as_text=True)
+        self.assertNotIn(token, page, "token shown again")
+
+
+class TestRateLimits(unittest.TestCase):
+    """API rate limits, kept in the SQLite limiter storage."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app(
+            {
+                "DATABASE": os.path.join(self.directory, "db.sqlite"),
+                "MESSAGE_BUS": "memory",
+                "PASSWORD_WORKERS": 0,
+                "RATELIMIT_ENABLED": True,
+                "RATELIMIT_STORAGE_URI": "sqlite://"
+                + os.path.join(self.directory, "limits.sqlite"),
+            }
+        )
+        with self.app.app_context():
+            db.init_db(True)
+            auth.register_user("a", "password1")
+            self.tokens = [auth.generate_api_token("a", name) for name in "xy"]
+
+    def tearDown(self):
+        self.app.extensions["log_handler"].close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_limits_are_per_token(self):
+        client = self.app.test_client()
+
+        statuses = [
+            client.post("/api/v1/token/username", json={"token": self.tokens[0]})
+            .status_code
+            for _ in range(5)
+        ]
+        self.assertIn(429, statuses, "token not limited")
+
+        resp = client.post("/api/v1/token/username", json={"token": self.tokens[1]})
+        self.assertEqual(resp.status_code, 200, "other token limited too")
+
+
+class TestStreams(unittest.TestCase):
+    """Server-Sent Event streams, read chunk by chunk from the test client."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app(
+            {
+                "DATABASE": os.path.join(self.directory, "db.sqlite"),
+                "MESSAGE_BUS": "memory",
+                "PASSWORD_WORKERS": 0,
+                "RATELIMIT_ENABLED": False,
+                "STREAM_HEARTBEAT": 5,
+            }
+        )
+        with self.app.app_context():
+            db.init_db(True)
+            auth.register_user("a", "password1")
+            auth.register_user("b", "password1")
+            self.token = auth.generate_api_token("b", "stream")
+            backend.create_room("busy", "a")
+            backend.add_to_room("busy", "a", 1)
+            backend.add_to_room("busy", "b")
+
+    def tearDown(self):
+        self.app.extensions["log_handler"].close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _send(self, *messages):
+        with self.app.app_context():
+            backend.add_messages("a", [("busy", m) for m in messages])
+
+    def test_removed_member_stream_closes(self):
+        resp = self.app.test_client().post(
+            "/api/v1/stream",
+            json={"token": self.token, "room": "busy"},
+            buffered=False,
+        )
+        self.assertEqual(resp.status_code, 200)
+        chunks = iter(resp.response)
+        self.assertEqual(next(chunks), b"retry: 1000\n\n")
+
+        self._send("hello 0", "hello 1")
+        events = [next(chunks).decode() for _ in range(2)]
+        self.assertTrue(all("hello" in e for e in events), events)
+
+        # Messages keep arriving after b is removed
+        self._send("hello 2")
+        with self.app.app_context():
+            backend.remove_from_room("busy", "b")
+        self._send(*[f"secret {i}" for i in range(10)])
+
+        rest = b"".join(chunks).decode()
+        resp.close()
+        self.assertNotIn("secret", rest, "removed member still streamed to")
+        self.assertIn("event: close", rest)
+
+
+class TestReclaim(unittest.TestCase):
+    """Deleting the messages of deleted rooms in the background."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app(
+            {
+                "DATABASE": os.path.join(self.directory, "db.sqlite"),
+                "MESSAGE_BUS": "memory",
+                "PASSWORD_WORKERS": 0,
+                "CLEAR_BATCH_SIZE": 2,
+                "CLEAR_PAUSE": 0.01,
+            }
+        )
+        with self.app.app_context():
+            db.init_db(True)
+            auth.register_user("a", "password1")
+
+    def tearDown(self):
+        self.app.extensions["log_handler"].close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_one_thread_for_all_rooms(self):
+        rooms = [f"reclaim {i}" for i in range(8)]
+        with self.app.app_context():
+            for room in rooms:
+                backend.create_room(room, "a")
+                backend.add_to_room(room, "a", 1)
+                backend.add_messages("a", [(room, f"message {i}") for i in range(5)])
+            for room in rooms:
+                backend.delete_room("a", room)
+
+            self.assertEqual(
+                sum(t.name == "reclaimer" for t in threading.enumerate()), 1
+            )
+            deadline = time.monotonic() + 10
+            while backend.reclaim_stats() and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(backend.reclaim_stats(), {})
+
+            with db.DBConnection() as conn:
+                left = conn.execute(
+                    "SELECT COUNT(*) FROM messages m JOIN room r ON r.id = m.room_id "
+                    "WHERE r.deleted = 1"
+                ).fetchone()[0]
+            self.assertEqual(left, 0)
+
+
+class TestMigrations(unittest.TestCase):
+    """Schema updates, run on a database made by an older schema.sql."""
+
+    # schema.sql as it was at version 11
+    SCHEMA_V11 = """
+CREATE TABLE user (
+  username TEXT UNIQUE NOT NULL,
+  password TEXT NOT NULL,
+  credential_epoch INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE messages (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  author TEXT NOT NULL,
+  created INTEGER NOT NULL DEFAULT (CAST(ROUND((julianday('now') - 2440587.5) * 86400000) AS INTEGER)),
+  content TEXT NOT NULL,
+  room TEXT NOT NULL,
+  edited INTEGER NOT NULL DEFAULT 0,
+  deleted INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY (room) REFERENCES rooms (roomname) ON DELETE CASCADE
+);
+CREATE VIRTUAL TABLE messages_fts USING fts5(content, content='messages', content_rowid='id');
+CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+  INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+  INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+  INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+  INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TABLE apitokens (
+  token TEXT PRIMARY KEY,
+  username TEXT NOT NULL,
+  tokenname TEXT NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE
+);
+CREATE TABLE invitelinks (
+  token TEXT PRIMARY KEY,
+  username TEXT NOT NULL,
+  invite_name TEXT NOT NULL,
+  room TEXT NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE
+);
+CREATE TABLE rooms (
+  roomname TEXT NOT NULL,
+  member TEXT NOT NULL,
+  isadmin INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY (member) REFERENCES user (username)
+);
+CREATE TABLE read_markers (
+  user TEXT NOT NULL,
+  room TEXT NOT NULL,
+  last_read_id INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (room, user)
+) WITHOUT ROWID;
+CREATE TABLE room_settings (
+  room TEXT PRIMARY KEY,
+  max_age_days INTEGER,
+  max_count INTEGER,
+  cleared_id INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX messages_room_id ON messages (room, id);
+CREATE UNIQUE INDEX rooms_roomname_member ON rooms (roomname, member);
+CREATE INDEX rooms_member_roomname ON rooms (member, roomname);
+CREATE INDEX apitokens_username_tokenname ON apitokens (username, tokenname);
+CREATE INDEX invitelinks_username_invite_name ON invitelinks (username, invite_name);
+CREATE TABLE schema_version (
+  num INT NOT NULL PRIMARY KEY,
+  enforcer INT DEFAULT 0 NOT NULL CHECK(enforcer == 0),
+  UNIQUE (enforcer)
+) WITHOUT ROWID;
+INSERT INTO user (username, password) VALUES ("Message Jar", "I am good at choosing passwords");
+INSERT INTO schema_version (num, enforcer) VALUES (11, 0);
+"""
+
+    # "old" was deleted, but its messages, invite and read marker are left
+    DATA_V11 = """
+INSERT INTO user (username, password) VALUES ("a", "x"), ("b", "x"), ("c", "x");
+INSERT INTO rooms (roomname, member, isadmin) VALUES
+  ("general", "b", 0), ("general", "a", 1), ("general", "c", 1),
+  ("quiet", "c", 1), ("quiet", "b", 0);
+INSERT INTO room_settings (room, max_age_days, max_count, cleared_id) VALUES
+  ("general", 30, 100, 2);
+INSERT INTO messages (id, author, created, content, room) VALUES
+  (1, "a", 1000, "hello everyone", "general"),
+  (2, "b", 2000, "hi a", "general"),
+  (3, "a", 3000, "anyone here", "old"),
+  (4, "c", 4000, "quiet please", "quiet"),
+  (5, "a", 5000, "fine then", "general"),
+  (6, "b", 6000, "never mind", "general");
+DELETE FROM messages WHERE id = 6;
+INSERT INTO apitokens (token, username, tokenname) VALUES ("h1", "b", "phone");
+INSERT INTO invitelinks (token, username, invite_name, room) VALUES
+  ("t1", "a", "friends", "general"), ("t2", "a", "stale", "old");
+INSERT INTO read_markers (user, room, last_read_id) VALUES
+  ("a", "general", 5), ("a", "old", 3), ("b", "quiet", 4);
+"""
+
+    # schema.sql as it was at version 3, the oldest that can be updated
+    SCHEMA_V3 = """
+CREATE TABLE user (
+  username TEXT UNIQUE NOT NULL,
+  password TEXT NOT NULL
+);
+CREATE TABLE messages (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  author TEXT NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  content TEXT NOT NULL,
+  room TEXT NOT NULL,
+  edited INTEGER NOT NULL DEFAULT 0,
+  deleted INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY (room) REFERENCES rooms (roomname) ON DELETE CASCADE
+);
+CREATE TABLE apitokens (
+  token TEXT PRIMARY KEY,
+  username TEXT NOT NULL,
+  tokenname TEXT NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE
+);
+CREATE TABLE invitelinks (
+  token TEXT PRIMARY KEY,
+  username TEXT NOT NULL,
+  invite_name TEXT NOT NULL,
+  room TEXT NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE
+);
+CREATE TABLE rooms (
+  roomname TEXT NOT NULL,
+  member TEXT NOT NULL,
+  isadmin INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY (member) REFERENCES user (username)
+);
+CREATE TABLE schema_version (
+  num INT NOT NULL PRIMARY KEY,
+  enforcer INT DEFAULT 0 NOT NULL CHECK(enforcer == 0),
+  UNIQUE (enforcer)
+) WITHOUT ROWID;
+INSERT INTO user (username, password) VALUES ("Message Jar", "I am good at choosing passwords");
+INSERT INTO schema_version (num, enforcer) VALUES (3, 0);
+"""
+
+    DATA_V3 = """
+INSERT INTO user (username, password) VALUES ("a", "x"), ("b", "x");
+INSERT INTO rooms (roomname, member, isadmin) VALUES
+  ("general", "a", 1), ("general", "b", 0);
+INSERT INTO messages (id, author, created, content, room) VALUES
+  (1, "a", "2024-01-01 10:00:00", "hello everyone", "general"),
+  (2, "b", "2024-01-01 10:01:00", "hi a", "general"),
+  (3, "a", "2024-01-01 10:02:00", "fine then", "general"),
+  (4, "b", "2024-01-01 10:03:00", "still here", "general"),
+  (5, "a", "2024-01-01 10:04:00", "never mind", "general"),
+  (6, "b", "2024-01-01 10:05:00", "gone", "general");
+DELETE FROM messages WHERE id = 6;
+"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = None
+        self._load(self.SCHEMA_V11 + self.DATA_V11)
+
+    def _load(self, script, name="db.sqlite"):
+        """Make a database from ``script`` and an app that uses it."""
+
+        if self.app is not None:
+            self.app.extensions["log_handler"].close()
+        database = os.path.join(self.directory, name)
+        conn = sqlite3.connect(database)
+        conn.executescript(script)
+        conn.close()
+        self.app = create_app(
+            {"DATABASE": database, "MESSAGE_BUS": "memory", "PASSWORD_WORKERS": 0}
+        )
+
+    def tearDown(self):
+        self.app.extensions["log_handler"].close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _update(self, version):
+        output = io.StringIO()
+        with self.app.app_context(), contextlib.redirect_stdout(output):
+            db.update_db(version)
+        return output.getvalue()
+
+    def _query(self, sql, params=()):
+        with self.app.app_context(), db.DBConnection() as conn:
+            return [tuple(row) for row in conn.execute(sql, params).fetchall()]
+
+    def _check_common(self, version):
+        """What every version from 12 on keeps: the schema version, the
+        message id sequence, working search triggers and valid references."""
+
+        self.assertEqual(self._query("SELECT num FROM schema_version"), [(version,)])
+        self.assertEqual(
+            self._query("SELECT seq FROM sqlite_sequence WHERE name = 'messages'"),
+            [(6,)],
+            "message ids would be reused",
+        )
+        self.assertEqual(
+            self._query(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger' "
+                "AND tbl_name = 'messages' ORDER BY name"
+            ),
+            [
+                ("messages_fts_delete",),
+                ("messages_fts_insert",),
+                ("messages_fts_update",),
+            ],
+        )
+        self.assertEqual(self._query("PRAGMA foreign_key_check"), [])
+
+    def _search(self, term):
+        return self._query(
+            "SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid",
+            (term,),
+        )
+
+    def test_version_12(self):
+        self.assertIn("Done!", self._update(12))
+        self._check_common(12)
+
+        rooms = {
+            row[0]: row[1:]
+            for row in self._query(
+                "SELECT name, id, creator, deleted, max_age_days, max_count, "
+                "cleared_id FROM room"
+            )
+        }
+        self.assertEqual(
+            {name: row[1:] for name, row in rooms.items()},
+            {
+                "general": ("a", 0, 30, 100, 2),
+                "quiet": ("c", 0, None, None, 0),
+                "old": (None, 1, None, None, 0),
+            },
+        )
+        ids = {name: row[0] for name, row in rooms.items()}
+        self.assertEqual(
+            self._query("SELECT created FROM room WHERE name = 'general'"), [(1000,)]
+        )
+
+        self.assertEqual(
+            self._query("SELECT id, author, room_id FROM messages ORDER BY id"),
+            [
+                (1, "a", ids["general"]),
+                (2, "b", ids["general"]),
+                (3, "a", ids["old"]),
+                (4, "c", ids["quiet"]),
+                (5, "a", ids["general"]),
+            ],
+        )
+        self.assertEqual(
+            sorted(self._query("SELECT room_id, member, isadmin FROM room_members")),
+            sorted(
+                [
+                    (ids["general"], "a", 1),
+                    (ids["general"], "b", 0),
+                    (ids["general"], "c", 1),
+                    (ids["quiet"], "b", 0),
+                    (ids["quiet"], "c", 1),
+                ]
+            ),
+        )
+        self.assertEqual(
+            sorted(self._query("SELECT user, room_id, last_read_id FROM read_markers")),
+            sorted([("a", ids["general"], 5), ("b", ids["quiet"], 4)]),
+        )
+        self.assertEqual(
+            self._query("SELECT token, room_id FROM invitelinks"),
+            [("t1", ids["general"])],
+        )
+
+        # The search index still matches, and keeps up with new messages
+        self.assertEqual(self._search("hello"), [(1,)])
+        with self.app.app_context(), db.DBConnection() as conn:
+            conn.execute(
+                "INSERT INTO messages (author, content, room_id) VALUES (?, ?, ?)",
+                ("a", "hello again", ids["general"]),
+            )
+            conn.commit()
+        self.assertEqual(self._search("hello"), [(1,), (7,)])
+
+    def test_version_13(self):
+        # A message whose author was deleted, which was never shown
+        with sqlite3.connect(os.path.join(self.directory, "db.sqlite")) as conn:
+            conn.execute("UPDATE messages SET author = 'gone' WHERE id = 5")
+        conn.close()
+
+        self.assertIn("Done!", self._update(12))
+        output = self._update(13)
+        self.assertIn("Dropped 1 messages by users that no longer exist.", output)
+        self._check_common(13)
+
+        users = dict(self._query("SELECT username, id FROM user"))
+        self.assertEqual(users, {"Message Jar": 1, "a": 2, "b": 3, "c": 4})
+        ids = dict(self._query("SELECT name, id FROM room"))
+
+        self.assertEqual(
+            self._query("SELECT id, author_id, room_id FROM messages ORDER BY id"),
+            [
+                (1, users["a"], ids["general"]),
+                (2, users["b"], ids["general"]),
+                (3, users["a"], ids["old"]),
+                (4, users["c"], ids["quiet"]),
+            ],
+        )
+        self.assertEqual(self._search("fine"), [], "dropped message still indexed")
+        self.assertEqual(
+            sorted(self._query("SELECT name, creator_id FROM room")),
+            [("general", users["a"]), ("old", None), ("quiet", users["c"])],
+        )
+        self.assertEqual(
+            sorted(self._query("SELECT room_id, user_id, isadmin FROM room_members")),
+            sorted(
+                [
+                    (ids["general"], users["a"], 1),
+                    (ids["general"], users["b"], 0),
+                    (ids["general"], users["c"], 1),
+                    (ids["quiet"], users["b"], 0),
+                    (ids["quiet"], users["c"], 1),
+                ]
+            ),
+        )
+        self.assertEqual(
+            sorted(
+                self._query("SELECT user_id, room_id, last_read_id FROM read_markers")
+            ),
+            sorted([(users["a"], ids["general"], 5), (users["b"], ids["quiet"], 4)]),
+        )
+        self.assertEqual(
+            self._query("SELECT token, user_id FROM apitokens"), [("h1", users["b"])]
+        )
+        self.assertEqual(
+            self._query("SELECT token, user_id, room_id FROM invitelinks"),
+            [("t1", users["a"], ids["general"])],
+        )
+
+        # Foreign keys are back on once the update is done, and enforced
+        self.assertEqual(self._query("PRAGMA foreign_keys"), [(1,)])
+        with self.app.app_context(), db.DBConnection() as conn:
+            with self.assertRaises(sqlite3.IntegrityError):
+                conn.execute(
+                    "INSERT INTO messages (author_id, content, room_id) "
+                    "VALUES (99, 'who', ?)",
+                    (ids["general"],),
+                )
+
+    def test_latest_version_matches_schema(self):
+        self._update(SCHEMA_VERSION)
+        self._check_common(SCHEMA_VERSION)
+
+        fresh = os.path.join(self.directory, "fresh.sqlite")
+        conn = sqlite3.connect(fresh)
+        with open("schema.sql") as file:
+            conn.executescript(file.read())
+
+        def tables(conn):
+            names = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name NOT LIKE 'messages_fts_%' ORDER BY name"
+            ).fetchall()
+            return {
+                name: [row[1:] for row in conn.execute(f"PRAGMA table_info({name})")]
+                for name, in names
+            }
+
+        with sqlite3.connect(os.path.join(self.directory, "db.sqlite")) as updated:
+            self.assertEqual(tables(updated), tables(conn))
+        updated.close()
+        conn.close()
+
+    def test_from_version_3(self):
+        self._load(self.SCHEMA_V3 + self.DATA_V3, "v3.sqlite")
+        self.assertIn("Done!", self._update(SCHEMA_VERSION))
+        self._check_common(SCHEMA_VERSION)
+
+        self.assertEqual(
+            self._query("SELECT id, created FROM messages ORDER BY id"),
+            [(i, 1704103200000 + (i - 1) * 60000) for i in range(1, 6)],
+        )
+        self.assertEqual(self._search("hello"), [(1,)])
+
 
 if __name__ == "__main__":
     unittest.main()
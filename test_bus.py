@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from bus import MemoryBus, RedisBus, SQLiteBus, create_bus
+
+try:
+    from redislite import StrictRedis  # type: ignore
+except ImportError:
+    StrictRedis = None
+
+
+class BusTests:
+    """Behaviour every bus must have. Subclasses set up ``self.bus``."""
+
+    def publish_later(self, room, message_id, delay=0.1):
+        timer = threading.Timer(delay, self.bus.publish, (room, message_id))
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_wait_times_out(self):
+        start = time.monotonic()
+        self.assertFalse(self.bus.wait("a", 0, 0.1))
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+    def test_publish_wakes_waiter(self):
+        self.publish_later("a", 1)
+        start = time.monotonic()
+        self.assertTrue(self.bus.wait("a", 0, 5))
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(self.bus.latest("a"), 1)
+
+    def test_earlier_publish_is_not_lost(self):
+        self.bus.publish("a", 3)
+        self.assertTrue(self.bus.wait("a", 2, 0))
+        self.assertFalse(self.bus.wait("a", 3, 0))
+
+    def test_rooms_are_separate(self):
+        self.publish_later("b", 1)
+        self.assertFalse(self.bus.wait("a", 0, 0.3))
+
+    def test_wakes_every_waiter(self):
+        results = []
+        waiters = [
+            threading.Thread(target=lambda: results.append(self.bus.wait("a", 0, 5)))
+            for _ in range(5)
+        ]
+        for waiter in waiters:
+            waiter.start()
+        self.publish_later("a", 1)
+        for waiter in waiters:
+            waiter.join()
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(self.bus.stats()["waiting"], 0)
+
+    def test_broadcast_reaches_own_subscribers(self):
+        received = []
+        self.bus.subscribe("c", received.append)
+        self.bus.broadcast("c", {"x": 1})
+        self.bus.broadcast("other", {"x": 2})
+        self.assertEqual(received, [{"x": 1}])
+
+    def assert_broadcast_between(self, sender, receiver):
+        received = threading.Event()
+        payloads = []
+
+        def callback(payload):
+            payloads.append(payload)
+            received.set()
+
+        receiver.subscribe("c", callback)
+        sender.broadcast("c", {"room": "a"})
+        self.assertTrue(received.wait(5), "broadcast not received")
+        self.assertEqual(payloads, [{"room": "a"}])
+
+
+class TestMemoryBus(BusTests, unittest.TestCase):
+    def setUp(self):
+        self.bus = MemoryBus()
+
+    def test_forget(self):
+        self.bus.publish("a", 1)
+        self.bus.forget("a")
+        self.assertEqual(self.bus.latest("a"), 0)
+
+
+class TestSQLiteBus(BusTests, unittest.TestCase):
+    def setUp(self):
+        handle, self.database = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        self.addCleanup(os.remove, self.database)
+
+        conn = sqlite3.connect(self.database)
+        conn.execute("CREATE TABLE room (id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+        conn.execute(
+            "CREATE TABLE messages (id INTEGER PRIMARY KEY, room_id INTEGER NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE bus_events (id INTEGER PRIMARY KEY, origin TEXT NOT NULL, "
+            "channel TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        conn.execute("INSERT INTO room (name) VALUES ('a')")
+        conn.commit()
+        conn.close()
+
+        self.bus = SQLiteBus(self.database, interval=0.01)
+
+    def test_sees_other_connections(self):
+        def insert():
+            conn = sqlite3.connect(self.database)
+            conn.execute(
+                "INSERT INTO messages (room_id) SELECT id FROM room WHERE name = 'a'"
+            )
+            conn.commit()
+            conn.close()
+
+        timer = threading.Timer(0.1, insert)
+        timer.start()
+        self.addCleanup(timer.join)
+
+        self.assertTrue(self.bus.wait("a", 0, 5))
+        self.assertEqual(self.bus.latest("a"), 1)
+
+    def test_broadcast_between_buses(self):
+        self.assert_broadcast_between(SQLiteBus(self.database, 0.01), self.bus)
+
+
+@unittest.skipIf(StrictRedis is None, "redislite is not installed")
+class TestRedisBus(BusTests, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.redis = StrictRedis(os.path.join(tempfile.mkdtemp(), "bus.rdb"))
+
+    def setUp(self):
+        # A channel per test, so listeners of earlier tests stay out of it
+        self.channel = self.id()
+        self.bus = RedisBus(self.redis, channel=self.channel)
+
+    def test_sees_other_buses(self):
+        other = RedisBus(self.redis, channel=self.channel)
+        other._listen()
+        timer = threading.Timer(0.1, self.bus.publish, ("a", 1))
+        timer.start()
+        self.addCleanup(timer.join)
+        self.assertTrue(other.wait("a", 0, 5))
+
+    def test_broadcast_between_buses(self):
+        other = RedisBus(self.redis, channel=self.channel)
+        self.assert_broadcast_between(other, self.bus)
+
+
+class TestCreateBus(unittest.TestCase):
+    def test_auto_without_redis_uses_sqlite(self):
+        self.assertIsInstance(create_bus("auto", database=":memory:"), SQLiteBus)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            create_bus("carrier pigeon")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -47,7 +47,9 @@ def pass_change():
 
         if error is None:
             try:
-                auth.change_password(username, old_password, new_password)
+                epoch = auth.change_password(username, old_password, new_password)
+                # Other sessions end, but this one carries on
+                auth.start_session(username, epoch)
                 f.flash("Password successfully changed.")
                 f.current_app.logger.info(f"User {username} changed their password.")
                 return f.redirect(f.url_for("jar.index"))
@@ -67,15 +69,13 @@ def rmtoken():
     
     message = None
 
-    token = f.request.form.get("token")
+    token_name = f.request.form.get("token_name")
 
-    if token is None:
-        message = "Token is required!"
+    if token_name is None:
+        message = "Token name is required!"
     else:
         try:
-            if auth.check_valid_token(token) != f.g.user["username"]:
-                raise AuthError
-            auth.revoke_api_token(token)
+            auth.revoke_named_token(f.g.user["username"], token_name)
         except AuthError:
             message = "Invalid token!"
 
@@ -103,10 +103,24 @@ def tokens():
 
     if message is None:
         try:
-            auth.generate_api_token(f.g.user["username"], token_name)
-            message = "Token sucsessfully created."
+            token = auth.generate_api_token(f.g.user["username"], token_name)
         except auth.NotAllowedError as e:
             message = e.message
+        else:
+            # Only the hash is kept, so this is the one chance to copy it. The
+            # session cookie is only signed, so the token must not go in it.
+            f.flash(
+                "Token sucsessfully created. Copy it now, it will not be shown again."
+            )
+            resp = f.make_response(
+                f.render_template(
+                    "user/token.html",
+                    token_list=cb.list_tokens(f.g.user["username"]),
+                    new_token=token,
+                )
+            )
+            resp.headers["Cache-Control"] = "no-store"
+            return resp
 
     f.flash(message)
     return f.redirect(f.url_for("user.tokens"))
@@ -123,8 +137,8 @@ def create_invite(username, room, name):
 
     with DBConnection() as db:
         r = db.execute(
-            "SELECT token FROM invitelinks WHERE username = ? AND invite_name = ?",
-            (username, name),
+            "SELECT token FROM invitelinks WHERE user_id = ? AND invite_name = ?",
+            (cb.user_id(username), name),
         ).fetchone()
 
     if r is not None:
@@ -133,8 +147,8 @@ def create_invite(username, room, name):
     token = secrets.token_urlsafe(32)
     with DBConnection() as db:
         db.execute(
-            "INSERT INTO invitelinks (username, token, room, invite_name) VALUES (?, ?, ?, ?)",
-            (username, token, room, name),
+            "INSERT INTO invitelinks (user_id, token, room_id, invite_name) VALUES (?, ?, ?, ?)",
+            (cb.user_id(username), token, cb.room_id(room), name),
         )
         db.commit()
 
@@ -159,10 +173,11 @@ def list_invite(user):
     with DBConnection() as db:
         tokens = db.execute(
             """
-        SELECT room, token, invite_name
-        FROM invitelinks
-        WHERE username = ?;""",
-            (user,),
+        SELECT r.name AS room, i.token, i.invite_name
+        FROM invitelinks i
+        JOIN room r ON r.id = i.room_id
+        WHERE i.user_id = ?;""",
+            (cb.user_id(user),),
         ).fetchall()
 
     token_list = [
@@ -178,7 +193,10 @@ def invite_details(token):
 
     with DBConnection() as db:
         r = db.execute(
-            "SELECT room, username FROM invitelinks WHERE token = ?", (token,)
+            "SELECT r.name AS room, u.username FROM invitelinks i "
+            "JOIN room r ON r.id = i.room_id AND r.deleted = 0 "
+            "JOIN user u ON u.id = i.user_id WHERE i.token = ?",
+            (token,),
         ).fetchall()
 
     if r is None: